@@ -2,19 +2,35 @@ from __future__ import absolute_import
 
 import re
 import os
+import json
 import time
 import zlib
-import math
 import struct
+import itertools
 import threading
-import colorsys
+import traceback
+try:
+    from queue import Queue, Empty
+except ImportError:  # ST2
+    from Queue import Queue, Empty
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # ST2
+    ThreadPoolExecutor = None
+from bisect import bisect_left, bisect_right
 from functools import partial
 
 import sublime
 import sublime_plugin
 
 from .settings import Settings, SettingTogglerCommandMixin
-from .colorizer import SchemaColorizer, all_names_to_hex, names_to_hex, xterm_to_hex, xterm8_to_hex, xterm8b_to_hex, xterm8f_to_hex
+from .regions import RegionIndex
+from .cache import LRUCache
+from .scheduler import Scheduler, ACTIVE, VISIBLE, BACKGROUND
+from .debounce import Debounce
+from .stats import Stats, capture_format
+from .colorspace import CONVERTERS, hsv_to_rgb, hsl_to_rgb, hwb_to_rgb, lab_to_rgb, lch_to_lab, lch_to_rgb, to_rgb
+from .colorizer import SchemaColorizer, write_file, all_names_to_hex, names_to_hex, xterm_to_hex, xterm8_to_hex, xterm8b_to_hex, xterm8f_to_hex
 
 NAME = "Color Highlight"
 VERSION = "1.2.2"
@@ -44,6 +60,14 @@ VERSION = "1.2.2"
 
 regex_cache = {}
 re_cache = {}
+prefilter_cache = {}
+
+# Named colors are not part of the big regex (an alternation of ~150 names,
+# each with its own lookarounds, tried at every position); instead words are
+# pulled out with a single cheap pattern and looked up in a set.
+NAMED_COLORS = frozenset(names_to_hex)
+NAMED_COLOR_TOKEN_RE = re.compile(r'[-.\w]+')
+NAMED_COLOR_ARGUMENT = r'(?<![-.\w])[a-z]+(?![-.\w])'  # e.g. rgba(white, 20%)
 
 
 def regex_factory(
@@ -88,8 +112,6 @@ def regex_factory(
             function_colors.append(r'lch')
 
         simple_colors = []
-        if named_values:
-            simple_colors.append(r'(?<![-.\w])%s(?![-.\w])' % r'(?![-.\w])|(?<![-.\w])'.join(names_to_hex.keys()))
         if x_hex_values and hex_values:
             simple_colors.append(r'(?:#|0x)[0-9a-fA-F]{8}\b')
             simple_colors.append(r'(?:#|0x)[0-9a-fA-F]{6}\b')
@@ -106,10 +128,16 @@ def regex_factory(
         if xterm_color_values:
             simple_colors.append(r'(?:\x1b|\\033|\\x1b|\\u001b|\\e|\\E)\[\d{1,3}(?:;\d{1,3})*m')
 
+        # Standalone named colors are found by find_named_colors(), but they
+        # still need to be matched as function arguments:
+        argument_colors = list(simple_colors)
+        if named_values:
+            argument_colors.append(NAMED_COLOR_ARGUMENT)
+
         colors_regex = []
         if function_colors:
             num = r'\s*([-+]?(?:[0-9]*\.\d+|[0-9]+)(?:%|deg)?)\s*'
-            sc = r'|(%s)' % r'|'.join(simple_colors) if simple_colors else r''
+            sc = r'|(%s)' % r'|'.join(argument_colors) if argument_colors else r''
             colors_regex.append(r'(%s)\((?:%s,%s,%s%s)(?:,%s)?\)' % (r'|'.join(function_colors), num, num, num, sc, num))
 
         if simple_colors:
@@ -118,6 +146,8 @@ def regex_factory(
 
         if function_colors and simple_colors:
             colors_regex_capture = r'\1|\2\5\7,\3,\4,\6'
+        elif function_colors and argument_colors:
+            colors_regex_capture = r'\1|\2\5,\3,\4,\6'
         elif function_colors:
             colors_regex_capture = r'\1|\2,\3,\4,\5'
         elif simple_colors:
@@ -177,103 +207,125 @@ def re_factory(
     return colors_re, colors_re_capture
 
 
-def hsv_to_rgb(h, s, v):
-    # h -> [0, 360)
-    # s -> [0, 100]
-    # l -> [0, 100]
-
-    H = h / 360.0
-    S = s / 100.0
-    V = v / 100.0
-
-    RR, GG, BB = colorsys.hsv_to_rgb(H, S, V)
-    return int(RR * 255), int(GG * 255), int(BB * 255)
-
-
-def hsl_to_rgb(h, s, l):
-    # h -> [0, 360)
-    # s -> [0, 100]
-    # l -> [0, 100]
-
-    H = h / 360.0
-    S = s / 100.0
-    L = l / 100.0
-
-    RR, GG, BB = colorsys.hls_to_rgb(H, L, S)
-    return int(RR * 255), int(GG * 255), int(BB * 255)
-
-
-def hwb_to_rgb(h, w, b):
-    # h -> [0, 360)
-    # w -> [0, 100]
-    # b -> [0, 100]
-    H = h / 360.0
-    W = w / 100.0
-    B = b / 100.0
-
-    RR, GG, BB = colorsys.hls_to_rgb(H, 0.5, 1)
-    RR = RR * (1 - W - B) + W
-    GG = GG * (1 - W - B) + W
-    BB = BB * (1 - W - B) + W
-
-    r, g, b = int(RR * 255), int(GG * 255), int(BB * 255)
-    r = 0 if r < 0 else 255 if r > 255 else r
-    g = 0 if g < 0 else 255 if g > 255 else g
-    b = 0 if b < 0 else 255 if b > 255 else b
-    return r, g, b
-
-
-def lab_to_rgb(L, a, b):
-    # L -> [0, 100]
-    # a -> [-160, 160]
-    # b -> [-160, 160]
-
-    Y = (L + 16.0) / 116.0
-    X = a / 500.0 + Y
-    Z = Y - b / 200.0
-
-    Y3 = Y ** 3.0
-    Y = Y3 if Y3 > 0.008856 else (Y - 16.0 / 116.0) / 7.787
-
-    X3 = X ** 3.0
-    X = X3 if X3 > 0.008856 else (X - 16.0 / 116.0) / 7.787
-
-    Z3 = Z ** 3.0
-    Z = Z3 if Z3 > 0.008856 else (Z - 16.0 / 116.0) / 7.787
-
-    # Normalize white point for Observer=2°, Illuminant=D65
-    X *= 0.95047
-    Y *= 1.0
-    Z *= 1.08883
-
-    # XYZ to RGB
-    RR = X * 3.240479 + Y * -1.537150 + Z * - 0.498535
-    GG = X * -0.969256 + Y * 1.875992 + Z * 0.041556
-    BB = X * 0.055648 + Y * -0.204043 + Z * 1.057311
-
-    RR = 1.055 * RR ** (1 / 2.4) - 0.055 if RR > 0.0031308 else 12.92 * RR
-    GG = 1.055 * GG ** (1 / 2.4) - 0.055 if GG > 0.0031308 else 12.92 * GG
-    BB = 1.055 * BB ** (1 / 2.4) - 0.055 if BB > 0.0031308 else 12.92 * BB
-
-    r, g, b = int(RR * 255), int(GG * 255), int(BB * 255)
-    r = 0 if r < 0 else 255 if r > 255 else r
-    g = 0 if g < 0 else 255 if g > 255 else g
-    b = 0 if b < 0 else 255 if b > 255 else b
-    return r, g, b
+def prefilter_factory(
+    named_values,
+    x_hex_values,
+    hex_values,
+    xterm_color_values,
+    rgb_values,
+    hsv_values,
+    hsl_values,
+    hwb_values,
+    lab_values,
+    lch_values,
+):
+    '''Compiles a regex for the literal substrings that any color matched by the
+       colors regex must contain, for the enabled formats only. Named colors
+       are not part of the colors regex (see find_named_colors()).'''
+    key = (
+        named_values,
+        x_hex_values,
+        hex_values,
+        xterm_color_values,
+        rgb_values,
+        hsv_values,
+        hsl_values,
+        hwb_values,
+        lab_values,
+        lch_values,
+    )
+    try:
+        prefilter_re = prefilter_cache[key]
+    except KeyError:
+        triggers = []
+        if x_hex_values:
+            triggers.append(r'#')
+        if hex_values:
+            triggers.append(r'0x')
+        if rgb_values:
+            triggers.append(r'rgba?\(')
+        if hsv_values:
+            triggers.append(r'hsva?\(')
+        if hsl_values:
+            triggers.append(r'hsla?\(')
+        if hwb_values:
+            triggers.append(r'hwb\(')
+        if lab_values:
+            triggers.append(r'lab\(')
+        if lch_values:
+            triggers.append(r'lch\(')
+        if xterm_color_values:
+            triggers.append(r'\x1b\[|\\(?:033|x1b|u001b|e|E)\[')
+        prefilter_re = re.compile(r'|'.join(triggers)) if triggers else None
 
+        prefilter_cache[key] = prefilter_re
 
-def lch_to_lab(L, c, h):
-    # L -> [0, 100]
-    # c -> [0, 230]
-    # h -> [0, 360)
-    a = c * math.cos(math.radians(h))
-    b = c * math.sin(math.radians(h))
-    return L, a, b
+    return prefilter_re
 
 
-def lch_to_rgb(L, c, h):
-    L, a, b = lch_to_lab(L, c, h)
-    return lab_to_rgb(L, a, b)
+def find_colors(text, colors_re, colors_re_capture, prefilter_re, named_values):
+    '''Returns the (start, end) spans of the colors in text and, for each one,
+       its capture (as in "rgba|255,0,0,0.5" or "|#FFF"). Only lines with a
+       prefilter_re match (and any lines a function color there continues
+       into) ever reach the colors regex.'''
+    spans = []
+    found = []
+    if prefilter_re:
+        size = len(text)
+        pos = 0
+        while pos < size:
+            m = prefilter_re.search(text, pos)
+            if not m:
+                break
+            start = text.rfind('\n', 0, m.start()) + 1
+            end = text.find('\n', m.end())
+            if end == -1:
+                end = size
+            # Function colors can span lines, as in "rgb(255,\n 255,\n 255)",
+            # and the lines added can start more of them:
+            tail = start
+            while True:
+                paren = text.rfind('(', tail, end)
+                if paren == -1:
+                    break
+                close = text.find(')', paren)
+                if close <= end:
+                    break
+                tail = end
+                end = text.find('\n', close)
+                if end == -1:
+                    end = size
+            for m in colors_re.finditer(text, start, end):
+                gr = m.groups()
+                spans.append((m.start(), m.end()))
+                found.append(''.join(gr[ord(g) - 1] or '' if ord(g) < 10 else g for g in colors_re_capture))
+            pos = end + 1
+    if named_values:
+        named = find_named_colors(text, spans)
+        spans.extend((a, b) for a, b, name in named)
+        found.extend('|' + name for a, b, name in named)
+    return spans, found
+
+
+def find_named_colors(text, spans=()):
+    '''Returns (start, end, name) for every standalone named color in text,
+       skipping names inside the sorted (start, end) spans already matched
+       by the colors regex (as in "rgba(white, 20%)").'''
+    # A name only matches when not surrounded by [-.\w], so it must be a
+    # whole [-.\w]+ token; most texts have none, so check that first:
+    if not NAMED_COLORS.intersection(NAMED_COLOR_TOKEN_RE.findall(text)):
+        return []
+    starts = [s for s, e in spans]
+    named = []
+    for m in NAMED_COLOR_TOKEN_RE.finditer(text):
+        name = m.group()
+        if name in NAMED_COLORS:
+            start = m.start()
+            i = bisect_right(starts, start) - 1
+            if i >= 0 and spans[i][1] > start:
+                continue
+            named.append((start, m.end(), name))
+    return named
 
 
 def tohex(r, g, b, a):
@@ -297,9 +349,264 @@ def tohex(r, g, b, a):
     return '#%s%s%s%s' % (sr, sg, sb, sa)
 
 
-# Full PNG is: PNG_HEAD + PNG_IHDR + PNG_IDAT[mode] + PNG_IEND
+# Normalized colors (or False) by colors regex capture:
+color_cache = LRUCache(4096)
+
+
+def normalized_color(capture):
+    '''Returns the normalized #RRGGBBAA color for a colors regex capture, or
+       False if it's not a valid color; memoized, as the same few captures
+       tend to repeat all over a file.'''
+    col = color_cache.get(capture)
+    if col is None:
+        col = colorizer.normalize(parse_color(capture)) or False
+        color_cache.put(capture, col)
+    return col
+
+
+def normalized_colors(captures):
+    '''Same as normalized_color() for a list of captures, but the functional
+       notation colors (hsl, hsv, hwb, lab and lch) not in the cache get
+       grouped by color space and converted a whole batch at a time.'''
+    cols = {}
+    deferred = {}
+    for capture in captures:
+        if capture in cols:
+            continue
+        col = color_cache.get(capture)
+        if col is None:
+            col = parse_color(capture, defer_convert)
+            if isinstance(col, tuple):
+                space, args, alpha = col
+                deferred.setdefault(space, []).append((capture, args, alpha))
+                cols[capture] = None
+                continue
+            col = colorizer.normalize(col) or False
+            color_cache.put(capture, col)
+        cols[capture] = col
+    for space, pending in deferred.items():
+        rgbs = to_rgb(space, [args for capture, args, alpha in pending])
+        for (capture, args, alpha), rgb in zip(pending, rgbs):
+            if rgb is None:
+                # Let the scalar converter decide (or raise):
+                col = parse_color(capture)
+            else:
+                col = tohex(rgb[0], rgb[1], rgb[2], alpha)
+            col = colorizer.normalize(col) or False
+            color_cache.put(capture, col)
+            cols[capture] = col
+    return [cols[capture] for capture in captures]
+
+
+def convert(space, args, alpha):
+    r, g, b = CONVERTERS[space](*args)
+    return tohex(r, g, b, alpha)
+
+
+def defer_convert(space, args, alpha):
+    return space, args, alpha
+
+
+def parse_color(capture, convert=convert):
+    '''Parses a colors regex capture (as in "rgba|255,0,0,0.5" or "|#FFF")
+       into a color; returns None if it's not a valid color. Functional
+       notation colors are converted to RGB by convert(space, args, alpha).'''
+    mode, _, col = capture.partition('|')
+    col = col.rstrip(',')
+    col = col.split(',')
+    try:
+        if mode in ('hsl', 'hsla', 'hsv', 'hsva', 'hwb'):
+            if len(col) > 2 and col[0] and col[1] and col[2]:
+                # In the form of hsl(360, 100%, 100%) or hsla(360, 100%, 100%, 1.0) or hwb(360, 50%, 50%):
+                if col[0].endswith('deg'):
+                    col[0] = col[0][:-3]
+                h = float(col[0]) % 360
+                if col[1].endswith('%'):
+                    sb = float(col[1][:-1])
+                else:
+                    sb = float(col[1]) * 100.0
+                if sb < 0 or sb > 100:
+                    raise ValueError("sb out of range")
+                if col[2].endswith('%'):
+                    lwv = float(col[2][:-1])
+                else:
+                    lwv = float(col[2]) * 100.0
+                if lwv < 0 or lwv > 100:
+                    raise ValueError("lwv out of range")
+                if mode == 'hwb':
+                    if sb + lwv > 100:
+                        raise ValueError("sb + lwv > 100")
+                if len(col) == 4:
+                    if mode in ('hsl', 'hsv'):
+                        raise ValueError("hsl/hsv should not have alpha")
+                    if col[3].endswith('%'):
+                        alpha = float(col[3][:-1])
+                    else:
+                        alpha = float(col[3]) * 100.0
+                    if alpha < 0 or alpha > 100:
+                        raise ValueError("alpha out of range")
+                elif mode in ('hsla', 'hsva'):
+                    return None
+                else:
+                    alpha = 100.0
+                col = convert(mode[:3], (h, sb, lwv), alpha)
+            else:
+                raise ValueError("invalid hsl/hsla/hwb")
+        elif mode == 'lab':
+            # The first argument specifies the CIE Lightness, the second
+            # argument is a and the third is b. L is constrained to the
+            # range [0, 100] while a and b are signed values and
+            # theoretically unbounded (but in practice do not exceed ±160).
+            # There is an optional fourth alpha value separated by a comma.
+            if len(col) > 2 and col[0] and col[1] and col[2]:
+                # In the form of lab(100, 0, 0) or lab(100, 0, 0, 1.0):
+                # lab(100, 0, 127) <-> rgb(255, 250, 0)
+                L = float(col[0])
+                if L < 0 or L > 100:
+                    raise ValueError("L out of range")
+                a = float(col[1])
+                b = float(col[2])
+                if len(col) == 4:
+                    if col[3].endswith('%'):
+                        alpha = float(col[3][:-1])
+                    else:
+                        alpha = float(col[3]) * 100.0
+                    if alpha < 0 or alpha > 100:
+                        raise ValueError("alpha out of range")
+                else:
+                    alpha = 100.0
+                col = convert('lab', (L, a, b), alpha)
+            else:
+                raise ValueError("invalid lab")
+        elif mode == 'lch':
+            # The first argument specifies the CIE Lightness, the second
+            # argument is C and the third is H. L is constrained to the
+            # range [0, 100]. C is an unsigned number, theoretically
+            # unbounded (but in practice does not exceed 230). H is
+            # constrained to the range [0, 360). There is an optional
+            # fourth alpha value separated by a comma.
+            if len(col) > 2 and col[0] and col[1] and col[2]:
+                # In the form of lch(0, 250, 360) or lch(100, 100, 360, 1.0):
+                L = float(col[0])
+                if L < 0 or L > 100:
+                    raise ValueError("L out of range")
+                c = float(col[1])
+                if c < 0:
+                    raise ValueError("c out of range")
+                if col[2].endswith('deg'):
+                    col[2] = col[2][:-3]
+                h = float(col[2]) % 360
+                if len(col) == 4:
+                    if col[3].endswith('%'):
+                        alpha = float(col[3][:-1])
+                    else:
+                        alpha = float(col[3]) * 100.0
+                    if alpha < 0 or alpha > 100:
+                        raise ValueError("alpha out of range")
+                else:
+                    alpha = 100.0
+                col = convert('lch', (L, c, h), alpha)
+            else:
+                raise ValueError("invalid lch")
+        elif len(col) == 1:
+            # In the form of: black, #FFFFFFFF, 0xFFFFFF, \033[1;37m, \033[38;5;255m, \033[38;2;255;255;255m:
+            col0 = col[0]
+            if col0.endswith('m') and '[' in col0:
+                _, _, col0 = col0[:-1].partition('[')
+                col0 = ';' + col0 + ';'
+                col0 = re.sub(r';0*(?=\d)', r';', col0)
+                xterm_true = col0.find(';38;2;')
+                xterm = col0.find(';38;5;')
+                if xterm_true != -1:
+                    col = col0[xterm_true + 6:-1].split(';')
+                    r = int(col[0])
+                    g = int(col[1])
+                    b = int(col[2])
+                    if (r < 0 or r > 255) or (g < 0 or g > 255) or (b < 0 or b > 255):
+                        raise ValueError("rgb out of range")
+                    col = tohex(r, g, b, 100.0)
+                elif xterm != -1:
+                    col = col0[xterm + 6:-1].split(';')[0]
+                    col = xterm_to_hex.get(col)
+                    if not col:
+                        return None
+                else:
+                    mode = xterm8_to_hex
+                    modes = (xterm8_to_hex, xterm8b_to_hex, xterm8f_to_hex)
+                    q = -1
+                    for m in (0, 1, 2):
+                        p = col0.find(';%s;' % m)
+                        if p != -1 and p > q:
+                            mode = modes[m]
+                    xterm8 = col0[1:-1].split(';')
+                    col = None
+                    for x in xterm8:
+                        if x in mode:
+                            col = mode[x]
+                    if not col:
+                        return None
+            else:
+                if col0.startswith('0x'):
+                    col0 = '#' + col0[2:]
+                else:
+                    if col0[:1].isalpha() and col0 not in NAMED_COLORS:
+                        raise ValueError("unknown color name")
+                    col0 = all_names_to_hex.get(col0.lower(), col0.upper())
+                if len(col0) == 4:
+                    col0 = '#' + col0[1] * 2 + col0[2] * 2 + col0[3] * 2 + 'FF'
+                elif len(col0) == 7:
+                    col0 += 'FF'
+                col = col0
+        elif col[1] and col[2]:
+            # In the form of rgb(255, 255, 255) or rgba(255, 255, 255, 1.0):
+            r = int(col[0])
+            g = int(col[1])
+            b = int(col[2])
+            if (r < 0 or r > 255) or (g < 0 or g > 255) or (b < 0 or b > 255):
+                raise ValueError("rgb out of range")
+            if len(col) == 4:
+                if col[3].endswith('%'):
+                    alpha = float(col[3][:-1])
+                else:
+                    alpha = float(col[3]) * 100.0
+                if alpha < 0 or alpha > 100:
+                    raise ValueError("alpha out of range")
+            else:
+                alpha = 100.0
+            col = tohex(r, g, b, alpha)
+        else:
+            # In the form of rgba(white, 20%) or rgba(#FFFFFF, 0.4):
+            col0 = col[0]
+            if col0[:1].isalpha() and col0 not in NAMED_COLORS:
+                raise ValueError("unknown color name")
+            col0 = all_names_to_hex.get(col0.lower(), col0.upper())
+            if col0.startswith('0X'):
+                col0 = '#' + col0[2:]
+            if len(col0) == 4:
+                col0 = '#' + col0[1] * 2 + col0[2] * 2 + col0[3] * 2 + 'FF'
+            elif len(col0) == 7:
+                col0 += 'FF'
+            if len(col) == 4:
+                col3 = col[3]
+                if col3.endswith('%'):
+                    alpha = float(col3[:-1])
+                else:
+                    alpha = float(col3) * 100.0
+                if alpha < 0 or alpha > 100:
+                    raise ValueError("alpha out of range")
+            else:
+                alpha = 100.0
+            col = tohex(col0, None, None, alpha)
+    except (ValueError, IndexError, KeyError, OverflowError) as e:
+        # print(e)
+        return None
+
+    return col
+
+
+# Icon templates are the IDAT chunks of 32x32 RGBA PNGs drawn with two
+# placeholder colors (see PNG_PLACEHOLDERS), made into indexed-color ones:
 PNG_HEAD = b'\x89PNG\r\n\x1a\n'
-PNG_IHDR = b'\x00\x00\x00\x0dIHDR\x00\x00\x00 \x00\x00\x00 \x08\x06\x00\x00\x00szz\xf4'
 PNG_IDAT = {
     'circle': b'\x00\x00\x01\x13IDATx\x9c\xed\xd6\xc1\r\xc3 \x0c@QX!g\xa4\x8c\xd0\x11:BF\xe8\x01q\xee\x1c\xdd\x82e2\x00\xb30\x00\xb5U#U\x11\x85`\xac\xe6\xc2\xe1_\xc3K\x93\xd8U)%ue\x97\x1e>\x01\x13P\x05\xac\xb7{)\x03Y\xc8C\x01\x8a\xdb\xe3\x89\x05\xc8C\x162\x90:6\n\xd0\x90\x83v(}\x07\x17?\xb6C\x0e\xd2R\x80\x05z\x1d\x0f\xae\x00r/h\x19\x05\xe8\xda\xe1\r@F\xe8\x11\x80\xab\x1d~\x02\x90\xe8q\xb0\x00\xa6\xf4\xcc\x19\x00|\'\x0c\x07`[\x87\x9f\x04`\x96\x03\xf0\x82\x00\xcf\x01\x04A@\xe0\x00\xa2  v\x03h\xc25/~\x06\x897\xc3\x01\x04A@\xff#\xa0\xd9.\x05\xe8\x7f\ti\xb1H\x01\xfa?\xc3\xed\xb3\xd5v\x01\x00\x0e\xb3\xfeADK\xc4\t\x00p\x9c\xf7\x8fb\x02hZ(\\\x00.2=\x02\xc0\x96\x1a\xa2q8\xaer5\n\xc8\xbf\x84+\xbd\x13?\x9e\xb9\xcbw.\x05\xc8\x19\xfa:<\xcd\x89H\x133\xd0\xee\xc0\x05f\xd6\xc2\xdf\xb9n\xc0\xbf\x9a\x80\t\xb8\x1c\xf0\x06-\x9f\xcd\xf4\x17\xe9(\x03',
     'square': b'\x00\x00\x00\x4aIDATx\x9c\xed\xceA\r\x00 \x0cC\xd19A\x02\x12\x90\x80\x04$\xe0\xff\xd49 =\xb1,\xf9\x87\x7fm_H\x8a\xcaJ\xcf\x01\x00x\x02\xc6\\r\xda\xe7Z\x01\x00\x00\x00@?\x80;\xecB\x01\x00\x00\x00\xa0\x1f\xe0W\x00\x00\x94\x03\x12\\\xf0$\x87\xd4i\x0c\x98',
@@ -307,55 +614,305 @@ PNG_IDAT = {
 }
 PNG_IEND = b'\x00\x00\x00\x00IEND\xaeB`\x82'
 
-PNG_RE = re.compile(b'\\x1f\\x2f\\x3f|\\x4f\\x5f\\x6f')
-PNG_DATA = {
-    'circle': zlib.decompress(PNG_IDAT['circle'][8:-4]),
-    'square': zlib.decompress(PNG_IDAT['square'][8:-4]),
-    'fill': zlib.decompress(PNG_IDAT['fill'][8:-4]),
-}
+PNG_SIZE = 32
+PNG_PLACEHOLDERS = (b'\x1f\x2f\x3f', b'\x4f\x5f\x6f')
+
+
+def png_chunk(kind, data):
+    return struct.pack('!I', len(data)) + kind + data + struct.pack('!I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def png_template(idat):
+    '''Turns an RGBA icon template into an indexed-color one, returned as
+       (head, palette, tail): the PNG up to its PLTE chunk, the RGB colors
+       in the palette and the PNG after its PLTE chunk (tRNS, with the alpha
+       of each color, IDAT and IEND). Only the palette changes with the
+       color of the icon, the compressed image data is shared by all.'''
+    data = zlib.decompress(idat[8:-4])
+    stride = PNG_SIZE * 4 + 1  # rows start with their filter type (always 0)
+    pixels = {}
+    palette = []
+    indexed = bytearray()
+    for row in range(PNG_SIZE):
+        indexed.append(0)
+        for i in range(row * stride + 1, (row + 1) * stride, 4):
+            pixel = data[i:i + 4]
+            if pixel not in pixels:
+                pixels[pixel] = len(palette)
+                palette.append(pixel)
+            indexed.append(pixels[pixel])
+    head = PNG_HEAD + png_chunk(b'IHDR', struct.pack('!IIBBBBB', PNG_SIZE, PNG_SIZE, 8, 3, 0, 0, 0))
+    tail = png_chunk(b'tRNS', b''.join(pixel[3:4] for pixel in palette))
+    tail += png_chunk(b'IDAT', zlib.compress(bytes(indexed), 9))
+    tail += PNG_IEND
+    return head, [pixel[:3] for pixel in palette], tail
+
+
+PNG_TEMPLATES = dict((mode, png_template(idat)) for mode, idat in PNG_IDAT.items())
 DEFAULT_GUTTER_ICON = 'circle'
 
+ICONS = None  # Relative paths of the icons in the cache, by file name (see icon_index())
+ICONS_LOCK = threading.Lock()  # For building ICONS, which several threads may ask for first
+ICON_USES = {}  # Time each icon in the cache was last used, by file name
+ICON_SIZES = {}  # Size of each icon in the cache, by file name (see stat_icons())
+ICON_MANIFEST = 'manifest.json'  # Kept in the cache, with the ICON_USES and ICON_SIZES of its icons
+
+
+def icon_index(base_path):
+    '''Returns the index of the icons in the cache (by file name), read from
+       the cache directory the first time, and then kept as icons get
+       written; so icons are found without touching the filesystem.'''
+    global ICONS
+    if ICONS is None:
+        with ICONS_LOCK:
+            if ICONS is None:  # not built meanwhile
+                if not os.path.exists(base_path):
+                    os.mkdir(base_path)
+                if hasattr(os, 'scandir'):
+                    names = [entry.name for entry in os.scandir(base_path)]
+                else:  # ST3
+                    names = os.listdir(base_path)
+                names = [fn for fn in names if fn.endswith('.png')]
+                manifest = read_icon_manifest(base_path)
+                ICON_USES.clear()
+                ICON_SIZES.clear()
+                for fn in names:
+                    try:
+                        ICON_USES[fn], ICON_SIZES[fn] = manifest[fn]
+                    except (KeyError, TypeError, ValueError):
+                        pass  # not in the manifest, see stat_icons()
+                prefix = icon_relpath(base_path, '')
+                ICONS = dict((fn, prefix + fn) for fn in names)
+    return ICONS
+
+
+def stat_icons(base_path, icons):
+    '''Fills in the last use (taken to be when it was written) and size of
+       the icons in the cache missing from the manifest, from the files.'''
+    for fn in list(icons):
+        if fn not in ICON_SIZES:
+            try:
+                st = os.stat(os.path.join(base_path, fn))
+            except OSError:
+                continue
+            ICON_USES.setdefault(fn, st.st_mtime)
+            ICON_SIZES[fn] = st.st_size
+
+
+def read_icon_manifest(base_path):
+    '''Returns the [last used, size] of the icons in the cache manifest.'''
+    try:
+        with open(os.path.join(base_path, ICON_MANIFEST)) as fp:
+            return json.load(fp)['icons']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return {}
 
-def toicon(name, gutter_icon=True, light=True):
-    base_path = os.path.join(sublime.packages_path(), 'User', '%s.cache' % NAME)
+
+def write_icon_manifest(base_path):
+    '''Writes the manifest of the icons in the cache.'''
+    icons = dict((fn, [used, ICON_SIZES.get(fn, 0)]) for fn, used in list(ICON_USES.items()))
+    write_file(os.path.join(base_path, ICON_MANIFEST), json.dumps({'icons': icons}, sort_keys=True))
+
+
+def icon_relpath(base_path, fn):
+    '''Returns the path to an icon in the cache, as Sublime wants it.'''
+    relative_base_path = os.path.relpath(base_path, os.path.dirname(sublime.packages_path()))
+    return relative_base_path.replace('\\', '/') + '/' + fn
+
+
+def icon_file(name, gutter_icon=True):
+    '''Returns the file name of the icon of a color in the cache.'''
+    if gutter_icon not in PNG_TEMPLATES:
+        gutter_icon = DEFAULT_GUTTER_ICON
+    return name + '_' + gutter_icon + '.png'
+
+
+def icon_png(name, gutter_icon=True, light=True):
+    '''Returns the PNG image of the icon of a color.'''
+    if gutter_icon not in PNG_TEMPLATES:
+        gutter_icon = DEFAULT_GUTTER_ICON
+    r = int(name[4:6], 16)
+    g = int(name[6:8], 16)
+    b = int(name[8:10], 16)
+    a = int(name[10:12] or 'ff', 16) / 255.0
+    # print("r={} g={} b={} a={}".format(r, g, b, a))
+    if light:
+        x = 0xff * (1 - a)
+        y = 0xcc * (1 - a)
+    else:
+        x = 0x99 * (1 - a)
+        y = 0x66 * (1 - a)
+    r *= a
+    g *= a
+    b *= a
+    # print("x(r={} g={} b={}), y(r={} g={} b={})".format(int(r + x), int(g + x), int(b + x), int(r + y), int(g + y), int(b + y)))
+    I1 = lambda v: struct.pack("!B", v & (2**8 - 1))
+    col_map = {
+        PNG_PLACEHOLDERS[0]: I1(int(r + x)) + I1(int(g + x)) + I1(int(b + x)),
+        PNG_PLACEHOLDERS[1]: I1(int(r + y)) + I1(int(g + y)) + I1(int(b + y)),
+    }
+    head, palette, tail = PNG_TEMPLATES[gutter_icon]
+    return head + png_chunk(b'PLTE', b''.join(col_map.get(rgb, rgb) for rgb in palette)) + tail
+
+
+def write_icon(base_path, fn, png):
+    '''Writes an icon to the cache (atomically) and adds it to the index.'''
+    icons = icon_index(base_path)
     if not os.path.exists(base_path):
         os.mkdir(base_path)
-    if gutter_icon not in PNG_DATA:
-        gutter_icon = DEFAULT_GUTTER_ICON
-    icon_path = os.path.join(base_path, name + '_' + gutter_icon + '.png')
-    if not os.path.exists(icon_path):
-        r = int(name[4:6], 16)
-        g = int(name[6:8], 16)
-        b = int(name[8:10], 16)
-        a = int(name[10:12] or 'ff', 16) / 255.0
-        # print("r={} g={} b={} a={}".format(r, g, b, a))
-        if light:
-            x = 0xff * (1 - a)
-            y = 0xcc * (1 - a)
+    write_file(os.path.join(base_path, fn), png, 'wb')
+    ICON_USES[fn] = time.time()
+    ICON_SIZES[fn] = len(png)
+    icons[fn] = icon_relpath(base_path, fn)
+    return icons[fn]
+
+
+PENDING_ICONS = set()  # File names of the icons queued to be written
+ICON_WAITERS = {}  # Icon regions waiting for their icon to be written, by file name (UI thread)
+
+
+def toicon(name, gutter_icon=True, light=True):
+    '''Returns the path of the icon of a color, if it's in the cache already;
+       otherwise queues it to be written in the background and returns None
+       (see icons_written()).'''
+    fn = icon_file(name, gutter_icon)
+    try:
+        icon = ICONS[fn]
+    except (KeyError, TypeError):
+        pass
+    else:
+        ICON_USES[fn] = time.time()
+        return icon
+    base_path = os.path.join(sublime.packages_path(), 'User', '%s.cache' % NAME)
+    icons = icon_index(base_path)
+    if fn in icons:
+        ICON_USES[fn] = time.time()
+        return icons[fn]
+    if fn not in PENDING_ICONS:
+        PENDING_ICONS.add(fn)
+        __icon_queue_.put((base_path, fn, icon_png(name, gutter_icon, light)))
+    return None
+
+
+def icon_loop(icon_queue):
+    '''Writes the icons queued by toicon(), taking all those queued at once
+       as a batch; the views get their icons once the batch is written.'''
+    while True:
+        batch = [icon_queue.get()]
+        while batch[-1] is not None:
+            try:
+                batch.append(icon_queue.get_nowait())
+            except Empty:
+                break
+        written = []
+        for item in batch:
+            if item is not None:
+                base_path, fn, png = item
+                try:
+                    write_icon(base_path, fn, png)
+                    written.append(fn)
+                except Exception:
+                    traceback.print_exc()
+                PENDING_ICONS.discard(fn)
+            icon_queue.task_done()
+        if written:
+            sublime.set_timeout(partial(icons_written, written), 0)
+        if batch[-1] is None:
+            break
+
+
+def flush_icons():
+    '''Waits for the icons queued to be written.'''
+    __icon_queue_.join()
+
+
+def icons_written(fns):
+    '''Sets the icons just written to the icon regions waiting for them.'''
+    queue_evict_icons()
+    for fn in fns:
+        icon = ICONS and ICONS.get(fn)
+        for view, name in ICON_WAITERS.pop(fn, ()):
+            state = VIEWS.get(view.id())
+            if icon and state and name in state.regions:
+                wi = view.get_regions(name + '_icon')
+                if wi:
+                    view.add_regions(name + '_icon', wi, '%sgutter' % colorizer.prefix, icon=icon, flags=sublime.PERSISTENT)
+
+
+ICON_THREADS = 4  # Threads generating icons ahead of time
+ICON_CHUNK = 64  # Icons generated by a thread at a time
+__icons_cancel_ = None  # Set to cancel the icons being generated ahead of time
+
+
+def pregenerate_icons():
+    '''Generates the gutter icons (in every shape) for all named and xterm
+       colors missing from the cache, in a pool of background threads, so
+       icons for common colors are already there the first time they're
+       needed. Reports the progress and the time it took in the status bar.'''
+    global __icons_cancel_
+    cancel_icons()
+    cancel = __icons_cancel_ = threading.Event()
+    threading.Thread(target=generate_icons, args=(cancel,), name='color highlight icons').start()
+
+
+def generate_icons(cancel):
+    '''Finds the icons missing from the cache for pregenerate_icons(), in a
+       background thread (as reading the cache directory may take a while),
+       and generates them in a pool of threads.'''
+    base_path = os.path.join(sublime.packages_path(), 'User', '%s.cache' % NAME)
+    icons = icon_index(base_path)
+    names = sorted(set(colorizer.region_name(colorizer.normalize(col)) for col in itertools.chain(names_to_hex.values(), xterm_to_hex.values())))
+    todo = [(name, shape) for name in names for shape in sorted(PNG_TEMPLATES) if name + '_' + shape + '.png' not in icons]
+    if not todo or cancel.is_set():
+        return
+
+    chunks = [todo[i:i + ICON_CHUNK] for i in range(0, len(todo), ICON_CHUNK)]
+    progress = {'done': 0, 'chunks': 0}
+    lock = threading.Lock()
+    start = time.time()
+
+    def generate(chunk):
+        try:
+            for name, shape in chunk:
+                if cancel.is_set():
+                    break
+                fn = icon_file(name, shape)
+                if fn not in icons and fn not in PENDING_ICONS:
+                    write_icon(base_path, fn, icon_png(name, shape))
+                with lock:
+                    progress['done'] += 1
+        except Exception:
+            traceback.print_exc()
+        with lock:
+            progress['chunks'] += 1
+            finished = progress['chunks'] == len(chunks)
+            done = progress['done']
+        if finished:
+            if cancel.is_set():
+                message = '%s: generating gutter icons cancelled, %d of %d generated in %.1fs' % (NAME, done, len(todo), time.time() - start)
+            else:
+                message = '%s: %d gutter icons generated in %.1fs' % (NAME, done, time.time() - start)
+            print(message)
         else:
-            x = 0x99 * (1 - a)
-            y = 0x66 * (1 - a)
-        r *= a
-        g *= a
-        b *= a
-        # print("x(r={} g={} b={}), y(r={} g={} b={})".format(int(r + x), int(g + x), int(b + x), int(r + y), int(g + y), int(b + y)))
-        I1 = lambda v: struct.pack("!B", v & (2**8 - 1))
-        I4 = lambda v: struct.pack("!I", v & (2**32 - 1))
-        png = PNG_HEAD + PNG_IHDR
-        col_map = {
-            b'\x1f\x2f\x3f': I1(int(r + x)) + I1(int(g + x)) + I1(int(b + x)),
-            b'\x4f\x5f\x6f': I1(int(r + y)) + I1(int(g + y)) + I1(int(b + y)),
-        }
-        data = PNG_RE.sub(lambda m: col_map[m.group(0)], PNG_DATA[gutter_icon])
-        compressed = zlib.compress(data)
-        idat = b'IDAT' + compressed
-        png += I4(len(compressed)) + idat + I4(zlib.crc32(idat))
-        png += PNG_IEND
-        with open(icon_path, 'wb') as fp:
-            fp.write(png)
-    relative_icon_path = os.path.relpath(icon_path, os.path.dirname(sublime.packages_path()))
-    relative_icon_path = relative_icon_path.replace('\\', '/')
-    return relative_icon_path
+            message = '%s: generating gutter icons, %d of %d' % (NAME, done, len(todo))
+        sublime.set_timeout(partial(sublime.status_message, message), 0)
+
+    if ThreadPoolExecutor is None:
+        for chunk in chunks:
+            generate(chunk)
+        return
+    executor = ThreadPoolExecutor(ICON_THREADS)
+    try:
+        for chunk in chunks:
+            executor.submit(generate, chunk)
+    finally:
+        executor.shutdown(wait=False)  # threads exit once all chunks are done
+
+
+def cancel_icons():
+    '''Cancels the generation of icons ahead of time, if it's running.'''
+    if __icons_cancel_ is not None:
+        __icons_cancel_.set()
 
 
 # Commands
@@ -481,6 +1038,16 @@ class ColorHighlightCommand(sublime_plugin.TextCommand):
             self.toggle_hex_values()
         elif lc_action == 'xhex':
             self.toggle_xhex_values()
+        elif lc_action == 'debounce':
+            self.show_debounce()
+        elif lc_action == 'compact':
+            queue_compact_colors(force=True)
+        elif lc_action == 'icons':
+            pregenerate_icons()
+        elif lc_action == 'cancel-icons':
+            cancel_icons()
+        elif lc_action == 'evict-icons':
+            queue_evict_icons(force=True)
         else:
             highlight_colors(self.view)
 
@@ -494,10 +1061,22 @@ class ColorHighlightCommand(sublime_plugin.TextCommand):
         settings.save()
         queue_highlight_colors(self.view, preemptive=True)
 
+    def show_debounce(self):
+        '''Shows the debounce parameters chosen for the view.'''
+        state = view_state(self.view)
+        if state is None:
+            sublime.status_message('%s: the view is not highlighted' % NAME)
+            return
+        params = state.debounce.params()
+        message = ', '.join('%s=%s' % (k, '%.4g' % v if isinstance(v, float) else v) for k, v in sorted(params.items()))
+        print('%s debounce: %s' % (NAME, message))
+        sublime.status_message('%s debounce: %s' % (NAME, message))
+
     def reset(self):
         '''Removes existing lint marks and restores user settings.'''
         erase_highlight_colors()
-        TIMES.clear()
+        for state in VIEWS.values():
+            state.time = None
         colorizer.setup_color_scheme(self.view.settings())
         queue_highlight_colors(self.view, preemptive=True)
 
@@ -526,33 +1105,81 @@ class ColorHighlightCommand(sublime_plugin.TextCommand):
         erase_highlight_colors()
 
 
+def color_cache_report():
+    '''Returns a line with the hits and misses of the color cache, to tune
+       color_cache_size by.'''
+    stats = color_cache.stats()
+    return '%s color cache: %d of %d colors, %d hits, %d misses (%.1f%% hit rate), %d evictions' % (
+        NAME, stats['size'], stats['maxsize'], stats['hits'], stats['misses'], stats['hit_rate'] * 100, stats['evictions'])
+
+
+# command to show the timing and counters of the last highlighting passes
+class ColorHighlightStatsCommand(sublime_plugin.TextCommand):
+    def run(self, edit, dump=None):
+        '''Shows percentiles of the stats kept for the view and for all views
+           in an output panel; if dump is given, all samples are also written
+           as JSON to that path (or to User/Color Highlight.stats.json if
+           dump is true).'''
+        name = self.view.file_name() or self.view.name() or 'view %d' % self.view.id()
+        state = view_state(self.view)
+        reports = [STATS.report('%s stats for all views' % NAME), color_cache_report()]
+        if state is not None:
+            reports.insert(0, state.stats.report('%s stats for %s' % (NAME, name)))
+        report = '\n\n'.join(reports)
+        window = self.view.window() or sublime.active_window()
+        panel = window.create_output_panel('color_highlight_stats')
+        panel.run_command('append', {'characters': report + '\n'})
+        window.run_command('show_panel', {'panel': 'output.color_highlight_stats'})
+
+        if dump:
+            path = os.path.join(sublime.packages_path(), 'User', '%s.stats.json' % NAME) if dump is True else dump
+            with open(path, 'w') as fp:
+                STATS.dump(fp)
+            sublime.status_message('%s stats written to %s' % (NAME, path))
+
+
 class ColorHighlightViewEventListener(sublime_plugin.ViewEventListener):
     def on_modified(self):
         if settings.get('highlight') is not True:
             return
 
+        state = view_state(self.view)
+        if state is None:
+            return
+        state.debounce.keystroke(time.time())
+        if state.coverage is not None and state.dirty is None:
+            state.coverage = 0  # lines may have moved between blocks (as in ST3)
+
         action = self.view.command_history(0, True)[0]
         if action == 'revert':
             erase_highlight_colors()
             queue_highlight_colors(self.view, preemptive=True)
         else:
-            selection = action != 'paste'
-            queue_highlight_colors(self.view, preemptive=selection, selection=selection)
+            # Pasted text can span many lines, only text-change deltas cover it:
+            queue_highlight_colors(self.view, selection=action != 'paste' or state.dirty is not None)
+
+    def on_new(self):
+        register_view(self.view)
+
+    def on_load(self):
+        register_view(self.view)
+
+    def on_clone(self):
+        register_view(self.view)
 
     def on_close(self):
-        vid = self.view.id()
-        if vid in TIMES:
-            del TIMES[vid]
-        if vid in COLOR_HIGHLIGHTS:
-            del COLOR_HIGHLIGHTS[vid]
+        cancel_highlight_colors(self.view)
+        VIEWS.pop(self.view.id(), None)
+        queue_compact_colors()  # colors only that view used can go
+        queue_evict_icons()
 
     def on_activated(self):
         if self.view.file_name() is None:
             return
-        vid = self.view.id()
-        if vid in TIMES:
+        state = view_state(self.view)
+        if state is None or state.time is not None:
             return
-        TIMES[vid] = 100
+        state.time = 100
 
         if settings.get('highlight') in (False, 'save-only'):
             return
@@ -566,575 +1193,892 @@ class ColorHighlightViewEventListener(sublime_plugin.ViewEventListener):
         queue_highlight_colors(self.view, preemptive=True)
 
     def on_selection_modified(self):
-        delay_queue(1000)  # on movement, delay queue (to make movement responsive)
+        # On movement, delay queue (to make movement responsive); the
+        # rescans of what's being typed already wait for typing to pause:
+        scheduler.postpone(1000, keys=lambda key: key[1] != 'selection')
+
+
+if hasattr(sublime_plugin, 'TextChangeListener'):
+    class ColorHighlightTextChangeListener(sublime_plugin.TextChangeListener):
+        '''Records the text actually changed (by typing, macros, multiple
+           cursors or plugins calling view.replace()) so only that gets rescanned.'''
+
+        @classmethod
+        def is_applicable(cls, buffer):
+            return True
+
+        def on_text_changed(self, changes):
+            for view in self.buffer.views():
+                state = view_state(view)
+                if state is None:
+                    continue
+                index = state.index
+                for change in changes:
+                    mark_dirty(view, change.a.pt, change.b.pt, len(change.str))
+                    shift_pending(view, change.a.pt, change.b.pt, len(change.str))
+                    shift_coverage(view, change.a.row, change.b.row, change.str)
+                    if index is not None:
+                        index.shift(change.a.pt, change.b.pt, len(change.str))
+
+
+PROGRESSIVE_SIZE = 512000  # Files larger than this are highlighted progressively (or lazily), until their cost is measured
+PROGRESSIVE_DELAY = 10  # ms between progressive highlighting slices
+SLICE_SIZE = 65536
+MIN_SLICE_SIZE = 4096
+MAX_SLICE_SIZE = 4194304
+BLOCK_LINES = 64  # Lines per block in coverage bitmaps
+VIEWPORT_INTERVAL = 250  # ms between checks for the viewport having moved
+STATS_SAMPLES = 1024  # Highlighting passes whose stats are kept, for all views
+VIEW_STATS_SAMPLES = 256  # Highlighting passes whose stats are kept, for each view
+
+
+class ViewState(object):
+    """
+    Everything Color Highlight keeps track of for a view.
+    """
+    __slots__ = (
+        'view', 'time', 'regions', 'index', 'change_count', 'dirty',
+        'pending', 'slice_size', 'coverage', 'viewport', 'inflight', 'debounce',
+        'stats',
+    )
 
+    def __init__(self, view):
+        self.view = view
+        self.time = None  # how long (ms) the last full color highlight took
+        self.regions = set()  # names of the highlighted regions
+        self.index = None  # highlighted ranges, by position (a RegionIndex)
+        self.change_count = None  # of the view, when the regions were last updated
+        self.dirty = None  # changed (begin, end) spans waiting to be rescanned, None unless text changes are tracked
+        self.pending = None  # not yet scanned (begin, end) spans of a large view, being highlighted progressively
+        self.slice_size = SLICE_SIZE  # how many bytes fit in a progressive highlighting slice
+        self.coverage = None  # bitmap of the blocks of lines already scanned, when highlighted lazily
+        self.viewport = None  # last visible region seen
+        self.inflight = []  # jobs taken from dirty or pending spans and not yet applied
+        self.debounce = Debounce()  # measured costs and typing rate, and the delays chosen from them
+        self.stats = Stats(VIEW_STATS_SAMPLES)  # timing and counters of the last highlighting passes
 
-TIMES = {}  # collects how long it took the color highlight to complete
-COLOR_HIGHLIGHTS = {}  # Highlighted regions
 
+STATS = Stats(STATS_SAMPLES)  # timing and counters of the last highlighting passes, in all views
 
-def erase_highlight_colors(view=None):
-    if view:
-        vid = view.id()
-        if vid in COLOR_HIGHLIGHTS:
-            for name in COLOR_HIGHLIGHTS[vid]:
-                view.erase_regions(name)
-                view.erase_regions(name + '_icon')
-        COLOR_HIGHLIGHTS[vid] = set()
-    else:
-        for window in sublime.windows():
-            for view in window.views():
-                erase_highlight_colors(view)
 
+VIEWS = {}  # Open views, by id (kept by on_new, on_load, on_clone and on_close, see register_view())
 
-def highlight_colors(view, selection=False, **kwargs):
-    view_settings = view.settings()
-    colorizer.setup_color_scheme(view_settings)
 
-    vid = view.id()
-    start = time.time()
+def choose_debounce(view, selection=False):
+    '''Has the view's Debounce choose the delays before highlighting it, and
+       whether it's to be highlighted as a large file; returns the delays.
+       For a selection pass, the delays are chosen for rescanning the text
+       changed (or around the cursors) once typing pauses.'''
+    if selection:
+        state = view_state(view)
+        spans = state.dirty
+        if spans is None:  # text changes aren't tracked (as in ST3)
+            spans = [(r.begin(), r.end()) for r in view.sel()]
+        return state.debounce.choose_typing(sum(b - a for a, b in spans), len(spans))
+    size = view.size()
+    return view_state(view).debounce.choose(
+        size,
+        view.rowcol(size)[0] + 1,
+        settings.get('blocking_time_budget', 150),
+        int(settings.get('delay', 0) * 1000),
+        large=size > PROGRESSIVE_SIZE,
+    )
 
-    named_values = bool(settings.get('named_values', True))
-    hex_values = bool(settings.get('hex_values', True))
-    x_hex_values = bool(settings.get('0x_hex_values', True))
-    xterm_color_values = bool(settings.get('xterm_color_values', True))
-    rgb_values = bool(settings.get('rgb_values', True))
-    hsv_values = bool(settings.get('hsv_values', True))
-    hsl_values = bool(settings.get('hsl_values', True))
-    hwb_values = bool(settings.get('hwb_values', True))
-    lab_values = bool(settings.get('lab_values', True))
-    lch_values = bool(settings.get('lch_values', True))
 
-    if len(view.sel()) > 100:
-        selection = False
+def is_large_view(view):
+    '''Returns whether the view is to be highlighted as a large file.'''
+    choose_debounce(view)
+    return view_state(view).debounce.large
 
-    if selection:
-        selected_lines = [ln for r in view.sel() for ln in view.lines(r)]
-    elif view.size() > 512000:
-        selected_lines = view.lines(view.visible_region())
-    else:
-        selected_lines = None
 
-    words = {}
-    found = []
-    if selected_lines:
-        colors_re, colors_re_capture = re_factory(
-            named_values=named_values,
-            x_hex_values=x_hex_values,
-            hex_values=hex_values,
-            xterm_color_values=xterm_color_values,
-            rgb_values=rgb_values,
-            hsv_values=hsv_values,
-            hsl_values=hsl_values,
-            hwb_values=hwb_values,
-            lab_values=lab_values,
-            lch_values=lch_values,
-        )
-        matches = [colors_re.finditer(view.substr(l)) for l in selected_lines]
-        matches = [
-            (
-                sublime.Region(
-                    selected_lines[i].begin() + m.start(),
-                    selected_lines[i].begin() + m.end()
-                ),
-                m.groups()
-            ) if m else (None, None)
-            for i, am in enumerate(matches) for m in am
-        ]
-        matches = [
-            (
-                rg,
-                ''.join(
-                    gr[ord(g) - 1] or '' if ord(g) < 10 else g for g in colors_re_capture
-                )
-            )
-            for rg, gr in matches if rg
-        ]
-        if matches:
-            ranges, found = zip(*[q for q in matches if q])
+def register_view(view):
+    '''Registers the view to be highlighted, unless it's a widget (as the
+       find panel) or a panel, returning its ViewState (None if it isn't).'''
+    if view.settings().get('is_widget'):
+        return None
+    window = view.window()
+    if window is not None and view.id() not in set(v.id() for v in window.views()):
+        return None  # a panel
+    try:
+        return VIEWS[view.id()]
+    except KeyError:
+        state = VIEWS[view.id()] = ViewState(view)
+        return state
+
+
+def view_state(view):
+    '''Returns the ViewState of the view; None if it isn't registered.'''
+    return VIEWS.get(view.id())
+
+
+def mark_dirty(view, begin, end, length):
+    '''Records that the text in [begin, end) was replaced by length characters.
+       Spans recorded earlier are shifted (or grown) to the text after the change.'''
+    state = view_state(view)
+    delta = length - (end - begin)
+    spans = [(begin, begin + length)]
+    for a, b in state.dirty or ():
+        if b < begin:
+            spans.append((a, b))
+        elif a > end:
+            spans.append((a + delta, b + delta))
         else:
-            ranges = []
+            spans[0] = (min(a, spans[0][0]), max(b + delta, spans[0][1]))
+    if len(spans) > 100:
+        spans = [(min(a for a, b in spans), max(b for a, b in spans))]
+    state.dirty = spans
+
+
+def shift_spans(spans, begin, end, length):
+    '''Follows the text in [begin, end) being replaced by length characters,
+       so the (begin, end) spans keep covering the same text.'''
+    delta = length - (end - begin)
+    for i, (a, b) in enumerate(spans):
+        if b < begin:
+            continue
+        elif a > end:
+            spans[i] = (a + delta, b + delta)
+        else:
+            spans[i] = (min(a, begin), max(b + delta, begin + length))
+
+
+def shift_pending(view, begin, end, length):
+    '''Shifts the spans waiting to be highlighted, and those being scanned,
+       after a change to the text.'''
+    state = VIEWS.get(view.id())
+    if state is None:
+        return
+    if state.pending:
+        shift_spans(state.pending, begin, end, length)
+    for job in state.inflight:
+        shift_spans(job.spans, begin, end, length)
+
+
+def shift_coverage(view, begin_row, end_row, text):
+    '''Follows the lines in [begin_row, end_row] being replaced by text: the
+       blocks touched are no longer covered, and the ones after the change
+       stay covered only if all the lines that end up in them were.'''
+    state = VIEWS.get(view.id())
+    coverage = state.coverage if state else None
+    if not coverage:
+        return
+    new_lines = text.count('\n')
+    delta = new_lines - (end_row - begin_row)
+    first = begin_row // BLOCK_LINES
+    last = (begin_row + new_lines) // BLOCK_LINES
+    tail = coverage
+    if delta:
+        # Block k now holds the lines of old blocks k - q (and k - q - 1,
+        # unless the shift is a whole number of blocks):
+        q, r = divmod(delta, BLOCK_LINES)
+        tail = coverage << q if q >= 0 else coverage >> -q
+        if r:
+            tail &= coverage << (q + 1) if q + 1 >= 0 else coverage >> -(q + 1)
+    tail = tail >> (last + 1) << (last + 1)
+    state.coverage = (coverage & ((1 << first) - 1)) | tail
+
+
+def cover_visible_blocks(view):
+    '''Marks the blocks of lines around the visible region as covered,
+       returning the lines of those which weren't (the ones to scan).'''
+    state = view_state(view)
+    coverage = state.coverage or 0
+    visible = view.visible_region()
+    state.viewport = visible
+    first = max(0, view.rowcol(visible.begin())[0] // BLOCK_LINES - 1)
+    last = view.rowcol(visible.end())[0] // BLOCK_LINES + 1
+    last_row = view.rowcol(view.size())[0]
+    lines = []
+    for block in range(first, min(last, last_row // BLOCK_LINES) + 1):
+        if not coverage >> block & 1:
+            coverage |= 1 << block
+            begin = view.text_point(block * BLOCK_LINES, 0)
+            end = view.line(view.text_point(min(last_row, block * BLOCK_LINES + BLOCK_LINES - 1), 0)).end()
+            lines.append(sublime.Region(begin, end))
+    state.coverage = coverage
+    return merge_lines(lines)
+
+
+def watch_viewport():
+    '''Checks every now and then (as there are no scrolling events) whether
+       the viewport of the active view moved, to highlight any blocks of
+       lines coming into view not yet covered.'''
+    if not __watching_:
+        return
+    sublime.set_timeout(watch_viewport, VIEWPORT_INTERVAL)
+    window = sublime.active_window()
+    view = window.active_view() if window else None
+    state = VIEWS.get(view.id()) if view else None
+    if state is None or state.coverage is None:
+        return
+    if view.visible_region() == state.viewport:
+        return
+    lines = cover_visible_blocks(view)
+    if lines:
+        if state.pending is None:
+            state.pending = []
+        state.pending[:0] = [(line.begin(), line.end()) for line in lines]
+        queue_highlight_colors(view, delay=PROGRESSIVE_DELAY, pending=True)
+
+
+def pop_pending_lines(view):
+    '''Returns the next line-aligned block of text waiting to be highlighted
+       progressively, as much as fits in a slice; None if there's none left.'''
+    state = view_state(view)
+    spans = state.pending
+    if not spans:
+        return None
+    size = view.size()
+    budget = state.slice_size
+    lines = []
+    while spans and budget > 0:
+        begin, end = spans.pop(0)
+        end = min(end, size)
+        if begin >= end:
+            continue
+        block = view.line(sublime.Region(begin, min(end, begin + budget)))
+        if block.end() + 1 < end:
+            spans.insert(0, (block.end() + 1, end))
+        lines.append(block)
+        budget -= block.size() + 1
+    return merge_lines(lines) or None
+
+
+def pop_dirty_lines(view):
+    '''Returns the lines with changes since the last call, merged and sorted;
+       None if no text changes have been recorded for the view (as in ST3).'''
+    state = view_state(view)
+    spans = state.dirty
+    if spans is None:
+        return None
+    state.dirty = []
+    size = view.size()
+    return merge_lines(view.line(sublime.Region(min(a, size), min(b, size))) for a, b in spans)
+
+
+def merge_lines(lines):
+    '''Sorts lines, merging overlapping and consecutive ones into blocks.'''
+    merged = []
+    for line in sorted(lines, key=lambda l: l.begin()):
+        if merged and line.begin() <= merged[-1].end() + 1:
+            merged[-1] = merged[-1].cover(line)
+        else:
+            merged.append(line)
+    return merged
+
+
+def region_index(view):
+    '''Returns the view's RegionIndex, rebuilt from the view's regions when
+       the text changed without text changes being tracked to keep it in sync
+       (as in ST3).'''
+    state = view_state(view)
+    index = state.index
+    if index is None or (state.dirty is None and state.change_count != view.change_count()):
+        index = state.index = RegionIndex()
+        index.reset((r.begin(), r.end(), name) for name in state.regions for r in view.get_regions(name))
+    return index
+
+
+def erase_highlight_colors(view=None):
+    if view:
+        state = view_state(view)
+        if state is None:
+            return
+        for name in state.regions:
+            view.erase_regions(name)
+            view.erase_regions(name + '_icon')
+        state.regions = set()
+        state.index = None
+        state.pending = None
+        state.coverage = None
     else:
-        colors_regex, colors_regex_capture = regex_factory(
-            named_values=named_values,
-            x_hex_values=x_hex_values,
-            hex_values=hex_values,
-            xterm_color_values=xterm_color_values,
-            rgb_values=rgb_values,
-            hsv_values=hsv_values,
-            hsl_values=hsl_values,
-            hwb_values=hwb_values,
-            lab_values=lab_values,
-            lch_values=lch_values,
-        )
-        ranges = view.find_all(colors_regex, 0, colors_regex_capture, found)
+        for state in list(VIEWS.values()):
+            erase_highlight_colors(state.view)
+
+
+class HighlightJob(object):
+    """
+    A highlighting pass: a snapshot of the text to scan, taken in the UI
+    thread, and (once scanned, possibly in the scanner thread) what was found.
+    """
+    __slots__ = (
+        'view', 'change_count', 'selection', 'pending', 'progressive', 'dirty',
+        'lines', 'texts', 'spans', 'bg_col', 'words', 'icons', 'elapsed',
+        'stats',
+    )
 
-    for i, col in enumerate(found):
-        mode, _, col = col.partition('|')
-        col = col.rstrip(',')
-        col = col.split(',')
-        try:
-            if mode in ('hsl', 'hsla', 'hsv', 'hsva', 'hwb'):
-                if len(col) > 2 and col[0] and col[1] and col[2]:
-                    # In the form of hsl(360, 100%, 100%) or hsla(360, 100%, 100%, 1.0) or hwb(360, 50%, 50%):
-                    if col[0].endswith('deg'):
-                        col[0] = col[0][:-3]
-                    h = float(col[0]) % 360
-                    if col[1].endswith('%'):
-                        sb = float(col[1][:-1])
-                    else:
-                        sb = float(col[1]) * 100.0
-                    if sb < 0 or sb > 100:
-                        raise ValueError("sb out of range")
-                    if col[2].endswith('%'):
-                        lwv = float(col[2][:-1])
-                    else:
-                        lwv = float(col[2]) * 100.0
-                    if lwv < 0 or lwv > 100:
-                        raise ValueError("lwv out of range")
-                    if mode == 'hwb':
-                        if sb + lwv > 100:
-                            raise ValueError("sb + lwv > 100")
-                    if len(col) == 4:
-                        if mode in ('hsl', 'hsv'):
-                            raise ValueError("hsl/hsv should not have alpha")
-                        if col[3].endswith('%'):
-                            alpha = float(col[3][:-1])
-                        else:
-                            alpha = float(col[3]) * 100.0
-                        if alpha < 0 or alpha > 100:
-                            raise ValueError("alpha out of range")
-                    elif mode in ('hsla', 'hsva'):
-                        continue
-                    else:
-                        alpha = 100.0
-                    if mode in ('hsl', 'hsla'):
-                        r, g, b = hsl_to_rgb(h, sb, lwv)
-                    elif mode in ('hsv', 'hsva'):
-                        r, g, b = hsv_to_rgb(h, sb, lwv)
-                    else:
-                        r, g, b = hwb_to_rgb(h, sb, lwv)
-                    col = tohex(r, g, b, alpha)
-                else:
-                    raise ValueError("invalid hsl/hsla/hwb")
-            elif mode == 'lab':
-                # The first argument specifies the CIE Lightness, the second
-                # argument is a and the third is b. L is constrained to the
-                # range [0, 100] while a and b are signed values and
-                # theoretically unbounded (but in practice do not exceed ±160).
-                # There is an optional fourth alpha value separated by a comma.
-                if len(col) > 2 and col[0] and col[1] and col[2]:
-                    # In the form of lab(100, 0, 0) or lab(100, 0, 0, 1.0):
-                    # lab(100, 0, 127) <-> rgb(255, 250, 0)
-                    L = float(col[0])
-                    if L < 0 or L > 100:
-                        raise ValueError("L out of range")
-                    a = float(col[1])
-                    b = float(col[2])
-                    if len(col) == 4:
-                        if col[3].endswith('%'):
-                            alpha = float(col[3][:-1])
-                        else:
-                            alpha = float(col[3]) * 100.0
-                        if alpha < 0 or alpha > 100:
-                            raise ValueError("alpha out of range")
-                    else:
-                        alpha = 100.0
-                    r, g, b = lab_to_rgb(L, a, b)
-                    col = tohex(r, g, b, alpha)
-                else:
-                    raise ValueError("invalid lab")
-            elif mode == 'lch':
-                # The first argument specifies the CIE Lightness, the second
-                # argument is C and the third is H. L is constrained to the
-                # range [0, 100]. C is an unsigned number, theoretically
-                # unbounded (but in practice does not exceed 230). H is
-                # constrained to the range [0, 360). There is an optional
-                # fourth alpha value separated by a comma.
-                if len(col) > 2 and col[0] and col[1] and col[2]:
-                    # In the form of lch(0, 250, 360) or lch(100, 100, 360, 1.0):
-                    L = float(col[0])
-                    if L < 0 or L > 100:
-                        raise ValueError("L out of range")
-                    c = float(col[1])
-                    if c < 0:
-                        raise ValueError("c out of range")
-                    if col[2].endswith('deg'):
-                        col[2] = col[2][:-3]
-                    h = float(col[2]) % 360
-                    if len(col) == 4:
-                        if col[3].endswith('%'):
-                            alpha = float(col[3][:-1])
-                        else:
-                            alpha = float(col[3]) * 100.0
-                        if alpha < 0 or alpha > 100:
-                            raise ValueError("alpha out of range")
-                    else:
-                        alpha = 100.0
-                    r, g, b = lch_to_rgb(L, c, h)
-                    col = tohex(r, g, b, alpha)
-                else:
-                    raise ValueError("invalid lch")
-            elif len(col) == 1:
-                # In the form of: black, #FFFFFFFF, 0xFFFFFF, \033[1;37m, \033[38;5;255m, \033[38;2;255;255;255m:
-                col0 = col[0]
-                if col0.endswith('m') and '[' in col0:
-                    _, _, col0 = col0[:-1].partition('[')
-                    col0 = ';' + col0 + ';'
-                    col0 = re.sub(r';0*(?=\d)', r';', col0)
-                    xterm_true = col0.find(';38;2;')
-                    xterm = col0.find(';38;5;')
-                    if xterm_true != -1:
-                        col = col0[xterm_true + 6:-1].split(';')
-                        r = int(col[0])
-                        g = int(col[1])
-                        b = int(col[2])
-                        if (r < 0 or r > 255) or (g < 0 or g > 255) or (b < 0 or b > 255):
-                            raise ValueError("rgb out of range")
-                        col = tohex(r, g, b, 100.0)
-                    elif xterm != -1:
-                        col = col0[xterm + 6:-1].split(';')[0]
-                        col = xterm_to_hex.get(col)
-                        if not col:
-                            continue
-                    else:
-                        mode = xterm8_to_hex
-                        modes = (xterm8_to_hex, xterm8b_to_hex, xterm8f_to_hex)
-                        q = -1
-                        for m in (0, 1, 2):
-                            p = col0.find(';%s;' % m)
-                            if p != -1 and p > q:
-                                mode = modes[m]
-                        xterm8 = col0[1:-1].split(';')
-                        col = None
-                        for x in xterm8:
-                            if x in mode:
-                                col = mode[x]
-                        if not col:
-                            continue
-                else:
-                    if col0.startswith('0x'):
-                        col0 = '#' + col0[2:]
-                    else:
-                        col0 = all_names_to_hex.get(col0.lower(), col0.upper())
-                    if len(col0) == 4:
-                        col0 = '#' + col0[1] * 2 + col0[2] * 2 + col0[3] * 2 + 'FF'
-                    elif len(col0) == 7:
-                        col0 += 'FF'
-                    col = col0
-            elif col[1] and col[2]:
-                # In the form of rgb(255, 255, 255) or rgba(255, 255, 255, 1.0):
-                r = int(col[0])
-                g = int(col[1])
-                b = int(col[2])
-                if (r < 0 or r > 255) or (g < 0 or g > 255) or (b < 0 or b > 255):
-                    raise ValueError("rgb out of range")
-                if len(col) == 4:
-                    if col[3].endswith('%'):
-                        alpha = float(col[3][:-1])
-                    else:
-                        alpha = float(col[3]) * 100.0
-                    if alpha < 0 or alpha > 100:
-                        raise ValueError("alpha out of range")
-                else:
-                    alpha = 100.0
-                col = tohex(r, g, b, alpha)
+    def __init__(self, view, selection, pending):
+        self.view = view
+        self.change_count = view.change_count()
+        self.selection = selection
+        self.pending = pending
+        self.progressive = False
+        self.dirty = False  # lines come from text changes
+        self.lines = None  # None for the whole view
+        self.texts = None  # [(begin, text)]
+        self.spans = None  # lines as (begin, end), following text changes
+        self.bg_col = None
+        self.words = None  # {name: [Region]}
+        self.icons = {}
+        self.elapsed = 0
+        self.stats = {}  # timing (ms) of the phases gone through and counters, see stats.py
+
+
+def highlight_colors(view, selection=False, pending=False, **kwargs):
+    '''Highlights colors in the view right away (background highlighting
+       scans in the scanner thread instead, see queue_thread()).'''
+    job = snapshot_highlight(view, selection=selection, pending=pending)
+    if job is not None:
+        scan_highlight(job)
+        apply_highlight(job)
+
+
+def snapshot_highlight(view, selection=False, pending=False, **kwargs):
+    '''Decides what needs to be scanned and takes a snapshot of its text;
+       returns a HighlightJob, or None if there's nothing to do.'''
+    state = view_state(view)
+    if state is None:
+        return  # not registered, or closed already
+    start = time.time()
+    job = HighlightJob(view, selection, pending)
+
+    if pending:
+        # Next slice of a large file being highlighted progressively:
+        selected_lines = pop_pending_lines(view)
+        if not selected_lines:
+            return
+    else:
+        dirty_lines = pop_dirty_lines(view)
+        if dirty_lines is not None:
+            if selection and not dirty_lines:
+                return  # nothing changed
+            if len(dirty_lines) > 100:
+                selection = False
+        elif len(view.sel()) > 100:
+            selection = False
+
+        if selection:
+            if dirty_lines is not None:
+                selected_lines = dirty_lines
+                job.dirty = True
             else:
-                # In the form of rgba(white, 20%) or rgba(#FFFFFF, 0.4):
-                col0 = col[0]
-                col0 = all_names_to_hex.get(col0.lower(), col0.upper())
-                if col0.startswith('0X'):
-                    col0 = '#' + col0[2:]
-                if len(col0) == 4:
-                    col0 = '#' + col0[1] * 2 + col0[2] * 2 + col0[3] * 2 + 'FF'
-                elif len(col0) == 7:
-                    col0 += 'FF'
-                if len(col) == 4:
-                    col3 = col[3]
-                    if col3.endswith('%'):
-                        alpha = float(col3[:-1])
-                    else:
-                        alpha = float(col3) * 100.0
-                    if alpha < 0 or alpha > 100:
-                        raise ValueError("alpha out of range")
-                else:
-                    alpha = 100.0
-                col = tohex(col0, None, None, alpha)
-        except (ValueError, IndexError, KeyError) as e:
-            # print(e)
-            continue
+                selected_lines = merge_lines(ln for r in view.sel() for ln in view.lines(r))
+        elif is_large_view(view):
+            # Highlight what's visible now, and the rest of the file after:
+            selected_lines = view.lines(view.visible_region())
+            large_file_highlight = settings.get('large_file_highlight', 'progressive')
+            if large_file_highlight == 'lazy':
+                # Only what's been visible gets highlighted, a block of lines at a time:
+                state.coverage = 0
+                selected_lines = cover_visible_blocks(view)
+            elif large_file_highlight == 'progressive':
+                visible = selected_lines[0].cover(selected_lines[-1]) if selected_lines else sublime.Region(0, 0)
+                state.pending = [(visible.end() + 1, view.size()), (0, visible.begin())]
+                job.progressive = True
+        else:
+            selected_lines = None
+        job.selection = selection
+
+    if selected_lines:
+        job.lines = selected_lines
+        job.texts = [(line.begin(), view.substr(line)) for line in selected_lines]
+        job.spans = [(line.begin(), line.end()) for line in selected_lines]
+        state.inflight.append(job)
+    else:
+        job.texts = [(0, view.substr(sublime.Region(0, view.size())))]
+
+    if hasattr(view, 'style'):
+        job.bg_col = (view.style()['background'] + 'FF')[:9].upper()
+
+    job.elapsed = time.time() - start
+    job.stats['snapshot'] = job.elapsed * 1000
+    return job
+
+
+def scan_options():
+    '''Returns which kinds of color values to look for, as per the settings.'''
+    return dict(
+        named_values=bool(settings.get('named_values', True)),
+        x_hex_values=bool(settings.get('0x_hex_values', True)),
+        hex_values=bool(settings.get('hex_values', True)),
+        xterm_color_values=bool(settings.get('xterm_color_values', True)),
+        rgb_values=bool(settings.get('rgb_values', True)),
+        hsv_values=bool(settings.get('hsv_values', True)),
+        hsl_values=bool(settings.get('hsl_values', True)),
+        hwb_values=bool(settings.get('hwb_values', True)),
+        lab_values=bool(settings.get('lab_values', True)),
+        lch_values=bool(settings.get('lch_values', True)),
+    )
+
+
+def scan_texts(texts, options):
+    '''Finds the colors in the [(begin, text)] of a snapshot, returning their
+       (begin, end) spans, their normalized colors and the stats of the scan
+       (timing of the match and normalize phases, bytes scanned, matches and
+       rejected matches by format).'''
+    start = time.time()
+    colors_re, colors_re_capture = re_factory(**options)
+    prefilter_re = prefilter_factory(**options)
+    spans = []
+    found = []
+    for begin, text in texts:
+        text_spans, text_found = find_colors(text, colors_re, colors_re_capture, prefilter_re, options['named_values'])
+        spans.extend((begin + a, begin + b) for a, b in text_spans)
+        found.extend(text_found)
+    matched = time.time()
+    colors = normalized_colors(found)
+    normalized = time.time()
+
+    rejected = {}
+    for capture, col in zip(found, colors):
+        if not col:
+            fmt = capture_format(capture)
+            rejected[fmt] = rejected.get(fmt, 0) + 1
+    stats = {
+        'match': (matched - start) * 1000,
+        'normalize': (normalized - matched) * 1000,
+        'bytes': sum(len(text) for begin, text in texts),
+        'matches': len(found),
+        'rejected': sum(rejected.values()),
+        'rejected_formats': rejected,
+    }
+    return spans, colors, stats
+
+
+def scan_highlight(job):
+    '''Finds the colors in a job's snapshot, making sure the color scheme and
+       gutter icons for them exist. Doesn't touch the view's regions, so it
+       can run in the scanner thread.'''
+    with __scan_lock_:
+        start = time.time()
+        colorizer.setup_color_scheme(job.view.settings())
+
+        spans, colors, stats = scan_texts(job.texts, scan_options())
+        job.stats.update(stats)
+        mark = time.time()
+
+        words = {}
 
         # Fix case when color it's the same as background color:
-        if hasattr(view, 'style'):
-            bg_col = (view.style()['background'] + 'FF')[:9].upper()
+        bg_col = job.bg_col
+        if bg_col:
+            br = int(bg_col[1:3], 16)
+            bg = int(bg_col[3:5], 16)
+            bb = int(bg_col[5:7], 16)
+            ba = int(bg_col[7:9], 16)
+            br += -1 if br > 1 else 1
+            bg += -1 if bg > 1 else 1
+            bb += -1 if bb > 1 else 1
+            fixed_bg_col = '#%02X%02X%02X%02X' % (br, bg, bb, ba)
+
+        for (a, b), col in zip(spans, colors):
+            if not col:
+                continue
+
             if col == bg_col:
-                br = int(bg_col[1:3], 16)
-                bg = int(bg_col[3:5], 16)
-                bb = int(bg_col[5:7], 16)
-                ba = int(bg_col[7:9], 16)
-                br += -1 if br > 1 else 1
-                bg += -1 if bg > 1 else 1
-                bb += -1 if bb > 1 else 1
-                col = '#%02X%02X%02X%02X' % (br, bg, bb, ba)
-
-        name = colorizer.add_color(col)
-        if name not in words:
-            words[name] = [ranges[i]]
-        else:
-            words[name].append(ranges[i])
+                col = fixed_bg_col
+
+            name = colorizer.add_color(col)
+            if name not in words:
+                words[name] = [sublime.Region(a, b)]
+            else:
+                words[name].append(sublime.Region(a, b))
+        for name in words:
+            recent_colors.put(name, True)
+        now = time.time()
+        job.stats['names'] = (now - mark) * 1000
+        mark = now
+
+        colorizer.update(job.view)
+        now = time.time()
+        job.stats['update'] = (now - mark) * 1000
+        mark = now
+
+        gutter_icon = settings.get('gutter_icon', True)
+        if gutter_icon:
+            job.icons = dict((name, toicon(name, gutter_icon=gutter_icon)) for name in words)
+            job.stats['icons'] = (time.time() - mark) * 1000
+
+        job.words = words
+        job.elapsed += time.time() - start
+
+
+def apply_highlight(job):
+    '''Adds the regions for what a job found to its view; results for text
+       that changed since the snapshot was taken are dropped.'''
+    view = job.view
+    state = VIEWS.get(view.id())
+    if state is None:
+        return  # the view was closed
+    start = time.time()
+
+    if job in state.inflight:
+        state.inflight.remove(job)
+
+    if view.change_count() != job.change_count:
+        retry_highlight(job)
+        return
+    if job.words is None:
+        return  # scanning failed
 
-    colorizer.update(view)
+    words = job.words
+    selected_lines = job.lines
+    erased = 0.0
 
+    found_ranges = sorted((r.begin(), r.end(), name) for name, w in words.items() for r in w)
     if selected_lines:
-        if vid not in COLOR_HIGHLIGHTS:
-            COLOR_HIGHLIGHTS[vid] = set()
-        for name in COLOR_HIGHLIGHTS[vid]:
+        # Replace the ranges on the selected lines in the index, and re-add
+        # every color with ranges found or removed there:
+        index = region_index(view)
+        found_starts = [s for s, e, name in found_ranges]
+        affected = set(words)
+        for line in selected_lines:
+            lo = bisect_left(found_starts, line.begin())
+            hi = bisect_right(found_starts, line.end(), lo)
+            affected.update(index.replace(line.begin(), line.end(), found_ranges[lo:hi]))
+        line_starts = [line.begin() for line in selected_lines]
+        for name in affected:
             ranges = []
-            affected_line = False
             for _range in view.get_regions(name):
-                _line_range = False
-                for _line in selected_lines:
-                    if _line.contains(_range):
-                        _line_range = True
-                        break
-                if _line_range:
-                    affected_line = True
-                else:
+                i = bisect_right(line_starts, _range.begin()) - 1
+                if i < 0 or not selected_lines[i].contains(_range):
                     ranges.append(_range)
-            if affected_line or name in words:
-                if name not in words:
-                    words[name] = ranges
-                else:
-                    words[name].extend(ranges)
+            if name not in words:
+                words[name] = ranges
+            else:
+                words[name].extend(ranges)
     else:
+        mark = time.time()
         erase_highlight_colors(view)
-    all_regs = COLOR_HIGHLIGHTS[vid]
+        erased = time.time() - mark
+        state.index = RegionIndex()
+        state.index.reset(found_ranges)
+    state.change_count = view.change_count()
+    all_regs = state.regions
 
     highlight_values = bool(settings.get('highlight_values', True))
     gutter_icon = settings.get('gutter_icon', True)
 
+    regions = 0
     for name, w in words.items():
+        if not w:
+            view.erase_regions(name)
+            view.erase_regions(name + '_icon')
+            all_regs.discard(name)
+            continue
         if highlight_values:
             view.add_regions(name, w, name, flags=sublime.PERSISTENT)
         if gutter_icon:
+            icon = job.icons.get(name) or toicon(name, gutter_icon=gutter_icon)
             wi = [sublime.Region(i, i) for i in set(view.line(r).a for r in w)]
-            view.add_regions(name + '_icon', wi, '%sgutter' % colorizer.prefix, icon=toicon(name, gutter_icon=gutter_icon), flags=sublime.PERSISTENT)
+            view.add_regions(name + '_icon', wi, '%sgutter' % colorizer.prefix, icon=icon or '', flags=sublime.PERSISTENT)
+            if not icon:  # still being written, see icons_written()
+                ICON_WAITERS.setdefault(icon_file(name, gutter_icon), []).append((view, name))
         all_regs.add(name)
+        regions += len(w)
 
-    if not selection:
-        TIMES[vid] = (time.time() - start) * 1000  # Keep how long it took to do a full color highlight
-        # print('highlight took %s' % TIMES[vid])
+    now = time.time()
+    elapsed = job.elapsed + now - start
+    stats = job.stats
+    stats['erase'] = erased * 1000
+    stats['apply'] = (now - start - erased) * 1000
+    stats['regions'] = regions
+    stats['total'] = elapsed * 1000
+    stats['kind'] = 'pending' if job.pending else 'selection' if job.selection else 'full'
+    stats['view'] = view.id()
+    state.stats.add(stats)
+    STATS.add(stats)
+    if job.pending:
+        # Size the next slices so each one takes about the time budget:
+        scanned = sum(line.size() + 1 for line in selected_lines)
+        rows = sum(view.rowcol(line.end())[0] - view.rowcol(line.begin())[0] + 1 for line in selected_lines)
+        state.debounce.scanned(elapsed * 1000, scanned, rows, full=False)
+        budget = settings.get('progressive_time_budget', 20) / 1000.0
+        if elapsed > 0:
+            state.slice_size = max(MIN_SLICE_SIZE, min(MAX_SLICE_SIZE, int(scanned * budget / elapsed)))
+    elif not job.selection:
+        state.time = elapsed * 1000  # Keep how long it took to do a full color highlight
+        if not selected_lines:
+            state.debounce.scanned(state.time, view.size(), view.rowcol(view.size())[0] + 1)
+
+    if job.pending or job.progressive:
+        if state.pending:
+            queue_highlight_colors(view, delay=PROGRESSIVE_DELAY, pending=True)
+        else:
+            state.pending = None
 
 
-################################################################################
-# Queue connection
+def retry_highlight(job):
+    '''Puts back what a job with stale results was to scan, and queues it to
+       be scanned again.'''
+    view = job.view
+    state = VIEWS.get(view.id())
+    if state is None:
+        return
+    if job.pending:
+        if state.pending is not None:
+            state.pending[:0] = job.spans
+            queue_highlight_colors(view, delay=PROGRESSIVE_DELAY, pending=True)
+    elif job.dirty:
+        if state.dirty is not None:
+            state.dirty.extend(job.spans)
+            queue_highlight_colors(view, selection=True)
+    else:
+        queue_highlight_colors(view, selection=job.selection)
+
 
-QUEUE = {}  # views waiting to be processed by Color Highlight
+################################################################################
+# Color scheme compaction
+
+COMPACT_DELAY = 10000  # ms without views closing before compacting the color scheme
+COMPACT_MIN_DEAD = 500  # Rules of unused colors there must be to compact the color scheme on its own
+
+# Colors (by region name) found lately, whose rules are kept in the color
+# scheme even if no view uses them anymore:
+recent_colors = LRUCache(1000)
+
+
+def color_references():
+    '''Returns the number of open views using each color (by region name).'''
+    references = {}
+    for state in list(VIEWS.values()):
+        for name in list(state.regions):
+            references[name] = references.get(name, 0) + 1
+    return references
+
+
+def compact_colors(force=False):
+    '''Drops the rules of colors neither used by an open view nor found
+       lately from the color scheme, if there are COMPACT_MIN_DEAD of them
+       (or any, if forced), and reports the effect.'''
+    with __scan_lock_:  # so no colors are found meanwhile
+        keep = set(color_references())
+        keep.update(recent_colors.data)
+        report = colorizer.compact(keep, 0 if force else COMPACT_MIN_DEAD)
+    if report is None:
+        message = '%s: no unused colors in the color scheme' % NAME
+    else:
+        message = '%s: color scheme compacted from %d to %d rules, %d to %d KB, parsed in %s to %s ms' % (
+            NAME,
+            report['rules_before'], report['rules_after'],
+            report['size_before'] // 1024, report['size_after'] // 1024,
+            '%.1f' % report['parse_before'] if report['parse_before'] is not None else '?',
+            '%.1f' % report['parse_after'] if report['parse_after'] is not None else '?',
+        )
+    if report is not None or force:
+        print(message)
+        sublime.set_timeout(partial(sublime.status_message, message), 0)
+    return report
+
+
+def queue_compact_colors(force=False):
+    '''Compacts the color scheme in a thread of its own, right away if forced
+       or otherwise once views stop closing for a while.'''
+    def start():
+        threading.Thread(target=compact_colors, args=(force,), name='color highlight compaction').start()
+    if force:
+        start()
+    else:
+        scheduler.schedule((None, 'compact'), start, COMPACT_DELAY, priority=BACKGROUND)
 
-# For snappier color highlighting, different delays are used for different color highlighting times:
-# (color_highlighting_time, (delay, delay_when_busy))
-DELAYS = (
-    (50, (50, 100)),
-    (100, (100, 300)),
-    (200, (200, 500)),
-    (400, (400, 1000)),
-    (600, (600, 1500)),
-    (800, (800, 2000)),
-    (1200, (1200, 1000)),
-    (1600, (1600, 3000)),
-)
 
+################################################################################
+# Gutter icon cache eviction
 
-def get_delay(t, view):
-    delays = 0
+EVICT_ICONS_DELAY = 30000  # ms without icons being written or views closing before evicting icons
 
-    for _t, d in DELAYS:
-        if _t <= t:
-            delays = d
-        else:
-            break
 
-    delays = delays or DELAYS[0][1]
+def evict_icons(force=False):
+    '''Deletes the least recently used icons from the cache while it holds
+       more than icon_cache_size icons or icon_cache_bytes bytes, never those
+       of colors used by an open view or found lately; then saves the cache
+       manifest, and reports the effect (always, if forced).'''
+    base_path = os.path.join(sublime.packages_path(), 'User', '%s.cache' % NAME)
+    max_count = settings.get('icon_cache_size', 5000)
+    max_bytes = settings.get('icon_cache_bytes', 4194304)
+    stat_icons(base_path, icon_index(base_path))
+    with __scan_lock_:  # so no icons are looked up meanwhile
+        icons = icon_index(base_path)
+        keep = set(color_references())
+        keep.update(recent_colors.data)
+        count = count_before = len(icons)
+        size = size_before = sum(ICON_SIZES.get(fn, 0) for fn in list(icons))
+        if count > max_count or size > max_bytes:
+            for used, fn in sorted((ICON_USES.get(fn, 0), fn) for fn in list(icons) if fn.rpartition('_')[0] not in keep):
+                if count <= max_count and size <= max_bytes:
+                    break
+                icons.pop(fn, None)
+                ICON_USES.pop(fn, None)
+                try:
+                    os.remove(os.path.join(base_path, fn))
+                except OSError:
+                    pass
+                count -= 1
+                size -= ICON_SIZES.pop(fn, 0)
+        try:
+            write_icon_manifest(base_path)
+        except (IOError, OSError):
+            traceback.print_exc()
+    if count != count_before or force:
+        message = '%s: gutter icon cache trimmed from %d to %d icons, %d to %d KB' % (
+            NAME, count_before, count, size_before // 1024, size // 1024)
+        print(message)
+        sublime.set_timeout(partial(sublime.status_message, message), 0)
+    return count_before - count
+
+
+def queue_evict_icons(force=False):
+    '''Evicts icons from the cache in a thread of its own, right away if
+       forced or otherwise once idle for a while.'''
+    def start():
+        threading.Thread(target=evict_icons, args=(force,), name='color highlight icon eviction').start()
+    if force:
+        start()
+    else:
+        scheduler.schedule((None, 'evict-icons'), start, EVICT_ICONS_DELAY, priority=BACKGROUND)
 
-    # If the user specifies a delay greater than the built in delay,
-    # figure they only want to see marks when idle.
-    min_delay = int(settings.get('delay', 0) * 1000)
 
-    return (min_delay, min_delay) if min_delay > delays[1] else delays
+################################################################################
+# Queue connection
 
 
 def _update_view(view, filename, **kwargs):
-    # It is possible that by the time the queue is run,
+    # It is possible that by the time the scheduler runs it,
     # the original file is no longer being displayed in the view,
     # or the view may be gone. This happens especially when
     # viewing files temporarily by single-clicking on a filename
     # in the sidebar or when selecting a file through the choose file palette.
-    valid_view = False
-    view_id = view.id()
+    if view.id() not in VIEWS or view.is_loading() or (view.file_name() or '').encode('utf-8') != filename:
+        return
 
-    for window in sublime.windows():
-        for v in window.views():
-            if v.id() == view_id:
-                valid_view = True
-                break
+    # Only the snapshot is taken here, scanning it is left to the scanner thread:
+    job = snapshot_highlight(view, **kwargs)
+    if job is not None:
+        __scan_queue_.put(job)
 
-    if not valid_view or view.is_loading() or (view.file_name() or '').encode('utf-8') != filename:
-        return
 
-    highlight_colors(view, **kwargs)
+def view_priority(view):
+    '''Returns how urgent highlighting the view is: the active view first,
+       then views visible in other groups or windows, then background tabs.'''
+    window = view.window()
+    if window is None:
+        return BACKGROUND
+    active_window = sublime.active_window()
+    if active_window is not None and window.id() == active_window.id() and view == window.active_view():
+        return ACTIVE
+    for group in range(window.num_groups()):
+        if view == window.active_view_in_group(group):
+            return VISIBLE
+    return BACKGROUND
 
 
 def queue_highlight_colors(view, delay=-1, preemptive=False, **kwargs):
     '''Put the current view in a queue to be examined by a Color Highlight'''
+    if view.id() not in VIEWS:
+        return
 
     if preemptive:
         delay = delay_when_busy = 0
     elif delay == -1:
-        delay, delay_when_busy = get_delay(TIMES.get(view.id(), 100), view)
+        delay, delay_when_busy = choose_debounce(view, selection=kwargs.get('selection'))
     else:
         delay_when_busy = delay
 
-    kwargs.update({'delay': delay, 'delay_when_busy': delay_when_busy, 'preemptive': preemptive})
-    queue(view, partial(_update_view, view, (view.file_name() or '').encode('utf-8'), **kwargs), kwargs)
-
+    if kwargs.get('pending'):
+        kind = 'pending'
+    elif kwargs.get('selection'):
+        kind = 'selection'
+    else:
+        kind = 'full'
+        scheduler.cancel((view.id(), 'selection'))  # covered by the full pass
+
+    scheduler.schedule(
+        (view.id(), kind),
+        partial(_update_view, view, (view.file_name() or '').encode('utf-8'), **kwargs),
+        delay,
+        delay_when_busy,
+        priority=view_priority(view),
+        change_count=view.change_count,
+    )
 
-def _callback(view, filename, kwargs):
-    kwargs['callback'](view, filename, **kwargs)
 
+def cancel_highlight_colors(view):
+    '''Drops any highlighting queued for the view'''
+    vid = view.id()
+    for kind in ('full', 'selection', 'pending'):
+        scheduler.cancel((vid, kind))
 
-def background_color_highlight():
-    __lock_.acquire()
 
-    try:
-        callbacks = list(QUEUE.values())
-        QUEUE.clear()
-    finally:
-        __lock_.release()
-
-    for callback in callbacks:
-        sublime.set_timeout(callback, 0)
+def scan_loop(scan_queue):
+    '''Scans the snapshots taken by the UI thread as they come, in a background
+       thread, posting the results back to the UI thread to be applied.'''
+    while True:
+        job = scan_queue.get()
+        if job is None:
+            break
+        if job.view.change_count() == job.change_count:  # otherwise it's stale already
+            try:
+                scan_highlight(job)
+            except Exception:
+                traceback.print_exc()
+        sublime.set_timeout(partial(apply_highlight, job), 0)
 
 
 ################################################################################
-# Queue dispatcher system:
-
-queue_dispatcher = background_color_highlight
-queue_thread_name = 'background color highlight'
-MAX_DELAY = 10
-
-
-def queue_loop():
-    '''An infinite loop running the color highlight in a background thread meant to
-       update the view after user modifies it and then does no further
-       modifications for some time as to not slow down the UI with color highlighting.'''
-    global __signaled_, __signaled_first_
-
-    while __loop_:
-        # print('acquire...')
-        __semaphore_.acquire()
-        __signaled_first_ = 0
-        __signaled_ = 0
-        # print('DISPATCHING!', len(QUEUE))
-        queue_dispatcher()
-
-
-def queue(view, callback, kwargs):
-    global __signaled_, __signaled_first_
-    now = time.time()
-    __lock_.acquire()
-
-    try:
-        QUEUE[view.id()] = callback
-        delay = kwargs['delay']
+# Scanner thread:
 
-        if now < __signaled_ + delay * 4:
-            delay = kwargs['delay_when_busy']
-
-        __signaled_ = now
-        _delay_queue(delay, kwargs['preemptive'])
-
-        # print('%s queued in %s' % ('' if __signaled_first_ else 'first ', __signaled_ - now))
-        if not __signaled_first_:
-            __signaled_first_ = __signaled_
-    finally:
-        __lock_.release()
-
-
-def _delay_queue(delay, preemptive):
-    global __signaled_, __queued_
-    now = time.time()
-
-    if not preemptive and now <= __queued_ + 0.01:
-        return  # never delay queues too fast (except preemptively)
-
-    __queued_ = now
-    _delay = float(delay) / 1000
-
-    if __signaled_first_:
-        if MAX_DELAY > 0 and now - __signaled_first_ + _delay > MAX_DELAY:
-            _delay -= now - __signaled_first_
-            if _delay < 0:
-                _delay = 0
-            delay = int(round(_delay * 1000, 0))
-
-    new__signaled_ = now + _delay - 0.01
-
-    if __signaled_ >= now - 0.01 and (preemptive or new__signaled_ >= __signaled_ - 0.01):
-        __signaled_ = new__signaled_
-        # print('delayed to %s' % (preemptive, __signaled_ - now))
-
-        def _signal():
-            if time.time() < __signaled_:
-                return
-            __semaphore_.release()
-
-        sublime.set_timeout(_signal, delay)
-
-
-def delay_queue(delay):
-    __lock_.acquire()
-    try:
-        _delay_queue(delay, False)
-    finally:
-        __lock_.release()
+scan_thread_name = 'color highlight scanner'
+icon_thread_name = 'color highlight icon writer'
+queue_thread_name = 'background color highlight'  # before the scheduler
 
+scheduler = Scheduler(sublime.set_timeout)
 
 # only start the thread once - otherwise the plugin will get laggy
 # when saving it often.
-__semaphore_ = threading.Semaphore(0)
-__lock_ = threading.Lock()
-__queued_ = 0
-__signaled_ = 0
-__signaled_first_ = 0
+__scan_queue_ = Queue()
+__icon_queue_ = Queue()
+__scan_lock_ = threading.Lock()
 
 # First finalize old standing threads:
 __loop_ = False
 __pre_initialized_ = False
+__watching_ = False
 
 
 def queue_finalize(timeout=None):
     global __pre_initialized_
 
     for thread in threading.enumerate():
-        if thread.isAlive() and thread.name == queue_thread_name:
+        if thread.is_alive() and thread.name == queue_thread_name:
             __pre_initialized_ = True
             thread.__semaphore_.release()
             thread.join(timeout)
+        elif thread.is_alive() and thread.name == scan_thread_name:
+            __pre_initialized_ = True
+            thread.__scan_queue_.put(None)
+            thread.join(timeout)
+        elif thread.is_alive() and thread.name == icon_thread_name:
+            thread.__icon_queue_.put(None)
+            thread.join(timeout)
 
 
 queue_finalize()
 
 # Initialize background thread:
-__loop_ = True
-__active_color_highlight_thread = threading.Thread(target=queue_loop, name=queue_thread_name)
-__active_color_highlight_thread.__semaphore_ = __semaphore_
-__active_color_highlight_thread.start()
+__active_scan_thread = threading.Thread(target=scan_loop, args=(__scan_queue_,), name=scan_thread_name)
+__active_scan_thread.__scan_queue_ = __scan_queue_
+__active_scan_thread.start()
+__active_icon_thread = threading.Thread(target=icon_loop, args=(__icon_queue_,), name=icon_thread_name)
+__active_icon_thread.__icon_queue_ = __icon_queue_
+__active_icon_thread.start()
 
 
 ################################################################################
 # Initialize settings and main objects only once
 class ColorHighlightSettings(Settings):
     def on_update(self):
+        color_cache.resize(self.get('color_cache_size', 4096))
+        recent_colors.resize(self.get('color_scheme_reserve', 1000))
         window = sublime.active_window()
         view = window.active_view()
         view.run_command('color_highlight', dict(action='reset'))
@@ -1154,7 +2098,27 @@ if 'colorizer' not in globals():
 ################################################################################
 
 def plugin_loaded():
+    global __watching_
     settings.load()
+    for window in sublime.windows():
+        for view in window.views():
+            register_view(view)
+    __watching_ = True
+    watch_viewport()
+    if settings.get('gutter_icon', True) and settings.get('pregenerate_icons', True):
+        pregenerate_icons()
+
+
+def plugin_unloaded():
+    global __watching_
+    __watching_ = False
+    colorizer.flush()
+    cancel_icons()
+    if ICONS is not None:
+        try:
+            write_icon_manifest(os.path.join(sublime.packages_path(), 'User', '%s.cache' % NAME))
+        except (IOError, OSError):
+            traceback.print_exc()
 
 
 # ST3 features a plugin_loaded hook which is called when ST's API is ready.
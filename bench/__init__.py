@@ -0,0 +1,7 @@
+"""
+Headless micro-benchmarks for Color Highlight.
+
+The plugin is imported against the stand-in ``sublime``/``sublime_plugin``
+modules in this package, so its hot paths can be timed outside the editor.
+See ``python -m bench --help``.
+"""
@@ -0,0 +1,138 @@
+"""
+Run the Color Highlight micro-benchmarks.
+
+    python -m bench [--filter REGEX] [--repeat N] [--scale X] [--output FILE]
+
+Results are printed as a table on stderr and written as JSON to ``--output``
+(or to stdout when it is ``-``), so successive runs can be diffed.
+"""
+from __future__ import absolute_import, print_function
+
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+
+from .harness import load_plugin, shutdown
+from .benchmarks import BENCHMARKS
+
+
+def cache_delta(before, after):
+    """The lookups a cache got between two of its stats()."""
+    delta = dict((key, after[key] - before[key]) for key in ('hits', 'misses', 'evictions'))
+    lookups = delta['hits'] + delta['misses']
+    delta['hit_rate'] = float(delta['hits']) / lookups if lookups else 0.0
+    delta['size'] = after['size']
+    delta['maxsize'] = after['maxsize']
+    return delta
+
+
+def measure(spec, scale, repeat):
+    color_cache = load_plugin().color_cache
+    cache_before = color_cache.stats()
+    run = spec['setup'](scale)
+    number = spec['number']
+    samples = []
+    try:
+        for _ in range(repeat):
+            before = getattr(run, 'before_repeat', None)
+            if before:
+                before()
+            prepare = getattr(run, 'prepare', None)
+            if prepare:
+                # Untimed work needed before every call (e.g. editing the view):
+                elapsed = 0
+                for _ in range(number):
+                    prepare()
+                    start = time.perf_counter()
+                    run()
+                    elapsed += time.perf_counter() - start
+            else:
+                start = time.perf_counter()
+                for _ in range(number):
+                    run()
+                elapsed = time.perf_counter() - start
+            samples.append(elapsed / number)
+    finally:
+        cleanup = getattr(run, 'cleanup', None)
+        if cleanup:
+            cleanup()
+    samples.sort()
+    mean = sum(samples) / len(samples)
+    result = {
+        'name': spec['name'],
+        'group': spec['group'],
+        'repeat': repeat,
+        'number': number,
+        'min': samples[0],
+        'median': samples[len(samples) // 2],
+        'mean': mean,
+        'max': samples[-1],
+        'stdev': (sum((s - mean) ** 2 for s in samples) / len(samples)) ** 0.5,
+    }
+    if getattr(run, 'bytes', None):
+        result['bytes'] = run.bytes
+        result['mb_per_s'] = run.bytes / result['median'] / 1e6 if result['median'] else None
+    if getattr(run, 'items', None):
+        result['items'] = run.items
+        result['us_per_item'] = result['median'] / run.items * 1e6
+    cache = cache_delta(cache_before, color_cache.stats())
+    if cache['hits'] or cache['misses']:
+        result['color_cache'] = cache
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--filter', '-k', default='', help="only run benchmarks whose name matches this regex")
+    parser.add_argument('--repeat', '-r', type=int, default=5, help="samples per benchmark (default: 5)")
+    parser.add_argument('--scale', '-s', type=float, default=1.0, help="corpus/batch size multiplier (default: 1.0)")
+    parser.add_argument('--output', '-o', default='-', help="JSON results file, '-' for stdout (default)")
+    parser.add_argument('--list', action='store_true', help="list benchmark names and exit")
+    args = parser.parse_args(argv)
+
+    selected = [spec for name, spec in BENCHMARKS.items() if re.search(args.filter, name)]
+    if args.list:
+        for spec in selected:
+            print(spec['name'])
+        return 0
+
+    module = load_plugin()
+    results = []
+    try:
+        for spec in selected:
+            result = measure(spec, args.scale, args.repeat)
+            results.append(result)
+            extra = ''
+            if 'mb_per_s' in result:
+                extra = '%8.2f MB/s' % result['mb_per_s']
+            elif 'us_per_item' in result:
+                extra = '%8.2f us/item' % result['us_per_item']
+            print('%-50s %10.3f ms %s' % (spec['name'], result['median'] * 1000, extra), file=sys.stderr)
+        color_cache = module.color_cache.stats()
+    finally:
+        shutdown()
+
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'results': results,
+        'color_cache': color_cache,
+    }
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(data)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
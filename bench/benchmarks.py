@@ -0,0 +1,378 @@
+"""
+Benchmark definitions.
+
+Each benchmark is a function decorated with ``@benchmark`` that receives the
+run ``scale`` and returns the callable to time; any setup happens before the
+return. ``bytes`` or ``items`` may be set as attributes on the returned
+callable so throughput can be reported, and ``prepare`` for untimed work
+needed before every call.
+"""
+from __future__ import absolute_import
+
+import sys
+import random
+from collections import OrderedDict
+
+from . import sublime
+from . import corpora
+from .harness import load_plugin, new_view, close_view, reset_colorizer, write_scheme, SCHEME_PATH, TMTHEME_PATH
+
+BENCHMARKS = OrderedDict()
+
+# Corpus sizes (bytes) at scale 1.0; full-file sizes stay under the plugin's
+# 512000 bytes cutoff so the full-file path is the one measured.
+FULL_SIZE = 200000
+LARGE_SIZE = 2000000
+
+
+def benchmark(name, group, number=1):
+    def decorator(func):
+        BENCHMARKS[name] = {'name': name, 'group': group, 'number': number, 'setup': func}
+        return func
+    return decorator
+
+
+# Regular expressions
+
+@benchmark('regex_factory', 'regex', number=20)
+def bench_regex_factory(scale):
+    module = load_plugin()
+    key = module.scan_options()
+
+    def run():
+        module.regex_cache.clear()
+        module.regex_factory(**key)
+    return run
+
+
+@benchmark('re_factory', 'regex', number=5)
+def bench_re_factory(scale):
+    import re
+    module = load_plugin()
+    key = module.scan_options()
+
+    def run():
+        module.regex_cache.clear()
+        module.re_cache.clear()
+        re.purge()
+        module.re_factory(**key)
+    return run
+
+
+# highlight_colors
+
+def _full_file(corpus, size):
+    def setup(scale):
+        module = load_plugin()
+        text = corpora.GENERATORS[corpus](int(size * scale))
+        view = new_view(text)
+        module.highlight_colors(view)  # warm scheme, icons and caches
+
+        def run():
+            module.highlight_colors(view)
+        run.bytes = len(text)
+        return run
+    return setup
+
+
+for _corpus in ('css', 'design_tokens', 'ansi_log', 'minified_bundle', 'source_code'):
+    benchmark('highlight_colors.full.%s' % _corpus, 'highlight_colors')(_full_file(_corpus, FULL_SIZE))
+
+
+@benchmark('highlight_colors.full.distinct_colors.cold', 'highlight_colors')
+def bench_distinct_colors_cold(scale):
+    module = load_plugin()
+    text = corpora.distinct_colors(int(2000 * scale))
+    view = new_view(text)
+
+    def run():
+        reset_colorizer()
+        module.highlight_colors(view)
+    run.bytes = len(text)
+    return run
+
+
+@benchmark('highlight_colors.large.css', 'highlight_colors')
+def bench_large_css(scale):
+    module = load_plugin()
+    module.settings.set('blocking_time_budget', 0)  # always highlighted as a large file
+    text = corpora.css(int(LARGE_SIZE * scale))
+    view = new_view(text)
+    view.set_viewport_lines(len(text.splitlines()) // 2, 80)
+    module.highlight_colors(view)
+
+    def run():
+        module.highlight_colors(view)
+    run.bytes = view.visible_region().size()
+    return run
+
+
+@benchmark('highlight_colors.progressive.css', 'highlight_colors')
+def bench_progressive_css(scale):
+    module = load_plugin()
+    module.settings.set('blocking_time_budget', 0)  # always highlighted as a large file
+    text = corpora.css(int(LARGE_SIZE * scale))
+    view = new_view(text)
+    view.set_viewport_lines(len(text.splitlines()) // 2, 80)
+    module.highlight_colors(view)
+
+    def run():
+        # The visible lines, then every slice the background queue would run:
+        module.highlight_colors(view)
+        while module.VIEWS[view.id()].pending:
+            module.highlight_colors(view, pending=True)
+    run.bytes = len(text)
+    return run
+
+
+@benchmark('highlight_colors.lazy.scroll.css', 'highlight_colors', number=10)
+def bench_lazy_scroll_css(scale):
+    module = load_plugin()
+    previous = module.settings.get('large_file_highlight')
+    module.settings.set('large_file_highlight', 'lazy')
+    module.settings.set('blocking_time_budget', 0)  # always highlighted as a large file
+    text = corpora.css(int(LARGE_SIZE * scale))
+    view = new_view(text)
+    rows = len(text.splitlines())
+    module.highlight_colors(view)
+    rng = random.Random(9)
+
+    def scroll():
+        view.set_viewport_lines(rng.randrange(rows), 80)
+
+    def run():
+        # What the viewport watcher and the slices it queues do:
+        module.watch_viewport()
+        while module.VIEWS[view.id()].pending:
+            module.highlight_colors(view, pending=True)
+
+    def cleanup():
+        module.settings.set('large_file_highlight', previous)
+        close_view(view)
+    run.prepare = scroll
+    run.cleanup = cleanup
+    return run
+
+
+def _activated(serial):
+    def setup(scale):
+        import time
+        module = load_plugin()
+        views = [new_view(corpora.css(int(FULL_SIZE / 4 * scale)), file_name='bench%d.css' % i) for i in range(16)]
+        for view in views:
+            module.highlight_colors(view)  # warm scheme, icons and caches
+
+        def run():
+            # A restored session: every view activated at once.
+            for view in views:
+                module.VIEWS[view.id()].time = None
+            if serial:
+                for view in views:
+                    module.highlight_colors(view)
+                return
+            for view in views:
+                module.queue_highlight_colors(view, preemptive=True)
+            while any(module.VIEWS[view.id()].time is None for view in views):
+                time.sleep(0.001)
+                sublime.run_timeouts(sublime._clock[0])
+
+        def cleanup():
+            for view in views:
+                close_view(view)
+        run.bytes = sum(view.size() for view in views)
+        run.cleanup = cleanup
+        return run
+    return setup
+
+
+benchmark('highlight_colors.activated.serial.css.16', 'highlight_colors')(_activated(True))
+benchmark('highlight_colors.activated.queued.css.16', 'highlight_colors')(_activated(False))
+
+
+def _selection(corpus, cursors):
+    def setup(scale):
+        module = load_plugin()
+        text = corpora.GENERATORS[corpus](int(FULL_SIZE * scale))
+        view = new_view(text)
+        module.highlight_colors(view)
+        lines = view.lines(sublime.Region(0, view.size()))
+        step = max(1, len(lines) // cursors)
+        view.sel().clear()
+        for line in lines[::step][:cursors]:
+            view.sel().add(sublime.Region(line.begin()))
+
+        def run():
+            module.highlight_colors(view, selection=True)
+        run.bytes = sum(line.size() for line in lines[::step][:cursors])
+        return run
+    return setup
+
+
+benchmark('highlight_colors.selection.css.1', 'highlight_colors', number=20)(_selection('css', 1))
+benchmark('highlight_colors.selection.css.50', 'highlight_colors', number=5)(_selection('css', 50))
+benchmark('highlight_colors.selection.design_tokens.50', 'highlight_colors', number=5)(_selection('design_tokens', 50))
+
+
+@benchmark('highlight_colors.incremental.css.10', 'highlight_colors', number=5)
+def bench_incremental(scale):
+    module = load_plugin()
+    text = corpora.css(int(FULL_SIZE * scale))
+    view = new_view(text)
+    module.highlight_colors(view)
+    view.sel().clear()
+    view.sel().add(sublime.Region(0))
+    rng = random.Random(8)
+
+    def edit():
+        # Edits away from the cursor, as done by macros or plugins:
+        for _ in range(10):
+            pt = rng.randrange(view.size())
+            view.replace(None, sublime.Region(pt, pt + 1), 'rgb(1, 2, 3)')
+
+    def run():
+        module.highlight_colors(view, selection=True)
+    run.prepare = edit
+    return run
+
+
+# Converters
+
+def _converter(name, make_args):
+    def setup(scale):
+        module = load_plugin()
+        func = getattr(module, name)
+        rng = random.Random(7)
+        args = [make_args(rng) for _ in range(int(10000 * scale))]
+
+        def run():
+            for a in args:
+                func(*a)
+        run.items = len(args)
+        return run
+    return setup
+
+
+_CONVERTERS = (
+    ('hsv_to_rgb', lambda rng: (rng.uniform(0, 360), rng.uniform(0, 100), rng.uniform(0, 100))),
+    ('hsl_to_rgb', lambda rng: (rng.uniform(0, 360), rng.uniform(0, 100), rng.uniform(0, 100))),
+    ('hwb_to_rgb', lambda rng: (rng.uniform(0, 360), rng.uniform(0, 50), rng.uniform(0, 50))),
+    ('lab_to_rgb', lambda rng: (rng.uniform(0, 100), rng.uniform(-160, 160), rng.uniform(-160, 160))),
+    ('lch_to_rgb', lambda rng: (rng.uniform(0, 100), rng.uniform(0, 230), rng.uniform(0, 360))),
+    ('tohex', lambda rng: (rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.uniform(0, 100))),
+)
+
+for _name, _make_args in _CONVERTERS:
+    benchmark('convert.%s' % _name, 'convert')(_converter(_name, _make_args))
+
+
+def _batch_converter(space, make_args):
+    def setup(scale):
+        module = load_plugin()
+        rng = random.Random(7)
+        args = [make_args(rng) for _ in range(int(10000 * scale))]
+
+        def run():
+            module.to_rgb(space, args)
+        run.items = len(args)
+        return run
+    return setup
+
+
+def _python_batch_converter(space, make_args):
+    # The pure Python kernel, as run without NumPy (as in Sublime Text):
+    def setup(scale):
+        module = load_plugin()
+        kernel = sys.modules[module.to_rgb.__module__].KERNELS[space]
+        rng = random.Random(7)
+        args = [make_args(rng) for _ in range(int(10000 * scale))]
+
+        def run():
+            kernel(args)
+        run.items = len(args)
+        return run
+    return setup
+
+
+for _name, _make_args in _CONVERTERS:
+    if _name != 'tohex':
+        benchmark('convert.batch.%s' % _name[:3], 'convert')(_batch_converter(_name[:3], _make_args))
+        benchmark('convert.batch.python.%s' % _name[:3], 'convert')(_python_batch_converter(_name[:3], _make_args))
+
+
+# Gutter icons
+
+@benchmark('toicon.cold', 'icons')
+def bench_toicon_cold(scale):
+    module = load_plugin()
+    count = int(500 * scale)
+    counter = [0]
+
+    def run():
+        base = counter[0]
+        counter[0] += count
+        for i in range(base, base + count):
+            module.toicon('col_%06XFF' % (i % 0x1000000), gutter_icon='circle')
+        module.flush_icons()
+    run.items = count
+    return run
+
+
+@benchmark('toicon.warm', 'icons')
+def bench_toicon_warm(scale):
+    module = load_plugin()
+    names = ['col_%06XFF' % (i * 7919 % 0x1000000) for i in range(int(500 * scale))]
+    for name in names:
+        module.toicon(name, gutter_icon='square')
+    module.flush_icons()
+
+    def run():
+        for name in names:
+            module.toicon(name, gutter_icon='square')
+    run.items = len(names)
+    return run
+
+
+# Color scheme updates
+
+def _scheme_update(path, colors, overlay=True):
+    def setup(scale):
+        module = load_plugin()
+        # Before Sublime Text 3149 rules are added to (a copy of) the color
+        # scheme itself, rather than to an overlay in the User package:
+        colorizer_module = sys.modules[module.SchemaColorizer.__module__]
+        overlay_schemes = colorizer_module.OVERLAY_SCHEMES
+        colorizer_module.OVERLAY_SCHEMES = overlay
+        view = new_view('', scheme=path)
+        count = max(1, int(colors * scale))
+        batches = []
+
+        def run():
+            if not batches:
+                batches.append(0)
+            else:
+                batches[0] += 1
+            colorizer = module.colorizer
+            for i in range(count):
+                colorizer.add_color('#%06XFF' % ((batches[0] * count + i) * 2654435761 % 0x1000000))
+            colorizer.update(view)
+            colorizer.flush()  # the write behind it, too
+
+        def reset():
+            write_scheme(path)
+            colorizer = module.colorizer
+            colorizer.color_scheme = None
+            colorizer.clear()
+            colorizer.setup_color_scheme(view.settings())
+        def cleanup():
+            close_view(view)
+            colorizer_module.OVERLAY_SCHEMES = overlay_schemes
+            module.colorizer.color_scheme = None
+        run.before_repeat = reset
+        run.items = count
+        run.cleanup = cleanup
+        return run
+    return setup
+
+
+benchmark('SchemaColorizer.update.sublime-color-scheme', 'scheme', number=10)(_scheme_update(SCHEME_PATH, 20))
+benchmark('SchemaColorizer.update.tmTheme', 'scheme', number=10)(_scheme_update(TMTHEME_PATH, 20, overlay=False))
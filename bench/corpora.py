@@ -0,0 +1,211 @@
+"""
+Deterministic corpus generators.
+
+Every generator takes a target size in bytes and a seed, and produces text
+shaped like the files Color Highlight struggles with in practice.
+"""
+from __future__ import absolute_import
+
+import random
+
+from .harness import plugin_module
+
+CSS_PROPERTIES = (
+    'margin: 0 auto;',
+    'padding: 4px 8px;',
+    'display: flex;',
+    'font-family: "Helvetica Neue", Arial, sans-serif;',
+    'line-height: 1.5;',
+    'transition: opacity 120ms ease-in-out;',
+    'z-index: 10;',
+    'width: calc(100% - 2rem);',
+    'transform: translate(-50%, -50%) rotate(45deg);',
+    'grid-template-columns: repeat(3, minmax(0, 1fr));',
+)
+
+SOURCE_LINES = (
+    'def handle_request(self, request, *args, **kwargs):',
+    '    response = self.dispatch(request, *args, **kwargs)',
+    '    if response is None:',
+    '        raise ValueError("no response for %r" % (request,))',
+    '    for item in sorted(self.items, key=lambda i: i.priority):',
+    '        total += item.weight * factor',
+    '    return {"status": 200, "body": body}',
+    '# TODO: cache the lookup table and avoid the extra copy',
+    'logger.debug("processed %d records in %.2fs", count, elapsed)',
+    '',
+)
+
+
+def _names():
+    return sorted(plugin_module().names_to_hex)
+
+
+def _hex(rng):
+    return '#%06x' % rng.randrange(0x1000000)
+
+
+def _color(rng, names):
+    kind = rng.randrange(12)
+    if kind == 0:
+        return rng.choice(names)
+    if kind == 1:
+        return '#%03x' % rng.randrange(0x1000)
+    if kind == 2:
+        return '#%08X' % rng.randrange(0x100000000)
+    if kind == 3:
+        return 'rgb(%d, %d, %d)' % (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    if kind == 4:
+        return 'rgba(%d, %d, %d, %.2f)' % (rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.random())
+    if kind == 5:
+        return 'hsl(%d, %d%%, %d%%)' % (rng.randrange(360), rng.randrange(101), rng.randrange(101))
+    if kind == 6:
+        return 'hsla(%ddeg, %d%%, %d%%, %.1f)' % (rng.randrange(360), rng.randrange(101), rng.randrange(101), rng.random())
+    if kind == 7:
+        w = rng.randrange(50)
+        return 'hwb(%d, %d%%, %d%%)' % (rng.randrange(360), w, rng.randrange(50))
+    if kind == 8:
+        return 'rgba(%s, %d%%)' % (rng.choice(names), rng.randrange(101))
+    return _hex(rng)
+
+
+def _fill(size, make_line):
+    out = []
+    total = 0
+    i = 0
+    while total < size:
+        line = make_line(i)
+        out.append(line)
+        total += len(line) + 1
+        i += 1
+    return '\n'.join(out) + '\n'
+
+
+def css(size, seed=1):
+    """A large stylesheet: mostly layout rules, one color in ~3 lines."""
+    rng = random.Random(seed)
+    names = _names()
+    color_props = ('color', 'background-color', 'border-color', 'fill', 'stroke', 'outline-color')
+
+    def make_line(i):
+        if i % 8 == 0:
+            return '.component-%d > .item:hover, .component-%d.is-active {' % (i, i + 1)
+        if i % 8 == 7:
+            return '}'
+        if rng.random() < 0.35:
+            return '    %s: %s;' % (rng.choice(color_props), _color(rng, names))
+        return '    ' + rng.choice(CSS_PROPERTIES)
+    return _fill(size, make_line)
+
+
+def design_tokens(size, seed=2):
+    """Design-token JSON dominated by hsl/hwb/lab/lch functional notations."""
+    rng = random.Random(seed)
+
+    def value():
+        kind = rng.randrange(6)
+        if kind == 0:
+            return 'lab(%.2f, %.2f, %.2f)' % (rng.uniform(0, 100), rng.uniform(-128, 128), rng.uniform(-128, 128))
+        if kind == 1:
+            return 'lch(%.2f, %.2f, %.2f)' % (rng.uniform(0, 100), rng.uniform(0, 150), rng.uniform(0, 360))
+        if kind == 2:
+            return 'hsl(%.1f, %.1f%%, %.1f%%)' % (rng.uniform(0, 360), rng.uniform(0, 100), rng.uniform(0, 100))
+        if kind == 3:
+            return 'hsv(%.1f, %.1f%%, %.1f%%)' % (rng.uniform(0, 360), rng.uniform(0, 100), rng.uniform(0, 100))
+        if kind == 4:
+            return 'hwb(%.1f, %.1f%%, %.1f%%)' % (rng.uniform(0, 360), rng.uniform(0, 50), rng.uniform(0, 50))
+        return _hex(rng)
+
+    def make_line(i):
+        if i == 0:
+            return '{'
+        if i % 5 == 1:
+            return '  "palette-%d": {' % i
+        if i % 5 == 0:
+            return '  },'
+        return '    "shade-%d": {"value": "%s", "type": "color"},' % (i, value())
+    return _fill(size, make_line)[:-1] + '\n  "end": {}\n}\n'
+
+
+def ansi_log(size, seed=3):
+    """A build log with raw and escaped ANSI color sequences."""
+    rng = random.Random(seed)
+    escapes = ('\x1b[', '\\033[', '\\x1b[', '\\u001b[', '\\e[')
+
+    def sgr():
+        kind = rng.randrange(4)
+        esc = rng.choice(escapes)
+        if kind == 0:
+            return '%s%dm' % (esc, rng.choice((30, 31, 32, 33, 34, 35, 36, 37, 90, 91, 92)))
+        if kind == 1:
+            return '%s1;%dm' % (esc, rng.randrange(30, 38))
+        if kind == 2:
+            return '%s38;5;%dm' % (esc, rng.randrange(256))
+        return '%s38;2;%d;%d;%dm' % (esc, rng.randrange(256), rng.randrange(256), rng.randrange(256))
+
+    def make_line(i):
+        stamp = '[%02d:%02d:%02d.%03d]' % (i // 3600 % 24, i // 60 % 60, i % 60, i % 1000)
+        if rng.random() < 0.3:
+            return '%s %sINFO%s compiling src/module_%d.c -> build/module_%d.o' % (stamp, sgr(), sgr(), i, i)
+        return '%s building target libfoo_%d (step %d of %d)' % (stamp, i % 97, i, i + 1000)
+    return _fill(size, make_line)
+
+
+def minified_bundle(size, seed=4, line_length=32000):
+    """A minified JavaScript/CSS bundle: very long lines, sparse colors."""
+    rng = random.Random(seed)
+    names = _names()
+    chunks = (
+        'function(e,t,n){"use strict";var r=n(12),o=n(7);',
+        'e.exports=function(e){return null!=e&&"object"==typeof e};',
+        'Object.defineProperty(t,"__esModule",{value:!0});',
+        'for(var i=0,a=e.length;i<a;i++)o[i]=r(e[i],i);',
+        '.btn{padding:.375rem .75rem;border-radius:.25rem}',
+    )
+
+    def make_line(i):
+        parts = []
+        length = 0
+        while length < line_length:
+            if rng.random() < 0.08:
+                chunk = '.c%d{color:%s}' % (length, _color(rng, names))
+            else:
+                chunk = rng.choice(chunks)
+            parts.append(chunk)
+            length += len(chunk)
+        return ''.join(parts)
+    return _fill(size, make_line)
+
+
+def distinct_colors(count, seed=5):
+    """A palette with ``count`` distinct #RRGGBB colors, one per line."""
+    rng = random.Random(seed)
+    seen = set()
+    lines = []
+    while len(lines) < count:
+        value = rng.randrange(0x1000000)
+        if value in seen:
+            continue
+        seen.add(value)
+        lines.append('$color-%d: #%06x;' % (len(lines), value))
+    return '\n'.join(lines) + '\n'
+
+
+def source_code(size, seed=6, color_every=200):
+    """Ordinary source code where only one line in ``color_every`` has a color."""
+    rng = random.Random(seed)
+
+    def make_line(i):
+        if i % color_every == color_every - 1:
+            return 'HIGHLIGHT = "%s"' % _hex(rng)
+        return rng.choice(SOURCE_LINES)
+    return _fill(size, make_line)
+
+
+GENERATORS = {
+    'css': css,
+    'design_tokens': design_tokens,
+    'ansi_log': ansi_log,
+    'minified_bundle': minified_bundle,
+    'source_code': source_code,
+}
@@ -0,0 +1,204 @@
+"""
+Loads the plugin outside Sublime Text.
+
+The stand-in ``sublime``/``sublime_plugin`` modules are registered, a scratch
+``Packages`` directory with a color scheme is prepared, and the plugin is
+imported as the ``Color Highlight`` package, exactly as Sublime names it.
+"""
+from __future__ import absolute_import
+
+import os
+import sys
+import shutil
+import tempfile
+import importlib
+
+from . import sublime
+from . import sublime_plugin
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'Color Highlight'
+SCHEME_PATH = '/Color Scheme - Default/Monokai.sublime-color-scheme'
+TMTHEME_PATH = '/Color Scheme - Default/Monokai.tmTheme'
+
+SUBLIME_COLOR_SCHEME = """{
+    "name": "Monokai",
+    "author": "Sublime HQ Pty Ltd, Wimer Hazenberg",
+    "variables":
+    {
+        "black": "hsl(0, 0%%, 0%%)",
+        "white": "hsl(0, 0%%, 100%%)"
+    },
+    "globals":
+    {
+        "foreground": "var(white)",
+        "background": "#272822"
+    },
+    "rules":
+    [
+%s
+        {
+            "name": "Comment",
+            "scope": "comment",
+            "foreground": "#75715e"
+        }
+    ]
+}
+"""
+
+SCHEME_RULE = """        {
+            "name": "Rule %(i)d",
+            "scope": "source.lang%(i)d meta.block%(i)d",
+            "foreground": "#%(i)06x"
+        },
+"""
+
+TMTHEME = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+    <key>name</key>
+    <string>Monokai</string>
+    <key>settings</key>
+    <array>
+        <dict>
+            <key>settings</key>
+            <dict>
+                <key>background</key>
+                <string>#272822</string>
+                <key>foreground</key>
+                <string>#F8F8F2</string>
+            </dict>
+        </dict>
+%s
+    </array>
+</dict>
+</plist>
+"""
+
+TMTHEME_RULE = """        <dict>
+            <key>name</key>
+            <string>Rule %(i)d</string>
+            <key>scope</key>
+            <string>source.lang%(i)d meta.block%(i)d</string>
+            <key>settings</key>
+            <dict>
+                <key>foreground</key>
+                <string>#%(i)06x</string>
+            </dict>
+        </dict>
+"""
+
+_state = {}
+
+
+def color_scheme(rules=50):
+    return SUBLIME_COLOR_SCHEME % ''.join(SCHEME_RULE % {'i': i} for i in range(rules))
+
+
+def tmtheme(rules=50):
+    return TMTHEME % ''.join(TMTHEME_RULE % {'i': i} for i in range(rules))
+
+
+def install_stubs():
+    sys.modules.setdefault('sublime', sublime)
+    sys.modules.setdefault('sublime_plugin', sublime_plugin)
+
+
+def write_scheme(path=SCHEME_PATH, content=None):
+    """(Re)write a color scheme under the scratch Packages directory, dropping any backup
+    and the overlay (with the generated rules) in the User package."""
+    if content is None:
+        content = tmtheme() if path.endswith('.tmTheme') else color_scheme()
+    full_path = sublime.packages_path() + path
+    if not os.path.isdir(os.path.dirname(full_path)):
+        os.makedirs(os.path.dirname(full_path))
+    overlay = os.path.join(sublime.packages_path(), 'User', os.path.splitext(os.path.basename(path))[0] + '.sublime-color-scheme')
+    for fn in (full_path, full_path + '.chback', overlay, overlay + '.chback'):
+        if os.path.exists(fn):
+            os.remove(fn)
+    with open(full_path, 'w') as f:
+        f.write(content)
+    return full_path
+
+
+def load_plugin():
+    """Import the plugin against the stubs; returns the ``ColorHighlight`` module."""
+    if 'module' in _state:
+        return _state['module']
+    install_stubs()
+    packages = tempfile.mkdtemp(prefix='color-highlight-bench-')
+    sublime.set_packages_path(packages)
+    os.makedirs(os.path.join(packages, 'User'))
+    with open(os.path.join(packages, 'User', '%s.sublime-settings' % PACKAGE), 'w') as f:
+        f.write('{"user": {"pregenerate_icons": false}}')  # icons are part of what's measured
+    sublime.add_resource_root(PACKAGE, ROOT)
+    write_scheme(SCHEME_PATH)
+    write_scheme(TMTHEME_PATH)
+
+    window = sublime.active_window()
+    window.new_file('', file_name=os.path.join(packages, 'scratch.txt'))
+
+    if PACKAGE not in sys.modules:
+        package = type(sys)(PACKAGE)
+        package.__path__ = [ROOT]
+        package.__package__ = PACKAGE
+        sys.modules[PACKAGE] = package
+    module = importlib.import_module(PACKAGE + '.ColorHighlight')
+    module.plugin_loaded()
+    _state['module'] = module
+    _state['packages'] = packages
+    return module
+
+
+def plugin_module():
+    return load_plugin()
+
+
+def new_view(text, file_name='bench.css', scheme=SCHEME_PATH):
+    """Open ``text`` in a new view of the active window, using the given scheme."""
+    load_plugin()
+    window = sublime.active_window()
+    view = window.new_file(text, file_name=os.path.join(_state['packages'], file_name), settings={
+        'color_scheme': 'Packages' + scheme,
+    })
+    window.focus_view(view)
+    _state['module'].ColorHighlightViewEventListener(view).on_load()
+    listener = getattr(_state['module'], 'ColorHighlightTextChangeListener', None)
+    if listener is not None:
+        listener().attach(view.buffer())
+    return view
+
+
+def close_view(view):
+    module = load_plugin()
+    module.ColorHighlightViewEventListener(view).on_close()
+    view.window().close_view(view)
+
+
+def reset_colorizer(path=SCHEME_PATH):
+    """Restore a pristine scheme and forget every generated color and icon."""
+    module = load_plugin()
+    module.colorizer.cancel()
+    module.flush_icons()
+    write_scheme(path)
+    module.colorizer.color_scheme = None
+    module.colorizer.clear()
+    icons = os.path.join(sublime.packages_path(), 'User', '%s.cache' % module.NAME)
+    if os.path.isdir(icons):
+        shutil.rmtree(icons)
+    module.ICONS = None  # the index of the icons goes with them
+
+
+def shutdown():
+    """Stop the plugin's background threads and remove the scratch Packages directory."""
+    module = _state.pop('module', None)
+    if module is not None:
+        module.__scan_queue_.put(None)
+        module.__active_scan_thread.join(5)
+        module.__icon_queue_.put(None)
+        module.__active_icon_thread.join(5)
+    packages = _state.pop('packages', None)
+    if packages:
+        shutil.rmtree(packages, ignore_errors=True)
+    sublime.reset()
@@ -0,0 +1,674 @@
+"""
+Headless stand-in for the parts of the ``sublime`` API Color Highlight uses.
+
+Only what the plugin (and the benchmarks) need is implemented; behaviour
+follows Sublime Text 4 closely enough to exercise the real code paths:
+character offsets, line splitting, ``find_all`` with format extraction,
+region storage (shifted on edits) and a deterministic ``set_timeout`` queue.
+"""
+from __future__ import absolute_import, print_function
+
+import os
+import re
+import json
+import heapq
+import itertools
+import threading
+from bisect import bisect_right
+
+LITERAL = 1
+IGNORECASE = 2
+
+DRAW_EMPTY = 1
+HIDE_ON_MINIMAP = 2
+DRAW_EMPTY_AS_OVERWRITE = 4
+DRAW_NO_FILL = 32
+DRAW_NO_OUTLINE = 256
+DRAW_SOLID_UNDERLINE = 512
+DRAW_STIPPLED_UNDERLINE = 1024
+DRAW_SQUIGGLY_UNDERLINE = 2048
+PERSISTENT = 16
+HIDDEN = 128
+
+VERSION = '4126'
+
+_packages_path = os.path.join(os.path.expanduser('~'), '.sublime-bench', 'Packages')
+_resource_roots = {}  # package name -> directory holding its resources
+_settings = {}
+_windows = []
+_timeouts = []
+_timeout_seq = itertools.count()
+_timeouts_lock = threading.Lock()
+_ids = itertools.count(1)
+_clock = [0]  # milliseconds, advanced by run_timeouts()
+
+
+def version():
+    return VERSION
+
+
+def platform():
+    return 'linux'
+
+
+def arch():
+    return 'x64'
+
+
+def packages_path():
+    return _packages_path
+
+
+def installed_packages_path():
+    return os.path.join(os.path.dirname(_packages_path), 'Installed Packages')
+
+
+def cache_path():
+    return os.path.join(os.path.dirname(_packages_path), 'Cache')
+
+
+def set_packages_path(path):
+    global _packages_path
+    _packages_path = path
+
+
+def add_resource_root(package, path):
+    """Expose ``path`` as ``Packages/<package>`` for load_resource()."""
+    _resource_roots[package] = path
+
+
+def _resource_file(name):
+    if not name.startswith('Packages/'):
+        raise IOError("resource not found: %s" % name)
+    package, _, rest = name[9:].partition('/')
+    candidates = [os.path.join(_packages_path, package, rest)]
+    if package in _resource_roots:
+        candidates.append(os.path.join(_resource_roots[package], rest))
+    for path in candidates:
+        if os.path.isfile(path):
+            return path
+    raise IOError("resource not found: %s" % name)
+
+
+def load_resource(name):
+    with open(_resource_file(name), 'r') as f:
+        return f.read()
+
+
+def load_binary_resource(name):
+    with open(_resource_file(name), 'rb') as f:
+        return f.read()
+
+
+def find_resources(pattern):
+    found = []
+    for package, root in sorted(_resource_roots.items()):
+        for fn in sorted(os.listdir(root)):
+            if re.match(re.escape(pattern).replace('\\*', '.*') + '$', fn):
+                found.append('Packages/%s/%s' % (package, fn))
+    return found
+
+
+_COMMENTS_RE = re.compile(r'"(?:\\.|[^"\\])*"|/\*.*?\*/|//[^\n]*', re.S)
+_TRAILING_COMMA_RE = re.compile(r',(\s*[}\]])')
+
+
+def decode_value(data):
+    """Decode Sublime-flavoured JSON (comments and trailing commas allowed)."""
+    data = _COMMENTS_RE.sub(lambda m: m.group(0) if m.group(0)[0] == '"' else '', data)
+    data = _TRAILING_COMMA_RE.sub(r'\1', data)
+    return json.loads(data)
+
+
+def encode_value(value, pretty=False):
+    return json.dumps(value, indent=4 if pretty else None)
+
+
+class Settings(object):
+    def __init__(self, values=None):
+        self._values = dict(values or {})
+        self._on_change = {}
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def has(self, key):
+        return key in self._values
+
+    def set(self, key, value):
+        self._values[key] = value
+        for callback in list(self._on_change.values()):
+            callback()
+
+    def erase(self, key):
+        self._values.pop(key, None)
+
+    def add_on_change(self, tag, callback):
+        self._on_change[tag] = callback
+
+    def clear_on_change(self, tag):
+        self._on_change.pop(tag, None)
+
+    def to_dict(self):
+        return dict(self._values)
+
+
+def load_settings(base_name):
+    if base_name not in _settings:
+        values = {}
+        for root in sorted(_resource_roots.values()) + [os.path.join(_packages_path, 'User')]:
+            path = os.path.join(root, base_name)
+            if os.path.isfile(path):
+                with open(path, 'r') as f:
+                    values.update(decode_value(f.read()))
+        _settings[base_name] = Settings(values)
+    return _settings[base_name]
+
+
+def save_settings(base_name):
+    pass
+
+
+def set_timeout(callback, delay=0):
+    with _timeouts_lock:
+        heapq.heappush(_timeouts, (_clock[0] + delay, next(_timeout_seq), callback))
+
+
+set_timeout_async = set_timeout
+
+
+def run_timeouts(until=None):
+    """
+    Run queued timeouts in due order, advancing the fake clock.
+
+    Timeouts scheduled while running are honoured as long as they become due
+    before ``until`` (milliseconds on the fake clock; all of them if None).
+    Returns the number of callbacks run.
+    """
+    count = 0
+    while True:
+        with _timeouts_lock:
+            if not _timeouts or (until is not None and _timeouts[0][0] > until):
+                break
+            due, _, callback = heapq.heappop(_timeouts)
+        _clock[0] = max(_clock[0], due)
+        callback()
+        count += 1
+    if until is not None:
+        _clock[0] = max(_clock[0], until)
+    return count
+
+
+def pending_timeouts():
+    return len(_timeouts)
+
+
+def status_message(msg):
+    pass
+
+
+def error_message(msg):
+    print("[sublime] error:", msg)
+
+
+def message_dialog(msg):
+    pass
+
+
+class Region(object):
+    __slots__ = ('a', 'b', 'xpos')
+
+    def __init__(self, a, b=None, xpos=-1):
+        if b is None:
+            b = a
+        self.a = a
+        self.b = b
+        self.xpos = xpos
+
+    def __repr__(self):
+        return 'Region(%d, %d)' % (self.a, self.b)
+
+    def __len__(self):
+        return self.size()
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and self.a == other.a and self.b == other.b
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.a, self.b))
+
+    def __lt__(self, other):
+        return self.begin() < other.begin()
+
+    def __contains__(self, x):
+        return self.contains(x)
+
+    def begin(self):
+        return self.a if self.a < self.b else self.b
+
+    def end(self):
+        return self.b if self.a < self.b else self.a
+
+    def size(self):
+        return abs(self.b - self.a)
+
+    def empty(self):
+        return self.a == self.b
+
+    def to_tuple(self):
+        return (self.a, self.b)
+
+    def cover(self, other):
+        return Region(min(self.begin(), other.begin()), max(self.end(), other.end()))
+
+    def intersection(self, other):
+        if self.end() <= other.begin() or other.end() <= self.begin():
+            return Region(0, 0)
+        return Region(max(self.begin(), other.begin()), min(self.end(), other.end()))
+
+    def intersects(self, other):
+        lb, le = self.begin(), self.end()
+        rb, re_ = other.begin(), other.end()
+        return (lb == rb and le == re_) or (rb > lb and rb < le) or (lb > rb and lb < re_)
+
+    def contains(self, x):
+        if isinstance(x, Region):
+            return self.begin() <= x.begin() and x.end() <= self.end()
+        return self.begin() <= x <= self.end()
+
+
+class Selection(object):
+    def __init__(self, view):
+        self.view = view
+        self._regions = []
+
+    def __len__(self):
+        return len(self._regions)
+
+    def __iter__(self):
+        return iter(list(self._regions))
+
+    def __getitem__(self, index):
+        return self._regions[index]
+
+    def clear(self):
+        del self._regions[:]
+
+    def add(self, region):
+        if not isinstance(region, Region):
+            region = Region(region)
+        self._regions.append(region)
+        self._regions.sort(key=Region.begin)
+
+    def add_all(self, regions):
+        for region in regions:
+            self.add(region)
+
+
+class TextChange(object):
+    """Mirrors ``sublime.TextChange``: ``a``/``b`` are HistoricPositions."""
+
+    def __init__(self, a, b, str, len_utf16=None, len_utf8=None):
+        self.a = a
+        self.b = b
+        self.str = str
+        self.len_utf16 = len_utf16
+        self.len_utf8 = len_utf8
+
+
+class HistoricPosition(object):
+    def __init__(self, pt, row, col, col_utf16=None, col_utf8=None):
+        self.pt = pt
+        self.row = row
+        self.col = col
+        self.col_utf16 = col_utf16
+        self.col_utf8 = col_utf8
+
+
+class Buffer(object):
+    def __init__(self, view):
+        self._id = next(_ids)
+        self._view = view
+
+    def id(self):
+        return self._id
+
+    def primary_view(self):
+        return self._view
+
+    def views(self):
+        return [self._view]
+
+
+class View(object):
+    """In-memory view backed by a plain string."""
+
+    def __init__(self, text='', file_name=None, window=None, settings=None, syntax=None):
+        self._id = next(_ids)
+        self._buffer = Buffer(self)
+        self._file_name = file_name
+        self._window = window
+        self._settings = Settings(settings)
+        self._regions = {}
+        self._sel = Selection(self)
+        self._change_count = 0
+        self._history = []
+        self._loading = False
+        self._style = {'background': '#272822', 'foreground': '#F8F8F2'}
+        self._visible_lines = 100
+        self._viewport_line = 0
+        self.text_change_listeners = []
+        self._set_text(text)
+
+    def __repr__(self):
+        return 'View(%d)' % self._id
+
+    def __eq__(self, other):
+        return isinstance(other, View) and self._id == other._id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._id
+
+    # Identity and state
+
+    def id(self):
+        return self._id
+
+    def buffer_id(self):
+        return self._buffer.id()
+
+    def buffer(self):
+        return self._buffer
+
+    def is_valid(self):
+        return True
+
+    def window(self):
+        return self._window
+
+    def file_name(self):
+        return self._file_name
+
+    def name(self):
+        return ''
+
+    def is_loading(self):
+        return self._loading
+
+    def is_dirty(self):
+        return bool(self._change_count)
+
+    def is_scratch(self):
+        return False
+
+    def change_count(self):
+        return self._change_count
+
+    def settings(self):
+        return self._settings
+
+    def style(self):
+        return dict(self._style)
+
+    def command_history(self, index, modifying_only=False):
+        if self._history and -len(self._history) <= index - 1 < len(self._history):
+            return self._history[index - 1]
+        return (None, None, 0)
+
+    def run_command(self, cmd, args=None):
+        self._history.append((cmd, args, 1))
+
+    def sel(self):
+        return self._sel
+
+    # Text
+
+    def _set_text(self, text):
+        self._text = text
+        starts = [0]
+        find = text.find
+        pos = find('\n')
+        while pos != -1:
+            starts.append(pos + 1)
+            pos = find('\n', pos + 1)
+        self._line_starts = starts
+
+    def size(self):
+        return len(self._text)
+
+    def substr(self, x):
+        if isinstance(x, Region):
+            return self._text[x.begin():x.end()]
+        return self._text[x:x + 1]
+
+    def _row(self, pt):
+        return bisect_right(self._line_starts, pt) - 1
+
+    def _line_bounds(self, row):
+        begin = self._line_starts[row]
+        if row + 1 < len(self._line_starts):
+            end = self._line_starts[row + 1] - 1
+        else:
+            end = len(self._text)
+        return begin, end
+
+    def rowcol(self, pt):
+        row = self._row(pt)
+        return row, pt - self._line_starts[row]
+
+    def text_point(self, row, col):
+        row = max(0, min(row, len(self._line_starts) - 1))
+        return min(self._line_starts[row] + col, self._line_bounds(row)[1])
+
+    def line(self, x):
+        if isinstance(x, Region):
+            begin = self._line_bounds(self._row(x.begin()))[0]
+            end = self._line_bounds(self._row(x.end()))[1]
+            return Region(begin, end)
+        return Region(*self._line_bounds(self._row(x)))
+
+    def full_line(self, x):
+        line = self.line(x)
+        return Region(line.begin(), min(line.end() + 1, len(self._text)))
+
+    def lines(self, region):
+        first = self._row(region.begin())
+        last = self._row(region.end())
+        return [Region(*self._line_bounds(row)) for row in range(first, last + 1)]
+
+    def split_by_newlines(self, region):
+        return [line.intersection(region) if not line.contains(region) else region for line in self.lines(region)]
+
+    def find(self, pattern, start_pt, flags=0):
+        m = self._compile(pattern, flags).search(self._text, start_pt)
+        if not m:
+            return Region(-1, -1)
+        return Region(m.start(), m.end())
+
+    def find_all(self, pattern, flags=0, fmt=None, extractions=None):
+        regions = []
+        for m in self._compile(pattern, flags).finditer(self._text):
+            regions.append(Region(m.start(), m.end()))
+            if fmt is not None and extractions is not None:
+                extractions.append(m.expand(fmt))
+        return regions
+
+    _pattern_cache = {}
+
+    def _compile(self, pattern, flags):
+        key = (pattern, flags)
+        try:
+            return self._pattern_cache[key]
+        except KeyError:
+            if flags & LITERAL:
+                pattern = re.escape(pattern)
+            compiled = re.compile(pattern, re.I if flags & IGNORECASE else 0)
+            self._pattern_cache[key] = compiled
+            return compiled
+
+    def visible_region(self):
+        first = min(self._viewport_line, len(self._line_starts) - 1)
+        last = min(first + self._visible_lines, len(self._line_starts)) - 1
+        return Region(self._line_starts[first], self._line_bounds(last)[1])
+
+    def set_viewport_lines(self, first, count=None):
+        """Scroll so ``first`` is the top visible line (bench helper)."""
+        self._viewport_line = first
+        if count is not None:
+            self._visible_lines = count
+
+    def show(self, x, show_surrounds=True):
+        pt = x.begin() if isinstance(x, Region) else x
+        row = self._row(pt)
+        if not (self._viewport_line <= row < self._viewport_line + self._visible_lines):
+            self._viewport_line = max(0, row - self._visible_lines // 2)
+
+    # Editing
+
+    def _apply_edit(self, region, text):
+        begin, end = region.begin(), region.end()
+        row, col = self.rowcol(begin)
+        erow, ecol = self.rowcol(end)
+        self._set_text(self._text[:begin] + text + self._text[end:])
+        self._change_count += 1
+        delta = len(text) - (end - begin)
+        for key, (regions, options) in list(self._regions.items()):
+            shifted = []
+            for r in regions:
+                a, b = r.begin(), r.end()
+                if b <= begin and not (a == b == begin):
+                    shifted.append(r)
+                    continue
+                if a >= end:
+                    shifted.append(Region(a + delta, b + delta))
+                    continue
+                # The region overlaps the edit: clip what was removed.
+                a = a if a < begin else begin + len(text) if a >= end else begin
+                b = b + delta if b >= end else begin
+                if b < a:
+                    b = a
+                shifted.append(Region(a, b))
+            self._regions[key] = (shifted, options)
+        change = TextChange(
+            HistoricPosition(begin, row, col),
+            HistoricPosition(end, erow, ecol),
+            text,
+        )
+        for listener in list(self.text_change_listeners):
+            listener.on_text_changed([change])
+        return change
+
+    def insert(self, edit, pt, text):
+        self._apply_edit(Region(pt, pt), text)
+        self._history.append(('insert', {'characters': text}, 1))
+        return len(text)
+
+    def erase(self, edit, region):
+        self._apply_edit(region, '')
+        self._history.append(('left_delete', None, 1))
+
+    def replace(self, edit, region, text):
+        self._apply_edit(region, text)
+        self._history.append(('replace', None, 1))
+
+    # Regions
+
+    def add_regions(self, key, regions, scope='', icon='', flags=0, annotations=None, annotation_color=''):
+        self._regions[key] = (list(regions), {'scope': scope, 'icon': icon, 'flags': flags})
+
+    def get_regions(self, key):
+        try:
+            return list(self._regions[key][0])
+        except KeyError:
+            return []
+
+    def get_regions_options(self, key):
+        """Bench helper: the scope/icon/flags a key was added with."""
+        try:
+            return dict(self._regions[key][1])
+        except KeyError:
+            return {}
+
+    def erase_regions(self, key):
+        self._regions.pop(key, None)
+
+    def region_keys(self):
+        """Bench helper: every region key currently stored on the view."""
+        return list(self._regions)
+
+
+class Window(object):
+    def __init__(self):
+        self._id = next(_ids)
+        self._views = []
+        self._active = None
+
+    def id(self):
+        return self._id
+
+    def views(self):
+        return list(self._views)
+
+    def active_view(self):
+        return self._active
+
+    def focus_view(self, view):
+        self._active = view
+
+    def new_file(self, text='', file_name=None, settings=None):
+        view = View(text, file_name=file_name, window=self, settings=settings)
+        self._views.append(view)
+        if self._active is None:
+            self._active = view
+        return view
+
+    def close_view(self, view):
+        self._views.remove(view)
+        if self._active is view:
+            self._active = self._views[-1] if self._views else None
+
+    def run_command(self, cmd, args=None):
+        pass
+
+    def views_in_group(self, group):
+        return self.views()
+
+    def num_groups(self):
+        return 1
+
+    def active_view_in_group(self, group):
+        return self._active
+
+    def status_message(self, msg):
+        pass
+
+
+def windows():
+    return list(_windows)
+
+
+def active_window():
+    if not _windows:
+        _windows.append(Window())
+    return _windows[0]
+
+
+def new_window():
+    window = Window()
+    _windows.append(window)
+    return window
+
+
+def reset():
+    """Forget every window, timeout and cached settings (bench helper)."""
+    del _windows[:]
+    with _timeouts_lock:
+        del _timeouts[:]
+    _settings.clear()
+    _clock[0] = 0
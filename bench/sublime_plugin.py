@@ -0,0 +1,70 @@
+"""
+Headless stand-in for the ``sublime_plugin`` base classes.
+"""
+from __future__ import absolute_import
+
+
+class Command(object):
+    def is_enabled(self, *args, **kwargs):
+        return True
+
+    def is_visible(self, *args, **kwargs):
+        return True
+
+    def is_checked(self, *args, **kwargs):
+        return False
+
+    def description(self, *args, **kwargs):
+        return None
+
+
+class ApplicationCommand(Command):
+    pass
+
+
+class WindowCommand(Command):
+    def __init__(self, window):
+        self.window = window
+
+
+class TextCommand(Command):
+    def __init__(self, view):
+        self.view = view
+
+
+class EventListener(object):
+    pass
+
+
+class ViewEventListener(object):
+    @classmethod
+    def is_applicable(cls, settings):
+        return True
+
+    @classmethod
+    def applies_to_primary_view_only(cls):
+        return True
+
+    def __init__(self, view):
+        self.view = view
+
+
+class TextChangeListener(object):
+    @classmethod
+    def is_applicable(cls, buffer):
+        return True
+
+    def __init__(self):
+        self.buffer = None
+
+    def attach(self, buffer):
+        self.buffer = buffer
+        buffer.primary_view().text_change_listeners.append(self)
+
+    def detach(self):
+        if self.buffer is not None:
+            self.buffer.primary_view().text_change_listeners.remove(self)
+            self.buffer = None
+
+    def is_attached(self):
+        return self.buffer is not None
@@ -4,15 +4,18 @@ import os
 import re
 import sys
 import json
+import time
 import errno
 import plistlib
-import datetime
+import threading
 
 import sublime
 
 from .colors import names_to_hex, xterm_to_hex, xterm8_to_hex, xterm8b_to_hex, xterm8f_to_hex
 
 DEFAULT_COLOR_SCHEME = 'Monokai.sublime-color-scheme'
+OVERLAY_SCHEME = '{\n\t"rules": [\n\t]\n}\n'
+OVERLAY_SCHEMES = int(sublime.version()) >= 3149  # Sublime merges User/<name>.sublime-color-scheme into <name> color schemes
 
 all_names_to_hex = dict(names_to_hex, **xterm_to_hex)
 
@@ -41,6 +44,20 @@ else:
     plistlib.dumps = lambda value: plistlib.writePlistToString(value)
 
 
+def write_file(rf, content, mode='w'):
+    # Write to a temporary file and rename it over the old one, so Sublime
+    # never gets to load a half written file:
+    tf = '%s.%d.%d.tmp' % (rf, os.getpid(), threading.current_thread().ident)
+    with open(tf, mode) as f:
+        f.write(content)
+    if hasattr(os, 'replace'):
+        os.replace(tf, rf)
+    else:  # ST2
+        if sys.platform == 'win32' and os.path.exists(rf):
+            os.remove(rf)
+        os.rename(tf, rf)
+
+
 def write_package(path, content):
     rf = sublime.packages_path() + path
     try:
@@ -48,8 +65,7 @@ def write_package(path, content):
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
-    with open(rf, 'w') as f:
-        f.write(content)
+    write_file(rf, content)
 
 
 def read_package(path):
@@ -63,54 +79,118 @@ def read_package(path):
     return res
 
 
+def color_scheme_path(settings):
+    path = settings.get('color_scheme') or DEFAULT_COLOR_SCHEME
+    if not path.startswith('Packages/'):
+        path = 'Packages/Color Scheme - Default/' + path
+    # Remove "Packages" part from name
+    return path[8:]
+
+
 class ColorScheme(object):
     backup_ext = ".chback"
 
     def __init__(self, settings):
-        path = settings.get('color_scheme') or DEFAULT_COLOR_SCHEME
-        if not path.startswith('Packages/'):
-            path = 'Packages/Color Scheme - Default/' + path
-        self.path = path[8:]
-        self.time = datetime.datetime.now()
+        self.path = color_scheme_path(settings)
+        self.signature = None  # of the file written to, when its content was read
+        self._plist = None  # parsed content (of a tmTheme), kept as rules get added
+        self._scopes = None  # col_* scopes the color scheme has rules for
+        if OVERLAY_SCHEMES:
+            # Rules go in a color scheme of the same name in the User package,
+            # which Sublime merges with this one, instead of in a copy of it:
+            name = os.path.splitext(os.path.basename(self.path))[0]
+            self.target = '/User/%s.sublime-color-scheme' % name
+        else:
+            self.target = self.path
 
-    def hash(self):
-        if not hasattr(self, '_hash'):
-            self._hash = hash(self.content())
-        return self._hash
+    def stat(self):
+        '''Returns the (mtime, size, inode) of the file written to, or None
+           if there's no such file (as for schemes inside packages).'''
+        try:
+            st = os.stat(sublime.packages_path() + self.target)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size, st.st_ino
 
     def restore(self):
-        # Remove "Packages" part from name
-        if not os.path.exists(sublime.packages_path() + self.path + self.backup_ext):
+        if not os.path.exists(sublime.packages_path() + self.target + self.backup_ext):
             log.debug("No backup :(")
             return False
-        log.debug("Starting restore scheme: " + self.path)
-        write_package(self.path, read_package(self.path + self.backup_ext))
+        log.debug("Starting restore scheme: " + self.target)
+        content = read_package(self.target + self.backup_ext)
+        if content:
+            self.write(content)
+        else:
+            # There was no overlay before:
+            if os.path.exists(sublime.packages_path() + self.target):
+                os.remove(sublime.packages_path() + self.target)
+            self._content = OVERLAY_SCHEME
+            self.signature = None
+        self._plist = None
+        self._scopes = None
         log.debug("Restore done.")
         return True
 
-    def backup(self, content):
+    def restore_legacy(self):
+        # Color schemes used to get the rules written in them:
         if os.path.exists(sublime.packages_path() + self.path + self.backup_ext):
+            log.debug("Restoring legacy scheme: " + self.path)
+            write_package(self.path, read_package(self.path + self.backup_ext))
+            os.remove(sublime.packages_path() + self.path + self.backup_ext)
+
+    def backup(self, content):
+        if os.path.exists(sublime.packages_path() + self.target + self.backup_ext):
             log.debug("Already backed up")
             return False
-        write_package(self.path + self.backup_ext, content)  # backup
+        write_package(self.target + self.backup_ext, content)  # backup
         log.debug("Backup done")
         return True
 
     def content(self):
         if not hasattr(self, '_content'):
-            # Remove "Packages" part from name
-            content = read_package(self.path)
-            self.backup(content)
+            self.signature = self.stat()
+            if self.target == self.path:
+                content = read_package(self.path)
+                self.backup(content)
+            else:
+                self.restore_legacy()
+                if os.path.exists(sublime.packages_path() + self.target):
+                    content = read_package(self.target)
+                else:
+                    content = ''
+                self.backup(content)  # empty if there was no overlay
+                if not re.search(r'"rules":\s*\[', content):
+                    content = re.sub(r'\{', '{\n\t"rules": [\n\t],', content, count=1) if content.strip() else OVERLAY_SCHEME
             self._content = content
         return self._content
 
+    def plist(self):
+        if self._plist is None:
+            self._plist = plistlib.loads(self.content().encode('utf-8'))
+        return self._plist
+
+    def scopes(self, prefix):
+        if self._scopes is None:
+            self._scopes = set(prefix + (c if c == 'gutter' else c.upper()) for c in re.findall(r'\b%s([a-fA-F0-9]{8}|gutter)\b' % prefix, self.content()))
+        return self._scopes
+
+    def write(self, content):
+        write_package(self.target, content)
+        self._content = content
+        self.signature = self.stat()
+
 
 class SchemaColorizer(object):
     prefix = "col_"
+    write_delay = 0.1  # seconds new colors are collected for, before writing them
 
     colors = {}
     color_scheme = None
     need_update = False
+    bg_col = None  # background of the view new colors were last found in
+    timer = None  # for the pending write of the color scheme
+    timer_lock = threading.Lock()
+    write_lock = threading.Lock()  # color scheme writes (and their signature checks) go one at a time
 
     def normalize(self, col):
         if col:
@@ -159,12 +239,14 @@ class SchemaColorizer(object):
         else:
             v += 128
 
-        return '#%sFF' % (('%02X' % v) * 3)
+        return '#%sFF' % (('%02X' % int(v)) * 3)
 
     def region_name(self, s):
         return self.prefix + s[1:]
 
     def add_color(self, col):
+        if col in self.colors:  # already normalized
+            return self.colors[col]
         col = self.normalize(col)
         if not col:
             return
@@ -186,24 +268,54 @@ class SchemaColorizer(object):
         return '#333333FF'
 
     def update(self, view):
+        '''Schedules rules for the colors added since the last update to be
+           written to the color scheme. New colors (from all views) are
+           collected for write_delay seconds and then written all at once,
+           in the background, so this never waits for the write.'''
         if not self.need_update:
             return
         self.need_update = False
+        self.bg_col = self.get_background_col(view)
+        with self.timer_lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.write_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def cancel(self):
+        '''Drops the pending write of the color scheme; returns whether
+           there was one.'''
+        with self.timer_lock:
+            timer, self.timer = self.timer, None
+        if timer is not None:
+            timer.cancel()
+        return timer is not None
+
+    def flush(self):
+        '''Does the pending write of the color scheme now, if there's one.'''
+        if self.cancel():
+            with self.write_lock:
+                self.write()
+
+    def write(self):
+        color_scheme = self.color_scheme
+        if not color_scheme:
+            return
 
-        content = self.color_scheme.content()
-        current_colors = set("#%s" % c.upper() for c in re.findall(r'\b%s([a-fA-F0-9]{8})\b' % self.prefix, content))
+        content = color_scheme.content()
+        scopes = color_scheme.scopes(self.prefix)
 
-        bg_col = self.get_background_col(view)
+        bg_col = self.bg_col or '#333333FF'
 
         rules = []
-        if not re.search(r'\b%sgutter\b' % self.prefix, content):
+        if "%sgutter" % self.prefix not in scopes:
             rules.append({
                 "scope": "%sgutter" % self.prefix,
                 "background": "#000000",
                 "foreground": "#ffffff",
             })
-        for col, name in self.colors.items():
-            if col not in current_colors:
+        for col, name in list(self.colors.items()):
+            if name not in scopes:
                 fg_col = self.get_inv_col(bg_col, col)
                 rules.append({
                     "scope": name,
@@ -219,13 +331,15 @@ class SchemaColorizer(object):
                     json_rules = json.dumps({"rules": rules}, indent=m.group(1))
                     json_rules = '\n'.join(map(str.rstrip, json_rules.split('\n')[2:-2])) + ',\n'
                     content = content[:m.end()] + json_rules + content[m.end():]
-                    write_package(self.color_scheme.path, content)
+                    color_scheme.write(content)
+                    scopes.update(r['scope'] for r in rules)
                     log.debug("Updated sublime-color-scheme")
                     return
 
                 # for tmTheme
                 if re.match(r'\s*<(?:\?xml|!DOCTYPE|plist)\b', content):
-                    plist_content = plistlib.loads(content.encode('utf-8'))
+                    # The rules are added to the parsed tmTheme kept in memory:
+                    plist_content = color_scheme.plist()
                     plist_content['settings'].extend({
                         "scope": r['scope'],
                         "settings": {
@@ -234,7 +348,8 @@ class SchemaColorizer(object):
                         }
                     } for r in rules)
                     content = plistlib.dumps(plist_content).decode('utf-8')
-                    write_package(self.color_scheme.path, content)
+                    color_scheme.write(content)
+                    scopes.update(r['scope'] for r in rules)
                     log.debug("Updated tmTheme")
                     return
 
@@ -243,26 +358,93 @@ class SchemaColorizer(object):
                 import traceback; traceback.print_exc();
                 log.error("Not Updated: %r" % e)
 
+    def compact(self, keep, min_dead=0):
+        '''Rewrites the color scheme without the rules for colors whose names
+           aren't in keep, if there are at least min_dead of those (and any).
+           Returns a report of the number of rules, the size and the time it
+           takes to parse the color scheme (what reloading it takes grows
+           with that), before and after; or None if nothing was dropped.'''
+        self.flush()
+        with self.write_lock:
+            color_scheme = self.color_scheme
+            if not color_scheme:
+                return
+            scopes = color_scheme.scopes(self.prefix)
+            dead = set(name for name in scopes if name not in keep and name != "%sgutter" % self.prefix)
+            if not dead or len(dead) < min_dead:
+                return
+
+            content = color_scheme.content()
+            report = {
+                'rules_before': len(scopes),
+                'size_before': len(content),
+                'parse_before': self.parse_time(content),
+            }
+            try:
+                # For sublime-color-scheme
+                if re.search(r'"rules":\s*\[', content):
+                    rule_re = r'[\t ]*\{[^{}]*"scope":\s*"%s([a-fA-F0-9]{8})"[^{}]*\},?[\t ]*(?:\r?\n)?' % self.prefix
+                    content = re.sub(rule_re, lambda m: '' if self.prefix + m.group(1).upper() in dead else m.group(0), content)
+                # for tmTheme
+                elif re.match(r'\s*<(?:\?xml|!DOCTYPE|plist)\b', content):
+                    plist_content = color_scheme.plist()
+                    plist_content['settings'][:] = [rule for rule in plist_content['settings'] if rule.get('scope') not in dead]
+                    content = plistlib.dumps(plist_content).decode('utf-8')
+                else:
+                    log.error("Not Compacted: Schema format not recognized")
+                    return
+                color_scheme.write(content)
+            except Exception as e:
+                import traceback; traceback.print_exc();
+                log.error("Not Compacted: %r" % e)
+                return
+
+            scopes -= dead
+            for name in dead:
+                self.colors.pop("#%s" % name[len(self.prefix):], None)
+            report.update({
+                'rules_after': len(scopes),
+                'size_after': len(content),
+                'parse_after': self.parse_time(content),
+            })
+            log.debug("Compacted color scheme")
+            return report
+
+    def parse_time(self, content):
+        start = time.time()
+        try:
+            if re.match(r'\s*<(?:\?xml|!DOCTYPE|plist)\b', content):
+                plistlib.loads(content.encode('utf-8'))
+            else:
+                sublime.decode_value(content)
+        except Exception:
+            return None  # as in ST2, without sublime.decode_value()
+        return (time.time() - start) * 1000
+
     def clear(self):
         self.colors = {}
 
     def setup_color_scheme(self, settings):
-        color_scheme = ColorScheme(settings)
-        if self.color_scheme and self.color_scheme.path == color_scheme.path:
-            if self.color_scheme.time + datetime.timedelta(seconds=1) > color_scheme.time:
-                return
-            if self.color_scheme.hash() == color_scheme.hash():
-                self.color_scheme.time = color_scheme.time
+        # Only a changed file (by its stat signature) gets read again. A write
+        # replaces the file and updates its signature under write_lock, so the
+        # check can't see our own write halfway (and drop the colors it has
+        # yet to write):
+        with self.write_lock:
+            color_scheme = self.color_scheme
+            if color_scheme and color_scheme.path == color_scheme_path(settings) and color_scheme.signature == color_scheme.stat():
                 return
-        log.debug("Color scheme %s setup" % color_scheme.path)
-        self.color_scheme = color_scheme
-        content = self.color_scheme.content()
-        self.colors = dict(("#%s" % c, "%s%s" % (self.prefix, c)) for c in re.findall(r'\b%s([a-fA-F0-9]{8})\b' % self.prefix, content))
+            color_scheme = ColorScheme(settings)
+            log.debug("Color scheme %s setup" % color_scheme.target)
+            self.color_scheme = color_scheme
+            gutter = "%sgutter" % self.prefix
+            self.colors = dict(("#%s" % name[len(self.prefix):], name) for name in color_scheme.scopes(self.prefix) if name != gutter)
 
     def restore_color_scheme(self):
         # do not support empty color scheme
         if not self.color_scheme:
             log.error("Empty scheme, can't restore")
             return
-        if self.color_scheme.restore():
-            self.colors = {}
+        self.cancel()
+        with self.write_lock:
+            if self.color_scheme.restore():
+                self.colors = {}
@@ -0,0 +1,463 @@
+from __future__ import absolute_import
+
+import math
+import colorsys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Below this many colors, NumPy's per-call overhead outweighs its speed:
+NUMPY_MIN_BATCH = 64
+
+
+def hsv_to_rgb(h, s, v):
+    # h -> [0, 360)
+    # s -> [0, 100]
+    # l -> [0, 100]
+
+    H = h / 360.0
+    S = s / 100.0
+    V = v / 100.0
+
+    RR, GG, BB = colorsys.hsv_to_rgb(H, S, V)
+    return int(RR * 255), int(GG * 255), int(BB * 255)
+
+
+def hsl_to_rgb(h, s, l):
+    # h -> [0, 360)
+    # s -> [0, 100]
+    # l -> [0, 100]
+
+    H = h / 360.0
+    S = s / 100.0
+    L = l / 100.0
+
+    RR, GG, BB = colorsys.hls_to_rgb(H, L, S)
+    return int(RR * 255), int(GG * 255), int(BB * 255)
+
+
+def hwb_to_rgb(h, w, b):
+    # h -> [0, 360)
+    # w -> [0, 100]
+    # b -> [0, 100]
+    H = h / 360.0
+    W = w / 100.0
+    B = b / 100.0
+
+    RR, GG, BB = colorsys.hls_to_rgb(H, 0.5, 1)
+    RR = RR * (1 - W - B) + W
+    GG = GG * (1 - W - B) + W
+    BB = BB * (1 - W - B) + W
+
+    r, g, b = int(RR * 255), int(GG * 255), int(BB * 255)
+    r = 0 if r < 0 else 255 if r > 255 else r
+    g = 0 if g < 0 else 255 if g > 255 else g
+    b = 0 if b < 0 else 255 if b > 255 else b
+    return r, g, b
+
+
+def lab_to_rgb(L, a, b):
+    # L -> [0, 100]
+    # a -> [-160, 160]
+    # b -> [-160, 160]
+
+    Y = (L + 16.0) / 116.0
+    X = a / 500.0 + Y
+    Z = Y - b / 200.0
+
+    Y3 = Y ** 3.0
+    Y = Y3 if Y3 > 0.008856 else (Y - 16.0 / 116.0) / 7.787
+
+    X3 = X ** 3.0
+    X = X3 if X3 > 0.008856 else (X - 16.0 / 116.0) / 7.787
+
+    Z3 = Z ** 3.0
+    Z = Z3 if Z3 > 0.008856 else (Z - 16.0 / 116.0) / 7.787
+
+    # Normalize white point for Observer=2°, Illuminant=D65
+    X *= 0.95047
+    Y *= 1.0
+    Z *= 1.08883
+
+    # XYZ to RGB
+    RR = X * 3.240479 + Y * -1.537150 + Z * - 0.498535
+    GG = X * -0.969256 + Y * 1.875992 + Z * 0.041556
+    BB = X * 0.055648 + Y * -0.204043 + Z * 1.057311
+
+    RR = 1.055 * RR ** (1 / 2.4) - 0.055 if RR > 0.0031308 else 12.92 * RR
+    GG = 1.055 * GG ** (1 / 2.4) - 0.055 if GG > 0.0031308 else 12.92 * GG
+    BB = 1.055 * BB ** (1 / 2.4) - 0.055 if BB > 0.0031308 else 12.92 * BB
+
+    r, g, b = int(RR * 255), int(GG * 255), int(BB * 255)
+    r = 0 if r < 0 else 255 if r > 255 else r
+    g = 0 if g < 0 else 255 if g > 255 else g
+    b = 0 if b < 0 else 255 if b > 255 else b
+    return r, g, b
+
+
+def lch_to_lab(L, c, h):
+    # L -> [0, 100]
+    # c -> [0, 230]
+    # h -> [0, 360)
+    a = c * math.cos(math.radians(h))
+    b = c * math.sin(math.radians(h))
+    return L, a, b
+
+
+def lch_to_rgb(L, c, h):
+    L, a, b = lch_to_lab(L, c, h)
+    return lab_to_rgb(L, a, b)
+
+
+CONVERTERS = {
+    'hsv': hsv_to_rgb,
+    'hsl': hsl_to_rgb,
+    'hwb': hwb_to_rgb,
+    'lab': lab_to_rgb,
+    'lch': lch_to_rgb,
+}
+
+
+def to_rgb(space, args):
+    """
+    Converts a batch of (x, y, z) colors in the given space ('hsv', 'hsl',
+    'hwb', 'lab' or 'lch') to a list of (r, g, b) tuples, each exactly what
+    the matching converter in CONVERTERS returns. Entries that can't be
+    guaranteed to match (or that the converter would raise for) are None,
+    for the caller to handle with the converter itself.
+    """
+    if numpy is not None and len(args) >= NUMPY_MIN_BATCH:
+        with numpy.errstate(all='ignore'):
+            return NUMPY_KERNELS[space](args)
+    return KERNELS[space](args)
+
+
+# Pure Python kernels
+#
+# These inline the converters (and the colorsys functions they call) with
+# the same operations in the same order, so results are the same, without
+# the calls.
+
+ONE_THIRD = 1.0 / 3.0
+ONE_SIXTH = 1.0 / 6.0
+TWO_THIRD = 2.0 / 3.0
+NAN = float('nan')
+
+
+def _hsv_kernel(args):
+    # colorsys.hsv_to_rgb(), inlined:
+    out = []
+    append = out.append
+    for h, s, v in args:
+        try:
+            H = h / 360.0
+            S = s / 100.0
+            V = v / 100.0
+            if S == 0.0:
+                r = int(V * 255)
+                append((r, r, r))
+                continue
+            i = int(H * 6.0)
+            f = (H * 6.0) - i
+            p = int(V * (1.0 - S) * 255)
+            i = i % 6
+            if i == 0:
+                append((int(V * 255), int(V * (1.0 - S * (1.0 - f)) * 255), p))
+            elif i == 1:
+                append((int(V * (1.0 - S * f) * 255), int(V * 255), p))
+            elif i == 2:
+                append((p, int(V * 255), int(V * (1.0 - S * (1.0 - f)) * 255)))
+            elif i == 3:
+                append((p, int(V * (1.0 - S * f) * 255), int(V * 255)))
+            elif i == 4:
+                append((int(V * (1.0 - S * (1.0 - f)) * 255), p, int(V * 255)))
+            else:
+                append((int(V * 255), p, int(V * (1.0 - S * f) * 255)))
+        except (ValueError, OverflowError):
+            append(None)
+    return out
+
+
+def _hsl_kernel(args):
+    # colorsys.hls_to_rgb(), inlined:
+    out = []
+    append = out.append
+    for h, s, l in args:
+        try:
+            H = h / 360.0
+            S = s / 100.0
+            L = l / 100.0
+            if S == 0.0:
+                r = int(L * 255)
+                append((r, r, r))
+                continue
+            m2 = L * (1.0 + S) if L <= 0.5 else L + S - (L * S)
+            m1 = 2.0 * L - m2
+            hue = (H + ONE_THIRD) % 1.0
+            if hue < ONE_SIXTH:
+                RR = m1 + (m2 - m1) * hue * 6.0
+            elif hue < 0.5:
+                RR = m2
+            elif hue < TWO_THIRD:
+                RR = m1 + (m2 - m1) * (TWO_THIRD - hue) * 6.0
+            else:
+                RR = m1
+            hue = H % 1.0
+            if hue < ONE_SIXTH:
+                GG = m1 + (m2 - m1) * hue * 6.0
+            elif hue < 0.5:
+                GG = m2
+            elif hue < TWO_THIRD:
+                GG = m1 + (m2 - m1) * (TWO_THIRD - hue) * 6.0
+            else:
+                GG = m1
+            hue = (H - ONE_THIRD) % 1.0
+            if hue < ONE_SIXTH:
+                BB = m1 + (m2 - m1) * hue * 6.0
+            elif hue < 0.5:
+                BB = m2
+            elif hue < TWO_THIRD:
+                BB = m1 + (m2 - m1) * (TWO_THIRD - hue) * 6.0
+            else:
+                BB = m1
+            append((int(RR * 255), int(GG * 255), int(BB * 255)))
+        except (ValueError, OverflowError):
+            append(None)
+    return out
+
+
+def _hwb_kernel(args):
+    # colorsys.hls_to_rgb(H, 0.5, 1), inlined (its m1 is 0.0 and m2 is 1.0):
+    out = []
+    append = out.append
+    for h, w, b in args:
+        try:
+            H = h / 360.0
+            W = w / 100.0
+            B = b / 100.0
+            hue = (H + ONE_THIRD) % 1.0
+            RR = hue * 6.0 if hue < ONE_SIXTH else 1.0 if hue < 0.5 else (TWO_THIRD - hue) * 6.0 if hue < TWO_THIRD else 0.0
+            hue = H % 1.0
+            GG = hue * 6.0 if hue < ONE_SIXTH else 1.0 if hue < 0.5 else (TWO_THIRD - hue) * 6.0 if hue < TWO_THIRD else 0.0
+            hue = (H - ONE_THIRD) % 1.0
+            BB = hue * 6.0 if hue < ONE_SIXTH else 1.0 if hue < 0.5 else (TWO_THIRD - hue) * 6.0 if hue < TWO_THIRD else 0.0
+            K = 1 - W - B
+            r = int((RR * K + W) * 255)
+            g = int((GG * K + W) * 255)
+            b = int((BB * K + W) * 255)
+        except (ValueError, OverflowError):
+            append(None)
+            continue
+        append((
+            0 if r < 0 else 255 if r > 255 else r,
+            0 if g < 0 else 255 if g > 255 else g,
+            0 if b < 0 else 255 if b > 255 else b,
+        ))
+    return out
+
+
+def _lab_kernel(args):
+    # lab_to_rgb(), inlined:
+    out = []
+    append = out.append
+    for L, a, b in args:
+        try:
+            Y = (L + 16.0) / 116.0
+            X = a / 500.0 + Y
+            Z = Y - b / 200.0
+            Y3 = Y ** 3.0
+            Y = Y3 if Y3 > 0.008856 else (Y - 16.0 / 116.0) / 7.787
+            X3 = X ** 3.0
+            X = X3 if X3 > 0.008856 else (X - 16.0 / 116.0) / 7.787
+            Z3 = Z ** 3.0
+            Z = Z3 if Z3 > 0.008856 else (Z - 16.0 / 116.0) / 7.787
+            X *= 0.95047
+            Z *= 1.08883
+            RR = X * 3.240479 + Y * -1.537150 + Z * - 0.498535
+            GG = X * -0.969256 + Y * 1.875992 + Z * 0.041556
+            BB = X * 0.055648 + Y * -0.204043 + Z * 1.057311
+            r = int((1.055 * RR ** (1 / 2.4) - 0.055 if RR > 0.0031308 else 12.92 * RR) * 255)
+            g = int((1.055 * GG ** (1 / 2.4) - 0.055 if GG > 0.0031308 else 12.92 * GG) * 255)
+            b = int((1.055 * BB ** (1 / 2.4) - 0.055 if BB > 0.0031308 else 12.92 * BB) * 255)
+        except (ValueError, OverflowError):
+            append(None)
+            continue
+        append((
+            0 if r < 0 else 255 if r > 255 else r,
+            0 if g < 0 else 255 if g > 255 else g,
+            0 if b < 0 else 255 if b > 255 else b,
+        ))
+    return out
+
+
+def _lch_kernel(args):
+    cos = math.cos
+    sin = math.sin
+    radians = math.radians
+    labs = []
+    append = labs.append
+    for L, c, h in args:
+        try:
+            append((L, c * cos(radians(h)), c * sin(radians(h))))
+        except (ValueError, OverflowError):
+            append((L, NAN, NAN))  # comes out of _lab_kernel() as None
+    return _lab_kernel(labs)
+
+
+KERNELS = {
+    'hsv': _hsv_kernel,
+    'hsl': _hsl_kernel,
+    'hwb': _hwb_kernel,
+    'lab': _lab_kernel,
+    'lch': _lch_kernel,
+}
+
+
+# NumPy kernels
+#
+# These follow the converters operation by operation, so with only
+# arithmetic involved (hsv, hsl and hwb) results are bit-for-bit the same.
+# The power and trigonometric functions used by lab and lch can round
+# differently than the math module though, so channels landing too close
+# to an integer (where int() could go either way) are left as None.
+
+EXACT_MARGIN = 1e-7
+
+
+def _columns(args):
+    data = numpy.array(args, dtype=numpy.float64).reshape(-1, 3)
+    return data[:, 0], data[:, 1], data[:, 2]
+
+
+def _to_rgb(RR, GG, BB, clamp, exact):
+    channels = []
+    valid = None
+    for C in (RR, GG, BB):
+        C = C * 255
+        ok = numpy.isfinite(C)
+        C = numpy.where(ok, C, 0)
+        if not exact:
+            margin = numpy.abs(C - numpy.rint(C)) > EXACT_MARGIN
+            if clamp:
+                # int() of anything below 1 gets clamped to 0, and of
+                # anything above 255 to 255:
+                margin |= (C < 1 - EXACT_MARGIN) | (C > 255 + EXACT_MARGIN)
+            ok &= margin
+        valid = ok if valid is None else valid & ok
+        C = numpy.trunc(C)
+        if clamp:
+            C = numpy.clip(C, 0, 255)
+        channels.append(C.astype(numpy.int64).tolist())
+    return [
+        (r, g, b) if ok else None
+        for r, g, b, ok in zip(channels[0], channels[1], channels[2], valid.tolist())
+    ]
+
+
+def _hls(H, L, S):
+    # colorsys.hls_to_rgb()
+    m2 = numpy.where(L <= 0.5, L * (1.0 + S), L + S - (L * S))
+    m1 = 2.0 * L - m2
+
+    def _v(hue):
+        hue = numpy.mod(hue, 1.0)
+        return numpy.where(hue < 1.0 / 6.0, m1 + (m2 - m1) * hue * 6.0,
+               numpy.where(hue < 0.5, m2,
+               numpy.where(hue < 2.0 / 3.0, m1 + (m2 - m1) * (2.0 / 3.0 - hue) * 6.0,
+               m1)))
+
+    gray = S == 0.0
+    return (
+        numpy.where(gray, L, _v(H + 1.0 / 3.0)),
+        numpy.where(gray, L, _v(H)),
+        numpy.where(gray, L, _v(H - 1.0 / 3.0)),
+    )
+
+
+def _hsv_numpy(args):
+    h, s, v = _columns(args)
+    H = h / 360.0
+    S = s / 100.0
+    V = v / 100.0
+    # colorsys.hsv_to_rgb()
+    i = numpy.trunc(H * 6.0)
+    f = (H * 6.0) - i
+    p = V * (1.0 - S)
+    q = V * (1.0 - S * f)
+    t = V * (1.0 - S * (1.0 - f))
+    i = numpy.mod(i, 6)
+    sextants = [i == 0, i == 1, i == 2, i == 3, i == 4]
+    gray = S == 0.0
+    RR = numpy.where(gray, V, numpy.select(sextants, [V, q, p, p, t], V))
+    GG = numpy.where(gray, V, numpy.select(sextants, [t, V, V, q, p], p))
+    BB = numpy.where(gray, V, numpy.select(sextants, [p, p, t, V, V], q))
+    return _to_rgb(RR, GG, BB, False, True)
+
+
+def _hsl_numpy(args):
+    h, s, l = _columns(args)
+    RR, GG, BB = _hls(h / 360.0, l / 100.0, s / 100.0)
+    return _to_rgb(RR, GG, BB, False, True)
+
+
+def _hwb_numpy(args):
+    h, w, b = _columns(args)
+    H = h / 360.0
+    W = w / 100.0
+    B = b / 100.0
+    RR, GG, BB = _hls(H, numpy.full_like(H, 0.5), numpy.ones_like(H))
+    RR = RR * (1 - W - B) + W
+    GG = GG * (1 - W - B) + W
+    BB = BB * (1 - W - B) + W
+    return _to_rgb(RR, GG, BB, True, True)
+
+
+def _lab_arrays(L, a, b):
+    # lab_to_rgb()
+    Y = (L + 16.0) / 116.0
+    X = a / 500.0 + Y
+    Z = Y - b / 200.0
+
+    Y3 = Y ** 3.0
+    Y = numpy.where(Y3 > 0.008856, Y3, (Y - 16.0 / 116.0) / 7.787)
+    X3 = X ** 3.0
+    X = numpy.where(X3 > 0.008856, X3, (X - 16.0 / 116.0) / 7.787)
+    Z3 = Z ** 3.0
+    Z = numpy.where(Z3 > 0.008856, Z3, (Z - 16.0 / 116.0) / 7.787)
+
+    X *= 0.95047
+    Y *= 1.0
+    Z *= 1.08883
+
+    RR = X * 3.240479 + Y * -1.537150 + Z * - 0.498535
+    GG = X * -0.969256 + Y * 1.875992 + Z * 0.041556
+    BB = X * 0.055648 + Y * -0.204043 + Z * 1.057311
+
+    RR = numpy.where(RR > 0.0031308, 1.055 * numpy.abs(RR) ** (1 / 2.4) - 0.055, 12.92 * RR)
+    GG = numpy.where(GG > 0.0031308, 1.055 * numpy.abs(GG) ** (1 / 2.4) - 0.055, 12.92 * GG)
+    BB = numpy.where(BB > 0.0031308, 1.055 * numpy.abs(BB) ** (1 / 2.4) - 0.055, 12.92 * BB)
+    return _to_rgb(RR, GG, BB, True, False)
+
+
+def _lab_numpy(args):
+    L, a, b = _columns(args)
+    return _lab_arrays(L, a, b)
+
+
+def _lch_numpy(args):
+    L, c, h = _columns(args)
+    # lch_to_lab()
+    a = c * numpy.cos(numpy.radians(h))
+    b = c * numpy.sin(numpy.radians(h))
+    return _lab_arrays(L, a, b)
+
+
+NUMPY_KERNELS = {
+    'hsv': _hsv_numpy,
+    'hsl': _hsl_numpy,
+    'hwb': _hwb_numpy,
+    'lab': _lab_numpy,
+    'lch': _lch_numpy,
+}
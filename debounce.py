@@ -0,0 +1,125 @@
+from __future__ import absolute_import
+
+
+class Debounce(object):
+    """
+    Adaptive debounce for a view: keeps exponentially weighted moving
+    averages of what highlighting costs per KB and per line of text, and of
+    the time between keystrokes, to choose how long to wait before
+    highlighting (longer while busy typing) and whether the view is too
+    costly to highlight in full within the blocking budget.
+
+    The parameters last chosen are kept for inspection (see params()).
+    """
+    __slots__ = (
+        'cost_per_kb', 'cost_per_line', 'typing_interval', 'last_keystroke',
+        'cost', 'delay', 'delay_when_busy', 'large', 'typing_delay',
+    )
+
+    alpha = 0.3  # weight of the newest sample in the averages
+    min_sample = 16384  # bytes a partial pass must scan to be a fair sample
+    max_typing_pause = 2.0  # seconds, longer pauses aren't typing
+    typing_factor = 1.5  # wait this many keystroke intervals for typing to stop
+    busy_factor = 2.5  # times the scan cost to wait while busy
+    default_cost = 100  # ms, until something's been measured
+    min_delay = 50  # ms
+    max_delay = 3000  # ms
+    min_large_size = 262144  # bytes, smaller views are always highlighted in full
+
+    def __init__(self):
+        self.cost_per_kb = None  # ms
+        self.cost_per_line = None  # ms
+        self.typing_interval = None  # seconds
+        self.last_keystroke = None
+        self.cost = None  # ms, predicted for the whole view when last chosen
+        self.delay = None  # ms
+        self.delay_when_busy = None  # ms
+        self.large = None  # whether the view is highlighted as a large file
+        self.typing_delay = None  # ms, last chosen to rescan what was typed
+
+    def _average(self, average, sample):
+        if average is None:
+            return sample
+        return average + self.alpha * (sample - average)
+
+    def scanned(self, elapsed, size, lines, full=True):
+        """Records that scanning size bytes in lines lines took elapsed ms."""
+        if not full and size < self.min_sample:
+            return  # dominated by fixed costs
+        self.cost_per_kb = self._average(self.cost_per_kb, elapsed * 1024.0 / max(size, 1))
+        self.cost_per_line = self._average(self.cost_per_line, float(elapsed) / max(lines, 1))
+
+    def keystroke(self, now):
+        """Records a modification made at time now (seconds)."""
+        if self.last_keystroke is not None:
+            interval = now - self.last_keystroke
+            if 0 <= interval <= self.max_typing_pause:
+                self.typing_interval = self._average(self.typing_interval, interval)
+        self.last_keystroke = now
+
+    def predict(self, size, lines):
+        """Returns the expected cost (ms) of highlighting size bytes in lines lines."""
+        if self.cost_per_kb is None:
+            return None
+        return max(self.cost_per_kb * size / 1024.0, self.cost_per_line * lines)
+
+    def choose(self, size, lines, budget, min_delay=0, large=False):
+        """
+        Chooses the delays (ms) to wait before highlighting a view with size
+        bytes in lines lines, and whether it's too costly to highlight in
+        full within budget ms (large, until costs are measured); returns
+        (delay, delay_when_busy).
+        """
+        cost = self.predict(size, lines)
+        self.cost = cost
+        if cost is not None:
+            large = size >= self.min_large_size and cost > budget
+        self.large = large
+        if self.large:
+            cost = budget  # only about the budget is scanned at a time
+        elif cost is None:
+            cost = self.default_cost
+
+        # Give highlighting at least the time it takes, and wait for typing to stop:
+        delay = cost
+        if self.typing_interval is not None:
+            delay = max(delay, self.typing_interval * 1000 * self.typing_factor)
+        delay = int(min(self.max_delay, max(self.min_delay, delay)))
+        delay_when_busy = int(min(self.max_delay, max(delay * 2, cost * self.busy_factor)))
+
+        # If the user specifies a delay greater than the chosen delay,
+        # figure they only want to see marks when idle.
+        if min_delay > delay_when_busy:
+            delay = delay_when_busy = min_delay
+
+        self.delay = delay
+        self.delay_when_busy = delay_when_busy
+        return delay, delay_when_busy
+
+    def choose_typing(self, size, lines):
+        """
+        Chooses the delays (ms) to wait before rescanning size bytes in lines
+        lines changed by typing: what the rescan costs, and long enough for
+        typing to pause; returns (delay, delay_when_busy).
+        """
+        cost = self.predict(size, lines) or 0
+        delay = cost
+        if self.typing_interval is not None:
+            delay = max(delay, self.typing_interval * 1000 * self.typing_factor)
+        delay = int(min(self.max_delay, delay))
+        delay_when_busy = int(min(self.max_delay, max(delay * 2, cost * self.busy_factor)))
+        self.typing_delay = delay
+        return delay, delay_when_busy
+
+    def params(self):
+        """Returns the averages kept and the parameters last chosen."""
+        return dict(
+            cost_per_kb=self.cost_per_kb,
+            cost_per_line=self.cost_per_line,
+            typing_interval=self.typing_interval,
+            cost=self.cost,
+            delay=self.delay,
+            delay_when_busy=self.delay_when_busy,
+            large=self.large,
+            typing_delay=self.typing_delay,
+        )
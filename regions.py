@@ -0,0 +1,99 @@
+from __future__ import absolute_import
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class RegionIndex(object):
+    """
+    Highlighted ranges of a view, sorted by start, in array-backed columns
+    (start, end, color id), so the ranges on some lines can be found and
+    replaced by bisection instead of testing every region against every line.
+    """
+    __slots__ = ('starts', 'ends', 'ids', 'names', 'name_ids')
+
+    def __init__(self):
+        self.starts = array('q')
+        self.ends = array('q')
+        self.ids = array('l')
+        self.names = []
+        self.name_ids = {}
+
+    def __len__(self):
+        return len(self.starts)
+
+    def clear(self):
+        self.__init__()
+
+    def name_id(self, name):
+        try:
+            return self.name_ids[name]
+        except KeyError:
+            self.name_ids[name] = len(self.names)
+            self.names.append(name)
+            return self.name_ids[name]
+
+    def _span(self, begin, end):
+        """Returns the first and past-the-last positions of the ranges starting in [begin, end]."""
+        lo = bisect_left(self.starts, begin)
+        hi = bisect_right(self.starts, end, lo)
+        return lo, hi
+
+    def query(self, begin, end):
+        """Returns (start, end, name) of every range contained in [begin, end]."""
+        lo, hi = self._span(begin, end)
+        names = self.names
+        return [
+            (s, e, names[i])
+            for s, e, i in zip(self.starts[lo:hi], self.ends[lo:hi], self.ids[lo:hi])
+            if e <= end
+        ]
+
+    def replace(self, begin, end, ranges):
+        """
+        Replaces every range contained in [begin, end] with the given sorted
+        (start, end, name) ranges. Returns the names of the ranges removed.
+        """
+        lo, hi = self._span(begin, end)
+        starts, ends, ids = self.starts, self.ends, self.ids
+        removed = set()
+        kept = []
+        for k in range(lo, hi):
+            if ends[k] <= end:
+                removed.add(ids[k])
+            else:
+                kept.append((starts[k], ends[k], ids[k]))  # spans past the lines being replaced
+        new = [(s, e, self.name_id(name)) for s, e, name in ranges]
+        if kept:
+            new = sorted(new + kept)
+        starts[lo:hi] = array('q', [s for s, e, i in new])
+        ends[lo:hi] = array('q', [e for s, e, i in new])
+        ids[lo:hi] = array('l', [i for s, e, i in new])
+        return set(self.names[i] for i in removed)
+
+    def reset(self, ranges):
+        """Replaces all ranges with the given (start, end, name) ranges."""
+        self.clear()
+        new = sorted((s, e, self.name_id(name)) for s, e, name in ranges)
+        self.starts = array('q', [s for s, e, i in new])
+        self.ends = array('q', [e for s, e, i in new])
+        self.ids = array('l', [i for s, e, i in new])
+
+    def shift(self, begin, end, length):
+        """Follows the text in [begin, end) being replaced by length characters."""
+        delta = length - (end - begin)
+        starts, ends = self.starts, self.ends
+        # Ranges starting at or after the end of the change just move:
+        j = bisect_left(starts, end)
+        # Ranges before it that reach into the change get clipped to it:
+        i = j
+        while i > 0 and ends[i - 1] > begin:
+            i -= 1
+        for k in range(i, j):
+            if starts[k] > begin:
+                starts[k] = begin
+            e = ends[k]
+            ends[k] = e + delta if e >= end else max(begin, starts[k])
+        if delta and j < len(starts):
+            starts[j:] = array('q', [s + delta for s in starts[j:]])
+            ends[j:] = array('q', [e + delta for e in ends[j:]])
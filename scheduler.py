@@ -0,0 +1,138 @@
+from __future__ import absolute_import
+
+import time
+import threading
+import traceback
+
+# Job priorities, most urgent first:
+ACTIVE = 0  # the view in the active group of the active window
+VISIBLE = 1  # views active in some other group or window
+BACKGROUND = 2  # tabs not currently shown
+
+
+class Job(object):
+    __slots__ = (
+        'key', 'callback', 'priority', 'delay', 'due', 'deadline',
+        'scheduled', 'change_count', 'changes', 'seq',
+    )
+
+    def __repr__(self):
+        return '<Job %r priority=%s due=%.3f deadline=%.3f>' % (self.key, self.priority, self.due, self.deadline)
+
+
+class Scheduler(object):
+    """
+    Runs callbacks after a delay, one job per key (as in (view id, kind)):
+    scheduling a key again coalesces into the job already waiting for it,
+    whose callback is replaced and whose delay starts over (but never past
+    the deadline set when the job was first scheduled). Due jobs run by
+    priority, and a job whose view changed since it was scheduled (its
+    change_count moved) is cancelled and waits another delay instead.
+
+    Only one timer is armed at a time, through ``set_timeout(callback, ms)``;
+    ``clock()`` returns the time in seconds. Both can be simulated.
+    """
+    tolerance = 0.005  # seconds a job can run ahead of time
+
+    def __init__(self, set_timeout, clock=time.time, max_delay=10):
+        self.set_timeout = set_timeout
+        self.clock = clock
+        self.max_delay = max_delay  # seconds a job can wait, at most
+        self.jobs = {}
+        self.lock = threading.RLock()
+        self.timer = None  # when the armed timer is due
+        self.generation = 0  # of the armed timer, earlier ones are ignored
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, key):
+        return key in self.jobs
+
+    def schedule(self, key, callback, delay, delay_when_busy=None, priority=BACKGROUND, change_count=None):
+        """
+        Schedules callback to run in delay ms (delay_when_busy ms if the key
+        was scheduled again before the previous delay had passed four times).
+        If change_count (a callable) is given, the job won't run while what
+        it returns keeps changing.
+        """
+        with self.lock:
+            now = self.clock()
+            job = self.jobs.get(key)
+            if job is None:
+                job = Job()
+                job.key = key
+                job.deadline = now + self.max_delay
+                job.scheduled = None
+                self.jobs[key] = job
+            elif delay_when_busy is not None and now < job.scheduled + job.delay * 4 / 1000.0:
+                delay = delay_when_busy
+            self.seq += 1
+            job.seq = self.seq
+            job.callback = callback
+            job.priority = priority if job.scheduled is None else min(priority, job.priority)
+            job.delay = delay
+            job.due = min(now + delay / 1000.0, job.deadline)
+            job.scheduled = now
+            job.change_count = change_count
+            job.changes = change_count() if change_count is not None else None
+            self._arm()
+
+    def cancel(self, key):
+        """Drops the job waiting for key, if any."""
+        with self.lock:
+            self.jobs.pop(key, None)
+
+    def postpone(self, delay, keys=None):
+        """Holds back jobs waiting with a delay (not those that were to run
+           right away, nor those whose key keys(key) is false, if given) for
+           at least delay ms, up to their deadlines."""
+        with self.lock:
+            due = self.clock() + delay / 1000.0
+            for job in self.jobs.values():
+                if job.delay and (keys is None or keys(job.key)):
+                    job.due = min(max(job.due, due), job.deadline)
+
+    def _arm(self):
+        if not self.jobs:
+            return
+        due = min(job.due for job in self.jobs.values())
+        if self.timer is not None and self.timer <= due + self.tolerance:
+            return  # the armed timer fires early enough
+        self.timer = due
+        self.generation += 1
+        generation = self.generation
+        delay = max(0, int(round((due - self.clock()) * 1000)))
+        self.set_timeout(lambda: self.run(generation), delay)
+
+    def run(self, generation=None):
+        """Runs the jobs that are due, by priority, and re-arms the timer."""
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return  # superseded by a timer armed after this one
+            self.timer = None
+            now = self.clock()
+            due = sorted(
+                (job for job in self.jobs.values() if job.due <= now + self.tolerance),
+                key=lambda job: (job.priority, job.due, job.seq),
+            )
+            ready = []
+            for job in due:
+                if job.change_count is not None and now < job.deadline:
+                    changes = job.change_count()
+                    if changes != job.changes:
+                        # Changed under it, wait until changes settle down:
+                        job.changes = changes
+                        job.due = min(now + job.delay / 1000.0, job.deadline)
+                        continue
+                del self.jobs[job.key]
+                ready.append(job)
+            self._arm()
+
+        for job in ready:
+            try:
+                job.callback()
+            except Exception:
+                traceback.print_exc()
+        return len(ready)
@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+
+import json
+from collections import deque
+
+# Phases of a highlighting pass, timed in ms:
+PHASES = (
+    'snapshot',  # taking the snapshot of the text to scan (UI thread)
+    'match',  # finding colors with the prefilter and colors regexes
+    'normalize',  # parsing what was matched into normalized colors
+    'names',  # naming colors in the color scheme
+    'update',  # colorizer.update()
+    'icons',  # toicon()
+    'erase',  # erasing regions (before a full pass)
+    'apply',  # adding regions to the view
+)
+# Counters kept for every pass:
+COUNTS = ('bytes', 'matches', 'rejected', 'regions')
+PERCENTILES = (50, 90, 99)
+
+
+def capture_format(capture):
+    '''Returns the format of a colors regex capture (as in "rgba|255,0,0,0.5"
+       or "|#FFF"), to count rejected matches by.'''
+    mode, _, col = capture.partition('|')
+    if mode:
+        return mode
+    if col.startswith('#'):
+        return 'hex'
+    if col.startswith('0x'):
+        return '0x_hex'
+    if col.endswith('m') and '[' in col:
+        return 'xterm'
+    return 'named'
+
+
+def percentile(values, p):
+    '''Returns the p-th percentile (nearest rank) of the sorted values.'''
+    if not values:
+        return None
+    rank = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(len(values) - 1, rank))]
+
+
+class Stats(object):
+    """
+    Timing and counters of the last highlighting passes, kept in a ring
+    buffer of at most size samples. A sample is a dict with the time (ms)
+    taken by each of the PHASES it went through, its COUNTS, the total time
+    and the kind of pass ('full', 'selection' or 'pending'), as well as
+    the rejected matches by format (in 'rejected_formats').
+    """
+    __slots__ = ('samples',)
+
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, sample):
+        self.samples.append(sample)
+
+    def clear(self):
+        self.samples.clear()
+
+    def percentiles(self, kind=None):
+        '''Returns {field: [p50, p90, p99]} for the total, phases and counts
+           of the samples (of the given kind, if any).'''
+        samples = [s for s in self.samples if kind is None or s['kind'] == kind]
+        result = {}
+        for field in ('total',) + PHASES + COUNTS:
+            values = sorted(s[field] for s in samples if field in s)
+            if values:
+                result[field] = [percentile(values, p) for p in PERCENTILES]
+        return result
+
+    def rejected_formats(self):
+        '''Returns the number of rejected matches by format, over all samples.'''
+        rejected = {}
+        for sample in self.samples:
+            for fmt, count in sample.get('rejected_formats', {}).items():
+                rejected[fmt] = rejected.get(fmt, 0) + count
+        return rejected
+
+    def report(self, title):
+        '''Returns a text table of the percentiles, by kind of pass.'''
+        lines = ['%s (%d samples)' % (title, len(self.samples))]
+        for kind in sorted(set(s['kind'] for s in self.samples)):
+            count = sum(1 for s in self.samples if s['kind'] == kind)
+            lines.append('')
+            lines.append('  %s passes (%d): %s' % (kind, count, ' / '.join('p%d' % p for p in PERCENTILES)))
+            for field, values in sorted(self.percentiles(kind).items(), key=lambda item: _field_order(item[0])):
+                unit = '' if field in COUNTS else ' ms'
+                lines.append('    %-10s %s%s' % (field, ' / '.join(_format(v) for v in values), unit))
+        rejected = self.rejected_formats()
+        if rejected:
+            lines.append('')
+            lines.append('  rejected matches: %s' % ', '.join('%s=%d' % item for item in sorted(rejected.items())))
+        return '\n'.join(lines)
+
+    def dump(self, fp):
+        '''Writes the samples to fp, as JSON.'''
+        json.dump(list(self.samples), fp, indent=2, sort_keys=True)
+
+
+def _field_order(field):
+    fields = ('total',) + PHASES + COUNTS
+    return fields.index(field)
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '%.2f' % value
+    return str(value)
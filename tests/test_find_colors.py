@@ -0,0 +1,56 @@
+"""
+Tests for find_colors(), run against the stand-in sublime modules of the
+bench package.
+
+    python -m unittest discover tests
+"""
+from __future__ import absolute_import
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import harness  # noqa: E402
+
+
+def setUpModule():
+    global module
+    module = harness.load_plugin()
+
+
+def tearDownModule():
+    harness.shutdown()
+
+
+class FindColorsTestCase(unittest.TestCase):
+    def find(self, text):
+        options = module.scan_options()
+        colors_re, colors_re_capture = module.re_factory(**options)
+        prefilter_re = module.prefilter_factory(**options)
+        spans, found = module.find_colors(text, colors_re, colors_re_capture, prefilter_re, options['named_values'])
+        return [text[a:b] for a, b in spans]
+
+    def test_single_line(self):
+        self.assertEqual(self.find('a { color: #fff; background: rgb(1, 2, 3) }\n'), ['#fff', 'rgb(1, 2, 3)'])
+
+    def test_no_trigger(self):
+        self.assertEqual(self.find('nothing to see here\n' * 3), [])
+
+    def test_multiline_function(self):
+        self.assertEqual(self.find('rgb(255,\n 255,\n 255)\n'), ['rgb(255,\n 255,\n 255)'])
+
+    def test_multiline_functions_on_continuation_line(self):
+        self.assertEqual(self.find('rgb(1,\n2,3) rgb(4,\n5,6)\n'), ['rgb(1,\n2,3)', 'rgb(4,\n5,6)'])
+        self.assertEqual(
+            self.find('a: hsl(10,\n20%, 30%); b: hsl(10,\n20%, 30%);\n'),
+            ['hsl(10,\n20%, 30%)', 'hsl(10,\n20%, 30%)'],
+        )
+
+    def test_unclosed_function(self):
+        self.assertEqual(self.find('rgb(1, 2,\n#abc\n'), ['#abc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+"""
+Tests for the scheduler, driven by a simulated clock and set_timeout.
+
+    python -m unittest discover tests
+"""
+from __future__ import absolute_import
+
+import os
+import sys
+import heapq
+import itertools
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import Scheduler, ACTIVE, VISIBLE, BACKGROUND  # noqa: E402
+
+
+class FakeTimers(object):
+    """A simulated clock (kept in ms, so it doesn't drift) with
+    sublime.set_timeout() timers on it."""
+
+    def __init__(self):
+        self.now = 0
+        self.timers = []
+        self.armed = 0  # set_timeout() calls
+        self.seq = itertools.count()
+
+    def clock(self):
+        return self.now / 1000.0
+
+    def set_timeout(self, callback, delay):
+        self.armed += 1
+        heapq.heappush(self.timers, (self.now + delay, next(self.seq), callback))
+
+    def advance(self, ms):
+        """Moves the clock forward, firing the timers due meanwhile."""
+        until = self.now + ms
+        while self.timers and self.timers[0][0] <= until:
+            due, _, callback = heapq.heappop(self.timers)
+            self.now = max(self.now, due)
+            callback()
+        self.now = until
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.timers = FakeTimers()
+        self.scheduler = Scheduler(self.timers.set_timeout, clock=self.timers.clock, max_delay=1)
+        self.ran = []
+
+    def callback(self, name):
+        return lambda: self.ran.append(name)
+
+    def test_runs_after_delay(self):
+        self.scheduler.schedule('a', self.callback('a'), 100)
+        self.timers.advance(50)
+        self.assertEqual(self.ran, [])
+        self.timers.advance(50)
+        self.assertEqual(self.ran, ['a'])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_coalesces_superseded_jobs(self):
+        self.scheduler.schedule('a', self.callback('first'), 100)
+        self.timers.advance(50)
+        self.scheduler.schedule('a', self.callback('second'), 100)
+        self.assertEqual(len(self.scheduler), 1)
+        self.timers.advance(60)
+        self.assertEqual(self.ran, [])  # the delay started over
+        self.timers.advance(40)
+        self.assertEqual(self.ran, ['second'])
+        self.timers.advance(1000)
+        self.assertEqual(self.ran, ['second'])
+
+    def test_deadline(self):
+        # Rescheduled more often than its delay, the job still runs by its deadline:
+        for _ in range(19):
+            self.scheduler.schedule('a', self.callback('a'), 100)
+            self.timers.advance(50)
+        self.assertEqual(self.ran, [])
+        self.scheduler.schedule('a', self.callback('a'), 100)
+        self.timers.advance(50)  # the deadline, a second after it was first scheduled
+        self.assertEqual(self.ran, ['a'])
+
+    def test_delay_when_busy(self):
+        self.scheduler.schedule('a', self.callback('a'), 100, delay_when_busy=300)
+        self.timers.advance(50)
+        self.scheduler.schedule('a', self.callback('a'), 100, delay_when_busy=300)
+        self.timers.advance(200)
+        self.assertEqual(self.ran, [])
+        self.timers.advance(100)
+        self.assertEqual(self.ran, ['a'])
+
+    def test_cancelled_when_change_count_moves(self):
+        changes = [0]
+        self.scheduler.schedule('a', self.callback('a'), 100, change_count=lambda: changes[0])
+        self.timers.advance(50)
+        changes[0] += 1
+        self.timers.advance(50)
+        self.assertEqual(self.ran, [])  # changed under it, waits another delay
+        self.assertIn('a', self.scheduler)
+        self.timers.advance(100)
+        self.assertEqual(self.ran, ['a'])
+
+    def test_change_count_deadline(self):
+        changes = [0]
+        self.scheduler.schedule('a', self.callback('a'), 100, change_count=lambda: changes[0])
+        for _ in range(30):
+            changes[0] += 1
+            self.timers.advance(50)
+        self.assertEqual(self.ran, ['a'])
+
+    def test_cancel(self):
+        self.scheduler.schedule('a', self.callback('a'), 100)
+        self.scheduler.cancel('a')
+        self.timers.advance(1000)
+        self.assertEqual(self.ran, [])
+        self.scheduler.cancel('b')  # not there
+
+    def test_priority_order(self):
+        self.scheduler.schedule('background', self.callback('background'), 100, priority=BACKGROUND)
+        self.scheduler.schedule('visible', self.callback('visible'), 100, priority=VISIBLE)
+        self.scheduler.schedule('active', self.callback('active'), 100, priority=ACTIVE)
+        self.timers.advance(100)
+        self.assertEqual(self.ran, ['active', 'visible', 'background'])
+
+    def test_priority_is_raised_only(self):
+        self.scheduler.schedule('a', self.callback('a'), 100, priority=BACKGROUND)
+        self.scheduler.schedule('b', self.callback('b'), 100, priority=VISIBLE)
+        self.scheduler.schedule('a', self.callback('a'), 100, priority=ACTIVE)
+        self.scheduler.schedule('a', self.callback('a'), 100, priority=BACKGROUND)
+        self.timers.advance(100)
+        self.assertEqual(self.ran, ['a', 'b'])
+
+    def test_single_timer(self):
+        for i in range(10):
+            self.scheduler.schedule(i, self.callback(i), 100 + i * 10)
+        self.assertEqual(self.timers.armed, 1)  # later jobs don't arm timers of their own
+        self.scheduler.schedule('soon', self.callback('soon'), 10)
+        self.assertEqual(self.timers.armed, 2)  # re-armed, for the earlier job
+        self.timers.advance(10)
+        self.assertEqual(self.ran, ['soon'])
+        self.timers.advance(90)
+        self.assertEqual(self.ran, ['soon', 0])
+
+    def test_superseded_timer_is_ignored(self):
+        self.scheduler.schedule('a', self.callback('a'), 100)
+        self.scheduler.schedule('b', self.callback('b'), 10)
+        self.scheduler.cancel('b')
+        self.timers.advance(10)  # the timer armed for 'b' fires
+        self.assertEqual(self.ran, [])
+        self.timers.advance(90)  # the timer re-armed for 'a'
+        self.assertEqual(self.ran, ['a'])
+        self.timers.advance(100)  # the first timer, superseded
+        self.assertEqual(self.ran, ['a'])
+
+    def test_rearms_for_remaining_jobs(self):
+        self.scheduler.schedule('a', self.callback('a'), 100)
+        self.scheduler.schedule('b', self.callback('b'), 300)
+        self.timers.advance(100)
+        self.assertEqual(self.ran, ['a'])
+        self.assertEqual(len(self.timers.timers), 1)
+        self.timers.advance(200)
+        self.assertEqual(self.ran, ['a', 'b'])
+        self.assertEqual(self.timers.timers, [])
+
+    def test_postpone(self):
+        self.scheduler.schedule('a', self.callback('a'), 100)
+        self.scheduler.schedule('now', self.callback('now'), 0)
+        self.scheduler.postpone(500)
+        self.timers.advance(0)
+        self.assertEqual(self.ran, ['now'])  # jobs without a delay aren't held back
+        self.timers.advance(400)
+        self.assertEqual(self.ran, ['now'])
+        self.timers.advance(100)
+        self.assertEqual(self.ran, ['now', 'a'])
+
+    def test_postpone_keys(self):
+        self.scheduler.schedule('a', self.callback('a'), 100)
+        self.scheduler.schedule('b', self.callback('b'), 100)
+        self.scheduler.postpone(500, keys=lambda key: key != 'b')
+        self.timers.advance(100)
+        self.assertEqual(self.ran, ['b'])
+        self.timers.advance(400)
+        self.assertEqual(self.ran, ['b', 'a'])
+
+
+if __name__ == '__main__':
+    unittest.main()